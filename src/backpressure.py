@@ -0,0 +1,129 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Workload backpressure module.
+
+This module renders the limits of the keystone front end, so an overloaded unit rejects the
+requests it cannot serve in time with a fast 503, instead of queueing them until the clients
+time out:
+
+- The WSGI daemon processes of the keystone sites: the requests served at the same time
+  (processes x threads), the requests queued for a thread (listen-backlog), the time a request
+  waits in the queue (queue-timeout, and connect-timeout when the queue is full) and the time a
+  request is served (request-timeout). The original directive is kept in a comment, so the
+  limits are rendered from it, and it is restored when the limits are removed.
+- The rate limit of the requests of every client address, enforced by mod_qos if the keystone
+  image ships it. The requests over the limit are rejected with a 429.
+
+Both are read again by a graceful reload of apache, so keystone does not need to be restarted.
+"""
+
+import re
+from typing import List, Tuple
+
+APACHE_BACKPRESSURE_CONFIG = "/etc/apache2/conf-enabled/charm-backpressure.conf"
+QOS_MODULE = "/usr/lib/apache2/modules/mod_qos.so"
+# Period of the per-source rate limit, in seconds
+RATE_LIMIT_PERIOD = 10
+ORIGINAL_DIRECTIVE = "# Original directive, limited by the charm: "
+DAEMON_PROCESS_REGEX = re.compile(
+    rf"^(\s*)(?:{re.escape(ORIGINAL_DIRECTIVE)}(WSGIDaemonProcess\s.*)\n\s*)?"
+    r"(WSGIDaemonProcess\s.*)$",
+    re.MULTILINE,
+)
+
+
+def daemon_process_directive(
+    directive: str,
+    max_concurrent_requests: int,
+    listen_backlog: int,
+    queue_timeout: int,
+    request_timeout: int,
+) -> str:
+    """Render the limits in a WSGIDaemonProcess directive.
+
+    Args:
+        directive: original directive.
+        max_concurrent_requests: requests served at the same time, 0 to keep the original.
+            The threads of every process are set accordingly, with fewer processes if needed.
+        listen_backlog: requests queued for a thread, 0 to keep the original.
+        queue_timeout: time a request waits for a thread, in seconds, 0 to keep the original.
+        request_timeout: time a request is served, in seconds, 0 to keep the original.
+
+    Returns:
+        str: The directive with the limits.
+    """
+    _, name, *tokens = directive.split()
+    options: List[Tuple[str, str]] = [token.partition("=")[::2] for token in tokens]
+    limits = {}
+    if max_concurrent_requests:
+        # mod_wsgi runs a single process if the number of processes is not set
+        processes = min(int(dict(options).get("processes", "1")), max_concurrent_requests)
+        limits["processes"] = str(processes)
+        limits["threads"] = str(-(-max_concurrent_requests // processes))
+    if listen_backlog:
+        limits["listen-backlog"] = str(listen_backlog)
+    if queue_timeout:
+        limits["queue-timeout"] = str(queue_timeout)
+        # The requests that do not fit in the backlog fail after the same time
+        limits["connect-timeout"] = str(queue_timeout)
+    if request_timeout:
+        limits["request-timeout"] = str(request_timeout)
+    options = [(key, limits.pop(key, value)) for key, value in options] + list(limits.items())
+    rendered = [f"{key}={value}" if value else key for key, value in options]
+    return " ".join(["WSGIDaemonProcess", name] + rendered)
+
+
+def limit_daemon_processes(
+    site_config: str,
+    max_concurrent_requests: int,
+    listen_backlog: int,
+    queue_timeout: int,
+    request_timeout: int,
+) -> str:
+    """Render the limits in the WSGI daemon processes of an apache site.
+
+    Args:
+        site_config: configuration file of the site.
+        max_concurrent_requests: requests served at the same time, 0 to keep the original.
+        listen_backlog: requests queued for a thread, 0 to keep the original.
+        queue_timeout: time a request waits for a thread, in seconds, 0 to keep the original.
+        request_timeout: time a request is served, in seconds, 0 to keep the original.
+
+    Returns:
+        str: The configuration file of the site.
+    """
+
+    def replace(match: re.Match) -> str:
+        indentation, original, directive = match.groups()
+        original = original or directive
+        limited = daemon_process_directive(
+            original, max_concurrent_requests, listen_backlog, queue_timeout, request_timeout
+        )
+        if limited == " ".join(original.split()):
+            return f"{indentation}{original}"
+        return f"{indentation}{ORIGINAL_DIRECTIVE}{original}\n{indentation}{limited}"
+
+    return DAEMON_PROCESS_REGEX.sub(replace, site_config)
+
+
+def rate_limit_config(requests_per_second: int) -> str:
+    """Render the apache configuration file with the rate limit of every client address.
+
+    Args:
+        requests_per_second: requests allowed to every client address, 0 to disable the limit.
+
+    Returns:
+        str: The configuration file.
+    """
+    if not requests_per_second:
+        return ""
+    return (
+        "<IfModule !qos_module>\n"
+        f"    LoadModule qos_module {QOS_MODULE}\n"
+        "</IfModule>\n"
+        "SetEnvIf Request_URI . QS_Limit=yes\n"
+        f"QS_ClientEventLimitCount {requests_per_second * RATE_LIMIT_PERIOD}"
+        f" {RATE_LIMIT_PERIOD}\n"
+        "QS_ErrorResponseCode 429\n"
+    )
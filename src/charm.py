@@ -4,22 +4,46 @@
 
 """Keystone charm module."""
 
+import hashlib
+import json
 import logging
+import time
 from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
-from charms.observability_libs.v0.kubernetes_service_patch import KubernetesServicePatch
-from config_validator import ValidationError
 from ops import pebble
 from ops.charm import ActionEvent, CharmBase, ConfigChangedEvent, UpdateStatusEvent
+from ops.framework import EventBase, StoredState
 from ops.main import main
-from ops.model import ActiveStatus, BlockedStatus, Container, MaintenanceStatus
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
 
 import cluster
-from config import ConfigModel, MysqlConnectionData, get_environment, validate_config
-from interfaces import KeystoneServer, MysqlClient
+from interfaces import (
+    KeystoneServer,
+    LokiPushApiConsumer,
+    MysqlClient,
+    PrometheusScrapeProvider,
+)
+from metrics import EXPORTER_STATE_FILE, CharmMetrics, InstrumentedContainer
+from service_patch import ServicePatch
+from startup import StartupTimeline, instrument_entrypoint, marker_command
+from statefulset_patch import KubernetesStatefulSetPatch
+from tracing import Tracing, traced
+
+if TYPE_CHECKING:  # pragma: no cover
+    from command_runner import CommandRunner
+    from config import MysqlConnectionData
+    from maintenance import KeystoneMaintenance
 
 logger = logging.getLogger(__name__)
 
+# Note: the `config` module (and config_validator) is imported lazily, in the code paths that
+# validate the configuration, so that hooks like update-status do not pay for it. In the same
+# way, the modules that only some hooks and actions use (commands, maintenance, profiling,
+# logging and backpressure configuration) are imported where they are used. The metrics,
+# tracing and startup timeline modules are imported here, as they instrument every hook.
+
 
 # We expect the keystone container to use the default port
 PORT = 5000
@@ -27,10 +51,88 @@ PORT = 5000
 KEY_SETUP_FILE = "/etc/keystone/key-setup"
 CREDENTIAL_KEY_REPOSITORY = "/etc/keystone/credential-keys/"
 FERNET_KEY_REPOSITORY = "/etc/keystone/fernet-keys/"
+KEY_REPOSITORIES = [FERNET_KEY_REPOSITORY, CREDENTIAL_KEY_REPOSITORY]
+# JWS token provider. The staged repository holds the private key of the next keypair, whose
+# public key is distributed before it is used to sign tokens.
+JWS_PRIVATE_KEY_REPOSITORY = "/etc/keystone/jws-keys/private/"
+JWS_PUBLIC_KEY_REPOSITORY = "/etc/keystone/jws-keys/public/"
+JWS_STAGED_KEY_REPOSITORY = "/etc/keystone/jws-keys/staged/"
+JWS_KEY_REPOSITORIES = [
+    JWS_PRIVATE_KEY_REPOSITORY,
+    JWS_PUBLIC_KEY_REPOSITORY,
+    JWS_STAGED_KEY_REPOSITORY,
+]
+# Key repositories of the JWS private keys, kept in a Juju secret if supported
+JWS_PRIVATE_KEY_REPOSITORIES = [JWS_PRIVATE_KEY_REPOSITORY, JWS_STAGED_KEY_REPOSITORY]
+JWS_PRIVATE_KEY = "private.pem"
+JWS_KEYPAIR_FOLDER = "/tmp/jws-keypair/"
+# Memory-backed folder of the key repositories: /dev/shm is a tmpfs in every container
+MEMORY_KEY_REPOSITORIES = "/dev/shm/keystone/"
+# oslo.config environment variables overriding the location of the key repositories
+KEY_REPOSITORY_ENVIRONMENT = {
+    FERNET_KEY_REPOSITORY: "OS_FERNET_TOKENS__KEY_REPOSITORY",
+    CREDENTIAL_KEY_REPOSITORY: "OS_CREDENTIAL__KEY_REPOSITORY",
+    JWS_PRIVATE_KEY_REPOSITORY: "OS_JWT_TOKENS__JWS_PRIVATE_KEY_REPOSITORY",
+    JWS_PUBLIC_KEY_REPOSITORY: "OS_JWT_TOKENS__JWS_PUBLIC_KEY_REPOSITORY",
+}
 KEYSTONE_USER = "keystone"
 KEYSTONE_GROUP = "keystone"
-FERNET_MAX_ACTIVE_KEYS = 3
+# Minimum (and keystone default) of the fernet max_active_keys: primary, secondary and staged
+MIN_FERNET_MAX_ACTIVE_KEYS = 3
+# Rotation of the credential keys: the new key is distributed to all the units, then the
+# credentials are migrated to it by a one-shot Pebble service.
+CREDENTIAL_MIGRATE_SERVICE = "credential-migrate"
+CREDENTIAL_KEYS_DISTRIBUTING = "distributing"
+CREDENTIALS_MIGRATING = "migrating"
+CREDENTIALS_MIGRATED = "migrated"
 KEYSTONE_FOLDER = "/etc/keystone/"
+# Phases of `keystone-manage db_sync`, in order. The exit code of `db_sync --check` is 2, 3 or 4
+# if the expand, migrate or contract phase (respectively) is the first one pending.
+DB_SYNC_PHASES = ["expand", "migrate", "contract"]
+LOAD_GENERATOR_SCRIPT = Path(__file__).parent / "load_generator.py"
+LOAD_GENERATOR_PATH = "/tmp/keystone-load-generator.py"
+# Exit code of the load generator if keystone does not respond in time
+LOAD_GENERATOR_NOT_READY = 2
+# Time to wait for keystone to respond before warming it up, in seconds
+WARM_UP_WAIT = 60
+WARM_UP_CONCURRENCY = 8
+METRICS_PORT = 9180
+EXPORTER_SCRIPT = Path(__file__).parent / "exporter.py"
+EXPORTER_PATH = "/tmp/keystone-exporter/exporter.py"
+DB_ROUTER_SCRIPT = Path(__file__).parent / "db_router.py"
+DB_ROUTER_PATH = "/tmp/keystone-db-router/db_router.py"
+DB_ROUTER_SERVICE = "db-router"
+DB_ROUTER_HOST = "127.0.0.1"
+DB_ROUTER_PORT = 3307
+# Time the db router waits for an endpoint, if mysql-connect-timeout is not set
+DB_ROUTER_CONNECT_TIMEOUT = 5
+DATABASE_CONFIG = "/etc/keystone/keystone.conf.d/charm-database.conf"
+DRAIN_SCRIPT = Path(__file__).parent / "drain.py"
+DRAIN_PATH = "/tmp/keystone-drain/drain.py"
+# The ready check of keystone fails while this file exists
+DRAIN_FILE = "/tmp/keystone-drain/draining"
+# Time given to Pebble to stop the services after the drain, when the pod is terminated
+TERMINATION_GRACE_MARGIN = 30
+KEYSTONE_READY_CHECK = "keystone-ready"
+# Time given to the scheduled maintenance in update-status, in seconds
+MAINTENANCE_TIME_BUDGET = 30
+NAMESPACE_FILE = "/var/run/secrets/kubernetes.io/serviceaccount/namespace"
+# Config options that invalidate the tokens cached by the consumers when changed
+REVOCATION_SENSITIVE_CONFIG = [
+    "token-expiration",
+    "fernet-max-active-keys",
+    "admin-password",
+    "service-password",
+    "ldap-enabled",
+    "ldap-authentication-domain-name",
+    "ldap-url",
+    "ldap-user-tree-dn",
+    "ldap-user-filter",
+    "ldap-user-enabled-attribute",
+    "ldap-user-enabled-mask",
+    "ldap-user-enabled-default",
+    "ldap-user-enabled-invert",
+]
 
 
 class CharmError(Exception):
@@ -41,47 +143,573 @@ class KeystoneCharm(CharmBase):
     """Keystone Charm operator."""
 
     on = cluster.ClusterEvents()
+    _stored = StoredState()
 
     def __init__(self, *args) -> None:
         super().__init__(*args)
+        self._stored.set_default(
+            background_commands={},
+            warm_up_pending=False,
+            leader_key_sync_pending=False,
+            log_targets=[],
+            restart_waiting=False,
+            reload_pending=False,
+            jws_keys_pending=False,
+        )
+        self._container = InstrumentedContainer(self.unit.get_container("keystone"))
+        self.metrics = CharmMetrics(self, self.container)
+        self.tracing = Tracing(self, self.config.get("tracing-endpoint"), self.container)
+        self.startup = StartupTimeline(self, self.container)
         event_observe_mapping = {
             self.on.keystone_pebble_ready: self._on_config_changed,
             self.on.config_changed: self._on_config_changed,
             self.on.update_status: self._on_update_status,
+            self.on.leader_elected: self._on_leader_elected,
             self.on.cluster_keys_changed: self._on_cluster_keys_changed,
             self.on["keystone"].relation_joined: self._publish_keystone_info,
             self.on["db"].relation_changed: self._on_config_changed,
             self.on["db"].relation_broken: self._on_config_changed,
             self.on["db-sync"].action: self._on_db_sync_action,
+            self.on["prune"].action: self._on_prune_action,
+            self.on["benchmark"].action: self._on_benchmark_action,
+            self.on["profile"].action: self._on_profile_action,
+            self.on["rotate-credential-keys"].action: self._on_rotate_credential_keys_action,
+            self.on["cluster"].relation_changed: self._on_cluster_relation_changed,
+            self.on["cluster"].relation_departed: self._on_cluster_relation_changed,
+            self.on["logging"].relation_changed: self._on_logging_relation_changed,
+            self.on["logging"].relation_departed: self._on_logging_relation_changed,
+            self.on["logging"].relation_broken: self._on_logging_relation_changed,
         }
         for event, observer in event_observe_mapping.items():
             self.framework.observe(event, observer)
         self.cluster = cluster.Cluster(self)
         self.mysql_client = MysqlClient(self, relation_name="db")
         self.keystone = KeystoneServer(self, relation_name="keystone")
-        self.service_patch = KubernetesServicePatch(self, [(f"{self.app.name}", PORT)])
+        self.metrics_endpoint = PrometheusScrapeProvider(
+            self, relation_name="metrics-endpoint", port=METRICS_PORT
+        )
+        self.logging = LokiPushApiConsumer(self, relation_name="logging")
+        self.metrics.workload_state = {
+            "key_repositories": {
+                "fernet": self._key_repository_path(FERNET_KEY_REPOSITORY),
+                "credential": self._key_repository_path(CREDENTIAL_KEY_REPOSITORY),
+            },
+            "rotation_times": {
+                "fernet": self._fernet_rotation_time(self.config["token-expiration"])
+            },
+            "last_startup": self.startup.last,
+        }
+        self.service_patch = ServicePatch(
+            self,
+            [(f"{self.app.name}", PORT)],
+            internal_traffic_policy=self.config.get("service-internal-traffic-policy"),
+            topology_aware_hints=self.config.get("service-topology-aware-hints"),
+            session_affinity=self.config.get("service-session-affinity"),
+            session_affinity_timeout=self.config.get("service-session-affinity-timeout"),
+        )
+        self.framework.observe(self.on.config_changed, self._patch_service)
+        drain_grace_period = self.config.get("drain-grace-period")
+        self.statefulset_patch = KubernetesStatefulSetPatch(
+            self,
+            "keystone",
+            requests={
+                "cpu": self.config.get("cpu-request"),
+                "memory": self.config.get("memory-request"),
+            },
+            limits={
+                "cpu": self.config.get("cpu-limit"),
+                "memory": self.config.get("memory-limit"),
+            },
+            spread=self.config.get("pod-spread"),
+            topology_key=self.config.get("pod-spread-topology-key"),
+            pre_stop=self._drain_command() if drain_grace_period else None,
+            termination_grace_period=(
+                drain_grace_period + TERMINATION_GRACE_MARGIN if drain_grace_period else None
+            ),
+            refresh_event=self.on.config_changed,
+        )
+
+    @property
+    def container(self) -> InstrumentedContainer:
+        """Property to get keystone container, whose Pebble calls are instrumented."""
+        return self._container
 
     @property
-    def container(self) -> Container:
-        """Property to get keystone container."""
-        return self.unit.get_container("keystone")
+    def command_runner(self) -> "CommandRunner":
+        """Property to get the runner of commands in the keystone container."""
+        from command_runner import CommandRunner
+
+        return CommandRunner(self.container, default_timeout=self.config["command-timeout"])
+
+    @property
+    def service_host(self) -> str:
+        """Host name of the keystone service.
+
+        If the `publish-fqdn` option is enabled, the fully qualified domain name of the
+        Kubernetes service is returned: <service>.<namespace>.svc.<cluster-domain>. It ends
+        with a dot, so it is resolved as is: it has fewer dots than the `ndots:5` of the pods,
+        which would try the search domains first. The HTTP clients and apache ignore the dot.
+        Otherwise, the short name of the service is returned.
+        """
+        if not self.config.get("publish-fqdn"):
+            return self.app.name
+        return f"{self.app.name}.{self._namespace}.svc.{self.config['cluster-domain']}."
+
+    @property
+    def _namespace(self) -> str:
+        """The Kubernetes namespace we're running in.
+
+        The namespace is read in the same way as the ServicePatch does. If the
+        service account is not mounted, the model name is used, which matches the namespace.
+        """
+        try:
+            with open(NAMESPACE_FILE, "r") as f:
+                return f.read().strip()
+        except OSError:
+            return self.model.name
 
     def _on_db_sync_action(self, event: ActionEvent):
-        process = self.container.exec(["keystone-manage", "db_sync"])
+        """Handler for the db-sync action.
+
+        The pending migrations are checked first, and the action returns immediately if there
+        are none. Otherwise, the pending expand, migrate and contract phases run separately,
+        reporting their progress and timing.
+        """
+        command = ["keystone-manage", "db_sync"]
+        if event.params.get("background"):
+            self.command_runner.start_background("db-sync", command)
+            self._stored.background_commands["db-sync"] = "db-sync action"
+            event.set_results({"output": "db-sync started in the background."})
+            return
+        deadline = time.monotonic() + (
+            event.params.get("timeout") or self.config["command-timeout"]
+        )
         try:
-            process.wait()
-            event.set_results({"output": "db-sync was successfully executed."})
+            pending_phases = self._db_sync_pending_phases(self._remaining_time(deadline))
+            if not pending_phases:
+                event.set_results({"output": "No database migrations pending."})
+                return
+            results = {"phases": " ".join(pending_phases)}
+            for phase in pending_phases:
+                event.log(f"Running db_sync {phase} phase...")
+                start = time.monotonic()
+                self.command_runner.run(
+                    command + [f"--{phase}"], timeout=self._remaining_time(deadline)
+                )
+                elapsed = time.monotonic() - start
+                event.log(f"db_sync {phase} phase finished in {elapsed:.1f} seconds.")
+                results[f"{phase}-seconds"] = f"{elapsed:.1f}"
+            results["output"] = "db-sync was successfully executed."
+            event.set_results(results)
         except pebble.ExecError as e:
             error_message = f"db-sync action failed with code {e.exit_code} and stderr {e.stderr}."
             logger.error(error_message)
             event.fail(error_message)
+        except pebble.ChangeError as e:
+            error_message = f"db-sync action failed: {e.err}"
+            logger.error(error_message)
+            event.fail(error_message)
+        except CharmError as e:
+            error_message = f"db-sync action failed: {e}"
+            logger.error(error_message)
+            event.fail(error_message)
+
+    def _db_sync_pending_phases(self, timeout: float) -> List[str]:
+        """Get the pending phases of the database migration.
+
+        Args:
+            timeout (float): Timeout of the check, in seconds.
+
+        Returns:
+            List[str]: Pending phases, in order. Empty if the database is up to date.
+
+        Raises:
+            pebble.ExecError: if the check fails.
+        """
+        try:
+            self.command_runner.run(["keystone-manage", "db_sync", "--check"], timeout=timeout)
+            return []
+        except pebble.ExecError as e:
+            first_pending_phase = e.exit_code - 2
+            if 0 <= first_pending_phase < len(DB_SYNC_PHASES):
+                return DB_SYNC_PHASES[first_pending_phase:]
+            raise
+
+    def _remaining_time(self, deadline: float) -> float:
+        """Get the time left until a deadline.
+
+        Args:
+            deadline (float): Deadline, as returned by time.monotonic().
+
+        Returns:
+            float: Seconds left.
+
+        Raises:
+            CharmError: if the deadline has passed.
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise CharmError("timed out")
+        return remaining
+
+    def _on_prune_action(self, event: ActionEvent) -> None:
+        """Handler for the prune action."""
+        if not self.unit.is_leader():
+            event.fail("The prune action must run on the leader unit.")
+            return
+        try:
+            results = self._prune(event.params.get("application-credentials", False))
+            event.set_results({key: str(value) for key, value in results.items()})
+        except pebble.ExecError as e:
+            error_message = f"prune action failed with code {e.exit_code} and stderr {e.stderr}."
+            logger.error(error_message)
+            event.fail(error_message)
+        except (pebble.ChangeError, pebble.PathError, CharmError) as e:
+            error_message = f"prune action failed: {e}"
+            logger.error(error_message)
+            event.fail(error_message)
+
+    def _on_benchmark_action(self, event: ActionEvent) -> None:
+        """Handler for the benchmark action.
+
+        The load generator runs inside the keystone container against the local keystone API,
+        authenticating with the service credentials.
+        """
+        duration = event.params.get("duration", 30)
+        try:
+            event.log(f"Running the benchmark for {duration} seconds...")
+            results = self._run_load_generator(
+                concurrency=event.params.get("concurrency", 10), duration=duration
+            )
+            event.set_results(results)
+        except pebble.ExecError as e:
+            error_message = (
+                f"benchmark action failed with code {e.exit_code} and stderr {e.stderr}."
+            )
+            logger.error(error_message)
+            event.fail(error_message)
+        except (pebble.ChangeError, pebble.PathError) as e:
+            error_message = f"benchmark action failed: {e}"
+            logger.error(error_message)
+            event.fail(error_message)
+
+    def _run_load_generator(self, concurrency: int, duration: float, *args: str) -> Dict:
+        """Run the load generator in the keystone container, with the service credentials.
+
+        Args:
+            concurrency (int): Number of concurrent workers.
+            duration (float): Maximum duration of the load, in seconds.
+            args (str): Additional arguments of the load generator.
+
+        Returns:
+            Dict: Summary of the requests of each operation, and the total.
+        """
+        from config import ConfigModel
 
-    def _publish_keystone_info(self, _):
+        config = ConfigModel(**dict(self.config))
+        command = [
+            "python3",
+            LOAD_GENERATOR_PATH,
+            "--url",
+            f"http://localhost:{PORT}/v3",
+            "--username",
+            config.service_username,
+            "--project",
+            config.service_project,
+            "--user-domain",
+            config.user_domain_name,
+            "--project-domain",
+            config.project_domain_name,
+            "--concurrency",
+            str(concurrency),
+            "--duration",
+            str(duration),
+            *args,
+        ]
+        self.container.push(LOAD_GENERATOR_PATH, LOAD_GENERATOR_SCRIPT.read_text())
+        output = self.command_runner.run(
+            command,
+            # Leave time for the in-flight requests to finish
+            timeout=duration + self.config["command-timeout"],
+            environment={"KEYSTONE_PASSWORD": config.service_password},
+        )
+        return json.loads(output)
+
+    def _on_profile_action(self, event: ActionEvent) -> None:
+        """Handler for the profile action."""
+        from profiler import ProfilerError, WorkloadProfiler
+
+        duration = event.params.get("duration", 30)
+        profiler = WorkloadProfiler(self.container, self.command_runner, self.charm_dir)
+        try:
+            event.log(f"Profiling the keystone workers for {duration} seconds...")
+            profile = profiler.profile(duration, rate=event.params.get("rate", 100))
+            profile["top-functions"] = {
+                str(rank): function
+                for rank, function in enumerate(profile["top-functions"], start=1)
+            }
+            event.set_results(profile)
+        except pebble.ExecError as e:
+            error_message = f"profile action failed with code {e.exit_code} and stderr {e.stderr}."
+            logger.error(error_message)
+            event.fail(error_message)
+        except (pebble.ChangeError, pebble.PathError, ProfilerError) as e:
+            error_message = f"profile action failed: {e}"
+            logger.error(error_message)
+            event.fail(error_message)
+
+    def _run_scheduled_maintenance(self) -> None:
+        """Prune the keystone database if the `maintenance-interval` has elapsed.
+
+        The maintenance only runs in the leader. The time of the last maintenance is kept
+        in the peer relation, so it does not depend on which unit is the leader. The
+        maintenance is bounded by MAINTENANCE_TIME_BUDGET, and continues in the next
+        update-status if there are rows left.
+        """
+        interval = self.config["maintenance-interval"]
+        if not interval or not self.unit.is_leader():
+            return
+        if self.cluster.last_maintenance + interval > time.time():
+            return
+        try:
+            self._prune(
+                self.config["prune-application-credentials"], time_budget=MAINTENANCE_TIME_BUDGET
+            )
+        except (pebble.ExecError, pebble.ChangeError, pebble.PathError, CharmError) as e:
+            self._log_command_error("Scheduled maintenance failed.", e)
+
+    def _prune(
+        self, application_credentials: bool, time_budget: Optional[float] = None
+    ) -> Dict[str, float]:
+        """Prune the keystone database.
+
+        Args:
+            application_credentials (bool): Also delete the expired application credentials.
+            time_budget (Optional[float]): Time after which no more rows are deleted, in seconds.
+                If none given, every row is deleted.
+
+        Returns:
+            Dict[str, float]: Rows removed from each table, the time taken in seconds, and
+                whether every row was deleted.
+        """
+        results = self._maintenance().prune(application_credentials, time_budget)
+        self.cluster.save_maintenance_results(results)
+        return results
+
+    def _maintenance(self) -> "KeystoneMaintenance":
+        """Get the maintenance of the keystone database.
+
+        Raises:
+            CharmError: if the mysql relation is not ready.
+        """
+        from maintenance import KeystoneMaintenance
+
+        self._check_mysql_data()
+        db_host, db_port = self._db_address(self._mysql_data())
+        return KeystoneMaintenance(
+            self.command_runner,
+            db_host=db_host,
+            db_port=db_port,
+            db_password=self.config["keystone-db-password"],
+            token_expiration=self.config["token-expiration"],
+        )
+
+    def _on_rotate_credential_keys_action(self, event: ActionEvent) -> None:
+        """Handler for the rotate-credential-keys action."""
+        if not self.unit.is_leader():
+            event.fail("The rotate-credential-keys action must run on the leader unit.")
+            return
+        migration = self.cluster.credential_migration
+        if migration.get("state") in (CREDENTIAL_KEYS_DISTRIBUTING, CREDENTIALS_MIGRATING):
+            event.fail(
+                "The credential keys cannot be rotated until the credentials are migrated to"
+                f" the current key: {json.dumps(migration, sort_keys=True)}"
+            )
+            return
+        try:
+            self._rotate_credential_keys()
+        except pebble.ExecError as e:
+            error_message = (
+                f"rotate-credential-keys action failed with code {e.exit_code}"
+                f" and stderr {e.stderr}."
+            )
+            logger.error(error_message)
+            event.fail(error_message)
+            return
+        except pebble.ChangeError as e:
+            error_message = f"rotate-credential-keys action failed: {e}"
+            logger.error(error_message)
+            event.fail(error_message)
+            return
+        migration = self.cluster.credential_migration
+        pending_units = self.cluster.units_missing_credential_keys(self._credential_key_hash())
+        event.set_results(
+            {
+                "state": migration["state"],
+                "pending-units": " ".join(pending_units),
+                "output": "Credential keys rotated. The credentials are migrated to the new key"
+                " once every unit has it.",
+            }
+        )
+
+    def _run_scheduled_credential_rotation(self) -> None:
+        """Rotate the credential keys if the `credential-rotation-interval` has elapsed.
+
+        The rotation only runs in the leader, once the credentials have been migrated to the
+        current key. If the keys have never been rotated, the time of the primary key is used.
+        """
+        interval = self.config["credential-rotation-interval"]
+        if not interval or not self.unit.is_leader():
+            return
+        migration = self.cluster.credential_migration
+        if migration.get("state") in (CREDENTIAL_KEYS_DISTRIBUTING, CREDENTIALS_MIGRATING):
+            return
+        last_rotation = migration.get("rotated") or self._credential_key_time()
+        if last_rotation is None or last_rotation + interval > time.time():
+            return
+        try:
+            self._rotate_credential_keys()
+        except (pebble.ExecError, pebble.ChangeError) as e:
+            self._log_command_error("Scheduled credential key rotation failed.", e)
+
+    def _rotate_credential_keys(self) -> None:
+        """Rotate the credential keys, and distribute them to the units.
+
+        The credentials are migrated to the new key once every unit has it, in a later hook
+        (see `_continue_credential_rotation`).
+
+        Raises:
+            pebble.ExecError: if `keystone-manage credential_rotate` fails. Keystone refuses
+                to rotate the keys if there are credentials not migrated to the primary key.
+            pebble.ChangeError: if the command could not run, or timed out.
+        """
+        self.command_runner.run(
+            [
+                "keystone-manage",
+                "credential_rotate",
+                "--keystone-user",
+                KEYSTONE_USER,
+                "--keystone-group",
+                KEYSTONE_GROUP,
+            ],
+            environment=self._key_repository_environment(),
+        )
+        logger.info("Credential keys successfully rotated.")
+        self._key_leader_set()
+        self.cluster.save_credential_migration(
+            {"state": CREDENTIAL_KEYS_DISTRIBUTING, "rotated": time.time()}
+        )
+        self._continue_credential_rotation()
+
+    def _continue_credential_rotation(self) -> None:
+        """Move the rotation of the credential keys forward, in the leader.
+
+        Once every unit has acknowledged the new credential key, `keystone-manage
+        credential_migrate` runs in the background. Keystone re-encrypts the credentials one
+        by one, so the credential table is not locked, and the hooks are not blocked. Its
+        progress is logged, and saved in the peer relation data, until it finishes.
+        """
+        if not self.unit.is_leader():
+            return
+        migration = self.cluster.credential_migration
+        state = migration.get("state")
+        if state == CREDENTIAL_KEYS_DISTRIBUTING:
+            pending_units = self.cluster.units_missing_credential_keys(self._credential_key_hash())
+            if pending_units:
+                logger.info(f"Waiting for the new credential key in {', '.join(pending_units)}")
+                return
+            self._start_credential_migrate()
+            migration.update(state=CREDENTIALS_MIGRATING, started=time.time())
+            state = CREDENTIALS_MIGRATING
+        if state == CREDENTIALS_MIGRATING:
+            self._check_credential_migrate(migration)
+
+    def _start_credential_migrate(self) -> None:
+        """Start the migration of the credentials to the primary key, in the background."""
+        self.command_runner.start_background(
+            CREDENTIAL_MIGRATE_SERVICE,
+            [
+                "keystone-manage",
+                "credential_migrate",
+                "--keystone-user",
+                KEYSTONE_USER,
+                "--keystone-group",
+                KEYSTONE_GROUP,
+            ],
+            environment=self._key_repository_environment(),
+        )
+
+    def _check_credential_migrate(self, migration: Dict) -> None:
+        """Check the migration of the credentials, and report its progress.
+
+        Args:
+            migration (Dict): State of the rotation of the credential keys.
+        """
+        exit_code = self.command_runner.background_exit_code(CREDENTIAL_MIGRATE_SERVICE)
+        if (
+            exit_code is None
+            and CREDENTIAL_MIGRATE_SERVICE not in self.container.get_plan().services
+        ):
+            # The migration was started by the previous leader. It is safe to run it again:
+            # the credentials already encrypted with the primary key are skipped.
+            logger.info("Restarting the migration of the credentials in the new leader")
+            self._start_credential_migrate()
+            return
+        if exit_code:
+            logger.error(f"Migration of the credentials failed with code {exit_code}, retrying")
+            migration["failures"] = migration.get("failures", 0) + 1
+            self._start_credential_migrate()
+        elif exit_code == 0:
+            migration.update(state=CREDENTIALS_MIGRATED, finished=time.time())
+        try:
+            migration.update(
+                self._maintenance().credential_migration_progress(self._credential_key_hash())
+            )
+            logger.info(
+                f"Credentials migrated to the new key: {migration['migrated']}"
+                f"/{migration['total']}"
+            )
+        except (pebble.ExecError, pebble.ChangeError, pebble.PathError, CharmError) as e:
+            logger.warning(f"Failed to get the progress of the credential migration: {e}")
+        self.cluster.save_credential_migration(migration)
+
+    def _credential_key_hash(self) -> Optional[str]:
+        """Hash of the primary credential key in the peer relation data."""
+        return cluster.primary_key_hash(self.cluster.get_keys().get(CREDENTIAL_KEY_REPOSITORY, {}))
+
+    def _credential_key_time(self) -> Optional[float]:
+        """Modification time of the primary credential key, if any."""
+        try:
+            files = self.container.list_files(self._key_repository_path(CREDENTIAL_KEY_REPOSITORY))
+        except pebble.APIError:
+            return None
+        keys = [file for file in files if file.name.isdigit()]
+        if not keys:
+            return None
+        return max(keys, key=lambda file: int(file.name)).last_modified.timestamp()
+
+    def _check_background_commands(self) -> None:
+        """Report the completion of the commands running in the background."""
+        for name, description in list(self._stored.background_commands.items()):
+            exit_code = self.command_runner.background_exit_code(name)
+            if exit_code is None:
+                logger.debug(f"{description} still running in the background")
+                continue
+            if exit_code == 0:
+                logger.info(f"{description} finished successfully in the background")
+            else:
+                logger.error(f"{description} failed in the background with code {exit_code}")
+            del self._stored.background_commands[name]
+
+    def _publish_keystone_info(self, _=None):
         """Handler for keystone-relation-joined."""
-        if self.unit.is_leader():
+        # Without consumers, there is no need to validate and load the configuration
+        if self.unit.is_leader() and self.model.relations["keystone"]:
+            from config import ConfigModel
+
             config = ConfigModel(**dict(self.config))
             self.keystone.publish_info(
-                host=f"http://{self.app.name}:{PORT}/v3",
+                host=f"http://{self.service_host}:{PORT}/v3",
                 port=PORT,
                 user_domain_name=config.user_domain_name,
                 project_domain_name=config.project_domain_name,
@@ -93,15 +721,24 @@ class KeystoneCharm(CharmBase):
                 admin_username=config.admin_username,
                 admin_password=config.admin_password,
                 admin_project_name=config.admin_project,
+                token_cache_ttl=self._token_cache_ttl(config.token_expiration),
+                key_generation=self.cluster.key_generation,
+                invalidation_counter=self.cluster.invalidation_counter,
+                jws_public_keys=self._jws_public_keys(),
             )
 
-    def _on_config_changed(self, _: ConfigChangedEvent) -> None:
+    def _on_config_changed(self, event: ConfigChangedEvent) -> None:
         """Handler for config-changed event."""
+        from config_validator import ValidationError
+
         if self.container.can_connect():
             try:
+                self._update_log_forwarding()
                 self._handle_fernet_key_rotation()
                 self._safe_restart()
-                self.unit.status = ActiveStatus()
+                if self.unit.is_leader():
+                    self.cluster.track_config(self._revocation_sensitive_fingerprint())
+                self._complete_warm_up(event)
             except CharmError as e:
                 self.unit.status = BlockedStatus(str(e))
             except ValidationError as e:
@@ -110,19 +747,202 @@ class KeystoneCharm(CharmBase):
             logger.info("pebble socket not available, deferring config-changed")
             self.unit.status = MaintenanceStatus("waiting for pebble to start")
 
+    def _patch_service(self, _) -> None:
+        """Patch the Kubernetes service with the traffic routing options, once validated."""
+        from config_validator import ValidationError
+
+        from config import validate_config
+
+        try:
+            validate_config(self.config)
+        except ValidationError:
+            logger.info("Invalid configuration, the Kubernetes service is not patched.")
+            return
+        self.service_patch.patch()
+
     def _on_update_status(self, event: UpdateStatusEvent) -> None:
         """Handler for update-status event."""
         if self.container.can_connect():
             self._handle_fernet_key_rotation()
+            self._check_background_commands()
+            self._run_scheduled_maintenance()
+            self._run_scheduled_credential_rotation()
+            self._continue_credential_rotation()
+            if self._jws_keys_arrived():
+                self._on_config_changed(event)
+            elif self._stored.warm_up_pending or self.cluster.restart_requested:
+                self._complete_warm_up()
+            self._collect_startup()
         else:
             logger.info("pebble socket not available, deferring config-changed")
             event.defer()
             self.unit.status = MaintenanceStatus("waiting for pebble to start")
 
-    def _on_cluster_keys_changed(self, _) -> None:
+    def _complete_warm_up(self, event: Optional[EventBase] = None) -> None:
+        """Warm up keystone if needed, then report the unit active and publish the keystone info.
+
+        If keystone is not ready to be warmed up, or has not passed its health check after a
+        restart holding the restart lock, the unit stays in maintenance, and the warm-up is
+        retried in the next update-status hook. The health check is not waited for in the hook:
+        the event, if given, is deferred to check it again in the next hook.
+
+        Args:
+            event (Optional[EventBase]): Event to defer while keystone is not healthy.
+        """
+        if self._stored.warm_up_pending and not self._warm_up():
+            self.unit.status = MaintenanceStatus("waiting for keystone to warm up")
+            return
+        self._collect_startup()
+        if not self._release_restart_lock():
+            self.unit.status = MaintenanceStatus("waiting for keystone to pass its health check")
+            if event:
+                event.defer()
+            return
+        if self.unit.is_leader():
+            self._publish_keystone_info()
+        if self._stored.restart_waiting:
+            self.unit.status = ActiveStatus("waiting for the restart lock")
+        else:
+            self.unit.status = ActiveStatus()
+
+    def _collect_startup(self) -> None:
+        """Record the startup timeline of keystone, once keystone serves requests."""
+        if self.startup.collect():
+            self.metrics.workload_state["last_startup"] = self.startup.last
+
+    def _warm_up(self) -> bool:
+        """Warm up keystone after a (re)start.
+
+        The first requests pay for the cold database pools, the empty caches and the lazy
+        imports of the WSGI workers. The `warm-up-requests` token issue, validate and catalog
+        loops are sent by concurrent clients, so they are spread across the workers.
+
+        Returns:
+            bool: True if keystone has been warmed up, or the warm-up is disabled.
+        """
+        loops = self.config["warm-up-requests"]
+        if loops:
+            try:
+                results = self._run_load_generator(
+                    min(loops, WARM_UP_CONCURRENCY),
+                    self.config["command-timeout"],
+                    "--loops",
+                    str(loops),
+                    "--wait-ready",
+                    str(WARM_UP_WAIT),
+                )
+            except pebble.ExecError as e:
+                if e.exit_code == LOAD_GENERATOR_NOT_READY:
+                    logger.info("keystone is not ready to be warmed up yet")
+                else:
+                    self._log_command_error("Keystone warm-up failed.", e)
+                return False
+            except (pebble.ChangeError, pebble.PathError, ValueError) as e:
+                self._log_command_error("Keystone warm-up failed.", e)
+                return False
+            total = results["total"]
+            seconds = total["requests"] / total["requests-per-second"] if total["requests"] else 0
+            logger.info(
+                f"Keystone warmed up in {seconds:.1f} seconds: {total['requests']} requests,"
+                f" {total['errors']} errors, p50 {total['p50-ms']} ms, p99 {total['p99-ms']} ms"
+            )
+        self._stored.warm_up_pending = False
+        return True
+
+    def _on_leader_elected(self, _) -> None:
+        """Handler for leader-elected event.
+
+        The local key repositories of the new leader may be stale, so they are brought up
+        to date from the peer relation data before the leader reads or rotates them.
+        """
+        self._stored.leader_key_sync_pending = True
+        self._grant_restarts()
+        if self.container.can_connect():
+            self._handle_fernet_key_rotation()
+
+    def _on_cluster_relation_changed(self, event) -> None:
+        """Handler for cluster-relation-changed and cluster-relation-departed events.
+
+        The units acknowledge the credential keys in their relation data: the leader checks
+        whether the rotation of the credential keys can move forward. The units request and
+        release the restart lock in their relation data as well: the leader grants it to the
+        next batch of units, and the units waiting for the lock restart once granted.
+        """
+        self._grant_restarts()
+        if not self.container.can_connect():
+            if self._stored.restart_waiting:
+                event.defer()
+            return
+        if self.unit.is_leader():
+            self._continue_credential_rotation()
+            self._update_jws_rollout()
+        if (
+            self._stored.restart_waiting and self.cluster.restart_granted
+        ) or self._jws_keys_arrived():
+            self._on_config_changed(event)
+
+    def _on_logging_relation_changed(self, event) -> None:
+        """Handler for the logging relation events.
+
+        The log forwarding is updated, and the log forwarder started, by config-changed.
+        """
+        self._on_config_changed(event)
+
+    def _on_cluster_keys_changed(self, event) -> None:
         """Handler for ClusterKeysChanged event."""
         self._handle_fernet_key_rotation()
+        if self._jws_keys_arrived():
+            self._on_config_changed(event)
+        # The key generation has changed: refresh the caching hints of the consumers
+        self._publish_keystone_info()
 
+    def _revocation_sensitive_fingerprint(self) -> str:
+        """Get a fingerprint of the config options that affect the issued tokens.
+
+        Returns:
+            str: sha256 hex digest of the values in REVOCATION_SENSITIVE_CONFIG.
+        """
+        values = {key: self.config.get(key) for key in REVOCATION_SENSITIVE_CONFIG}
+        return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+    @property
+    def _fernet_max_active_keys(self) -> int:
+        """Maximum number of active fernet keys (and JWS public keys), with a minimum of 3."""
+        return max(
+            MIN_FERNET_MAX_ACTIVE_KEYS,
+            self.config.get("fernet-max-active-keys", MIN_FERNET_MAX_ACTIVE_KEYS),
+        )
+
+    def _fernet_rotation_time(self, token_expiration: int) -> int:
+        """Get the time, in seconds, between two fernet key rotations.
+
+        Args:
+            token_expiration (int): Token keys expiration in seconds.
+
+        Returns:
+            int: token-expiration / (max-active-keys - 2)
+        """
+        return token_expiration // (self._fernet_max_active_keys - 2)
+
+    def _token_cache_ttl(self, token_expiration: int) -> int:
+        """Get the time, in seconds, the consumers can cache a validated token.
+
+        Once it is no longer the primary key, a key is kept for (max-active-keys - 2)
+        rotations: the tokens it encrypted can be validated at least for that long, and
+        never longer than the token expiration.
+
+        Args:
+            token_expiration (int): Token keys expiration in seconds.
+
+        Returns:
+            int: min(token-expiration, (max-active-keys - 2) * rotation time)
+        """
+        key_lifetime = (self._fernet_max_active_keys - 2) * self._fernet_rotation_time(
+            token_expiration
+        )
+        return max(0, min(token_expiration, key_lifetime))
+
+    @traced
     def _handle_fernet_key_rotation(self) -> None:
         """Handles fernet key rotation.
 
@@ -134,22 +954,101 @@ class KeystoneCharm(CharmBase):
         if self.unit.is_leader():
             if not self.cluster.get_keys():
                 self._key_setup()
+            if self._jws_enabled:
+                self._jws_key_setup()
             self._fernet_keys_rotate_and_sync()
+            self._update_jws_rollout()
+
+    @property
+    def _jws_enabled(self) -> bool:
+        """Whether the JWS token provider is configured."""
+        return self.config.get("token-provider") == "jws"
+
+    @property
+    def _jws_keys_ready(self) -> bool:
+        """Whether this unit can sign JWS tokens.
 
+        The unit must have the JWS keypair, and so must the rest of the units, to validate the
+        tokens signed by this one. Only the relation data is read, so no Pebble call is made.
+        """
+        return self.cluster.jws_rolled_out and self.cluster.jws_keys_acknowledged
+
+    def _jws_keys_arrived(self) -> bool:
+        """Whether keystone waits for the JWS keys to sign tokens, and they have arrived."""
+        return self._stored.jws_keys_pending and self._jws_keys_ready
+
+    def _jws_keys_hash(self, keys: Dict[str, Any]) -> Optional[str]:
+        """Hash identifying the JWS keypairs of a set of keys: the hash of the last public key.
+
+        Args:
+            keys (Dict[str, Any]): Keys, by key repository.
+
+        Returns:
+            Optional[str]: The hash, if there are JWS public keys.
+        """
+        public_keys = keys.get(JWS_PUBLIC_KEY_REPOSITORY, {})
+        return cluster.primary_key_hash(
+            {Path(name).stem: key for name, key in public_keys.items()}
+        )
+
+    def _update_jws_rollout(self) -> None:
+        """Record whether every unit has the JWS keypair, if this unit is the leader.
+
+        Like the credential keys, the JWS keypair is acknowledged by every unit before it is
+        used: the units keep the fernet token provider until then. Once rolled out, the rotations
+        of the JWS keys do not need it again, as the staged public key is distributed before it
+        signs tokens.
+        """
+        if not self.unit.is_leader():
+            return
+        if not self._jws_enabled:
+            self.cluster.set_jws_rolled_out(False)
+            return
+        key_hash = self._jws_keys_hash(self.cluster.get_keys())
+        self.cluster.set_jws_rolled_out(
+            self.cluster.jws_rolled_out
+            or (
+                key_hash is not None
+                and self.cluster.jws_keys_acknowledged
+                and not self.cluster.units_missing_jws_keys(key_hash)
+            )
+        )
+
+    @property
+    def _key_repositories(self) -> List[str]:
+        """Key repositories managed by the leader."""
+        if self._jws_enabled:
+            return KEY_REPOSITORIES + JWS_KEY_REPOSITORIES
+        return KEY_REPOSITORIES
+
+    @traced
     def _key_write(self) -> None:
-        """Write keys to container from the relation data."""
-        if self.unit.is_leader():
+        """Write keys to container from the relation data.
+
+        The leader only writes the keys if its key repositories are empty, for instance
+        after moving them to the memory-backed storage, or if it has just been elected.
+        """
+        fernet_key_repository = self._key_repository_path(FERNET_KEY_REPOSITORY)
+        if (
+            self.unit.is_leader()
+            and not self._stored.leader_key_sync_pending
+            and self._file_exists(f"{fernet_key_repository}0")
+        ):
             return
         keys = self.cluster.get_keys()
         if not keys:
             logger.debug('"key_repository" not in relation data yet...')
+            self._stored.leader_key_sync_pending = False
             return
+        # Correlate the key application with the rotation in the leader
+        self.tracing.link(self.cluster.trace_context, key_generation=self.cluster.key_generation)
 
-        for key_repository in [FERNET_KEY_REPOSITORY, CREDENTIAL_KEY_REPOSITORY]:
-            self._create_keys_folders()
-            for key_number, key in keys[key_repository].items():
+        self._create_keys_folders(list(keys))
+        for key_repository, repository_keys in keys.items():
+            key_repository_path = self._key_repository_path(key_repository)
+            for key_number, key in repository_keys.items():
                 logger.debug(f"writing key {key_number} in {key_repository}")
-                file_path = f"{key_repository}{key_number}"
+                file_path = f"{key_repository_path}{key_number}"
                 if self._file_changed(file_path, key):
                     self.container.push(
                         file_path,
@@ -158,7 +1057,22 @@ class KeystoneCharm(CharmBase):
                         group=KEYSTONE_GROUP,
                         permissions=0o600,
                     )
+            # Remove the keys that have been rotated out by the leader
+            for file in self.container.list_files(key_repository_path):
+                if file.name not in repository_keys:
+                    logger.debug(f"removing key {file.name} from {key_repository}")
+                    self.container.remove_path(file.path)
         self.container.push(KEY_SETUP_FILE, "")
+        # The leader waits for every unit to have the credential key to migrate the credentials
+        self.cluster.ack_credential_keys(
+            cluster.primary_key_hash(keys.get(CREDENTIAL_KEY_REPOSITORY, {}))
+        )
+        # The leader waits for every unit to have the JWS keypair to use the JWS token provider
+        self.cluster.ack_jws_keys(self._jws_keys_hash(keys))
+        self.metrics.key_synced()
+        if self.cluster.last_rotation:
+            self.metrics.workload_state["last_rotations"] = {"fernet": self.cluster.last_rotation}
+        self._stored.leader_key_sync_pending = False
 
     def _file_changed(self, file_path: str, content: str) -> bool:
         """Check if file in container has changed its value.
@@ -182,84 +1096,128 @@ class KeystoneCharm(CharmBase):
                 return False
         return True
 
-    def _create_keys_folders(self) -> None:
-        """Create folders for Key repositories."""
-        fernet_key_repository_found = False
-        credential_key_repository_found = False
-        for file in self.container.list_files(KEYSTONE_FOLDER):
-            if file.type == pebble.FileType.DIRECTORY:
-                if file.path == CREDENTIAL_KEY_REPOSITORY:
-                    credential_key_repository_found = True
-                if file.path == FERNET_KEY_REPOSITORY:
-                    fernet_key_repository_found = True
-        if not fernet_key_repository_found:
-            self.container.make_dir(
-                FERNET_KEY_REPOSITORY,
-                user="keystone",
-                group="keystone",
-                permissions=0o700,
-                make_parents=True,
-            )
-        if not credential_key_repository_found:
-            self.container.make_dir(
-                CREDENTIAL_KEY_REPOSITORY,
-                user=KEYSTONE_USER,
-                group=KEYSTONE_GROUP,
-                permissions=0o700,
-                make_parents=True,
+    def _create_keys_folders(self, key_repositories: Optional[List[str]] = None) -> None:
+        """Create folders for Key repositories.
+
+        Args:
+            key_repositories (Optional[List[str]]): Key repositories to create. If none given,
+                the key repositories managed by the leader are created.
+        """
+        for key_repository in key_repositories or self._key_repositories:
+            key_repository_path = self._key_repository_path(key_repository)
+            if not self.container.isdir(key_repository_path):
+                self.container.make_dir(
+                    key_repository_path,
+                    user=KEYSTONE_USER,
+                    group=KEYSTONE_GROUP,
+                    permissions=0o700,
+                    make_parents=True,
+                )
+
+    def _key_repository_path(self, key_repository: str) -> str:
+        """Get the path of a key repository in the container.
+
+        If the `memory-backed-key-repositories` option is enabled, the key repository
+        is located in /dev/shm, which needs no storage. The keys are identified by the
+        default path of their repository in the peer relation data regardless.
+
+        Args:
+            key_repository (str): Default path of the key repository.
+
+        Returns:
+            str: Path of the key repository.
+        """
+        if not self.config.get("memory-backed-key-repositories"):
+            return key_repository
+        return f"{MEMORY_KEY_REPOSITORIES}{Path(key_repository).relative_to(KEYSTONE_FOLDER)}/"
+
+    def _key_repository_environment(self) -> Dict[str, str]:
+        """Get the environment variables configuring the key repositories of keystone.
+
+        Returns:
+            Dict[str, str]: Empty if the default key repositories and max active keys are used.
+        """
+        environment = {}
+        if self._fernet_max_active_keys != MIN_FERNET_MAX_ACTIVE_KEYS:
+            environment["OS_FERNET_TOKENS__MAX_ACTIVE_KEYS"] = str(self._fernet_max_active_keys)
+        if self.config.get("memory-backed-key-repositories"):
+            environment.update(
+                {
+                    env: self._key_repository_path(key_repository)
+                    for key_repository, env in KEY_REPOSITORY_ENVIRONMENT.items()
+                }
             )
+        return environment
 
     def _fernet_keys_rotate_and_sync(self) -> None:
         """Rotate and sync the keys if the unit is the leader and the primary key has expired.
 
-        The modification time of the staging key (key with index '0') is used,
-        along with the config setting "token-expiration" to determine whether to
-        rotate the keys.
+        The time of the last rotation kept in the peer relation data is used, along with the
+        config setting "token-expiration" to determine whether to rotate the keys. If it is not
+        known yet, the modification time of the staging key (key with index '0') is used, and
+        saved in the peer relation data.
 
-        The rotation time = token-expiration / (max-active-keys - 2)
-        where max-active-keys has a minimum of 3.
+        The rotation time = token-expiration / (fernet-max-active-keys - 2)
+        where fernet-max-active-keys has a minimum of 3.
         """
         if not self.unit.is_leader():
             return
         try:
-            fernet_key_file = self.container.list_files(f"{FERNET_KEY_REPOSITORY}0")[0]
-            last_rotation = fernet_key_file.last_modified.timestamp()
+            fernet_key_repository = self._key_repository_path(FERNET_KEY_REPOSITORY)
+            fernet_key_file = self.container.list_files(f"{fernet_key_repository}0")[0]
         except pebble.APIError:
             logger.warning(
                 "Fernet key rotation requested but key repository not " "initialized yet"
             )
             return
+        last_rotation = self.cluster.last_rotation or fernet_key_file.last_modified.timestamp()
+        self.metrics.workload_state["last_rotations"] = {"fernet": last_rotation}
 
-        config = ConfigModel(**self.config)
-        rotation_time = config.token_expiration // (FERNET_MAX_ACTIVE_KEYS - 2)
+        rotation_time = self._fernet_rotation_time(self.config["token-expiration"])
 
         now = datetime.now().timestamp()
         if last_rotation + rotation_time > now:
             # No rotation to do as not reached rotation time
             logger.debug("No rotation needed")
-            self._key_leader_set()
+            self._key_leader_set(last_rotation)
             return
         # now rotate the keys and sync them
         self._fernet_rotate()
-        self._key_leader_set()
+        if self._jws_enabled:
+            self._jws_rotate()
+        self._key_leader_set(now)
+        self.metrics.workload_state["last_rotations"] = {"fernet": now}
 
         logger.info("Rotated and started sync of fernet keys")
 
-    def _key_leader_set(self) -> None:
+    @traced
+    def _key_leader_set(self, last_rotation: Optional[float] = None) -> None:
         """Read current key sets and update peer relation data.
 
         The keys are read from the `FERNET_KEY_REPOSITORY` and `CREDENTIAL_KEY_REPOSITORY`
-        directories. Note that this function will fail if it is called on the unit that is
-        not the leader.
+        directories, and the JWS key repositories if the JWS token provider is configured.
+        Note that this function will fail if it is called on the unit that is not the leader.
+
+        Args:
+            last_rotation (Optional[float]): Time of the last rotation of the fernet keys.
         """
         disk_keys = {}
-        for key_repository in [FERNET_KEY_REPOSITORY, CREDENTIAL_KEY_REPOSITORY]:
+        for key_repository in self._key_repositories:
             disk_keys[key_repository] = {}
-            for file in self.container.list_files(key_repository):
-                key_content = self.container.pull(f"{key_repository}{file.name}").read()
+            key_repository_path = self._key_repository_path(key_repository)
+            for file in self.container.list_files(key_repository_path):
+                key_content = self.container.pull(f"{key_repository_path}{file.name}").read()
                 disk_keys[key_repository][file.name] = key_content
-        self.cluster.save_keys(disk_keys)
+        self.cluster.save_keys(
+            disk_keys,
+            trace_context=self.tracing.inject(),
+            last_rotation=last_rotation,
+            private_repositories=JWS_PRIVATE_KEY_REPOSITORIES,
+        )
+        self.cluster.ack_jws_keys(self._jws_keys_hash(disk_keys))
+        self.metrics.key_synced()
 
+    @traced
     def _fernet_rotate(self) -> None:
         """Rotate Fernet keys.
 
@@ -275,22 +1233,136 @@ class KeystoneCharm(CharmBase):
         """
         logger.debug("Rotating Fernet tokens")
         try:
-            exec_command = [
-                "keystone-manage",
-                "fernet_rotate",
-                "--keystone-user",
-                KEYSTONE_USER,
-                "--keystone-group",
-                KEYSTONE_GROUP,
-            ]
-            logger.debug(f'Executing command: {" ".join(exec_command)}')
-            self.container.exec(exec_command).wait()
+            self.command_runner.run(
+                [
+                    "keystone-manage",
+                    "fernet_rotate",
+                    "--keystone-user",
+                    KEYSTONE_USER,
+                    "--keystone-group",
+                    KEYSTONE_GROUP,
+                ],
+                environment=self._key_repository_environment(),
+            )
             logger.info("Fernet keys successfully rotated.")
-        except pebble.ExecError as e:
-            logger.error(f"Fernet Key rotation failed: {e}")
-            logger.error("Exited with code %d. Stderr:", e.exit_code)
-            for line in e.stderr.splitlines():
-                logger.error("    %s", line)
+        except (pebble.ExecError, pebble.ChangeError) as e:
+            self._log_command_error("Fernet Key rotation failed.", e)
+
+    def _jws_key_setup(self) -> None:
+        """Initialize the JWS key repositories.
+
+        Two keypairs are created: the primary one, used to sign the tokens, and the staged
+        one, whose public key is distributed to all the units before it becomes primary.
+
+        Note that we only want to do this once, so it is skipped if the staged private
+        key exists already.
+        """
+        staged_private_key = (
+            f"{self._key_repository_path(JWS_STAGED_KEY_REPOSITORY)}{JWS_PRIVATE_KEY}"
+        )
+        if self._file_exists(staged_private_key) or not self.unit.is_leader():
+            return
+
+        logger.debug("Setting up key repositories for JWS tokens.")
+        self._create_keys_folders(JWS_KEY_REPOSITORIES)
+        try:
+            self._jws_create_keypair(JWS_PRIVATE_KEY_REPOSITORY)
+            self._jws_create_keypair(JWS_STAGED_KEY_REPOSITORY)
+            logger.info("JWS key repositories initialized successfully.")
+        except (pebble.PathError, pebble.ExecError, pebble.ChangeError) as e:
+            self._log_command_error("Failed initializing JWS key repositories.", e)
+
+    def _jws_rotate(self) -> None:
+        """Rotate JWS keys.
+
+        The staged private key becomes the primary one, and a new staged keypair is
+        created. Only the public keys of the last `fernet-max-active-keys` keypairs are kept,
+        so the tokens signed by the previous primary key can be validated until they expire.
+
+        Note that this does NOT synchronise the keys between the units.  This is
+        performed in `self._key_leader_set`.
+        """
+        logger.debug("Rotating JWS keys")
+        private_key_repository = self._key_repository_path(JWS_PRIVATE_KEY_REPOSITORY)
+        staged_key_repository = self._key_repository_path(JWS_STAGED_KEY_REPOSITORY)
+        public_key_repository = self._key_repository_path(JWS_PUBLIC_KEY_REPOSITORY)
+        try:
+            staged_private_key = self.container.pull(
+                f"{staged_key_repository}{JWS_PRIVATE_KEY}"
+            ).read()
+            self.container.push(
+                f"{private_key_repository}{JWS_PRIVATE_KEY}",
+                staged_private_key,
+                user=KEYSTONE_USER,
+                group=KEYSTONE_GROUP,
+                permissions=0o600,
+            )
+            self._jws_create_keypair(JWS_STAGED_KEY_REPOSITORY)
+            public_key_indexes = sorted(self._jws_public_key_indexes())
+            for index in public_key_indexes[: -self._fernet_max_active_keys]:
+                self.container.remove_path(f"{public_key_repository}{index}.pem")
+            logger.info("JWS keys successfully rotated.")
+        except (pebble.PathError, pebble.ExecError, pebble.ChangeError) as e:
+            self._log_command_error("JWS Key rotation failed.", e)
+
+    def _jws_create_keypair(self, private_key_repository: str) -> None:
+        """Create a JWS keypair.
+
+        The keypair is created with `keystone-manage create_jws_keypair`. The private key is
+        stored in `private_key_repository`, and the public key is added to the public key
+        repository with the next index.
+
+        Args:
+            private_key_repository (str): Repository of the private key.
+        """
+        self.container.make_dir(JWS_KEYPAIR_FOLDER, make_parents=True)
+        try:
+            self.command_runner.run(
+                ["keystone-manage", "create_jws_keypair", "--force"],
+                working_dir=JWS_KEYPAIR_FOLDER,
+            )
+            private_key = self.container.pull(f"{JWS_KEYPAIR_FOLDER}private.pem").read()
+            public_key = self.container.pull(f"{JWS_KEYPAIR_FOLDER}public.pem").read()
+        finally:
+            self.container.remove_path(JWS_KEYPAIR_FOLDER, recursive=True)
+        next_index = max(self._jws_public_key_indexes(), default=0) + 1
+        for file_path, content in [
+            (f"{self._key_repository_path(private_key_repository)}{JWS_PRIVATE_KEY}", private_key),
+            (
+                f"{self._key_repository_path(JWS_PUBLIC_KEY_REPOSITORY)}{next_index}.pem",
+                public_key,
+            ),
+        ]:
+            self.container.push(
+                file_path,
+                content,
+                user=KEYSTONE_USER,
+                group=KEYSTONE_GROUP,
+                permissions=0o600,
+            )
+
+    def _jws_public_key_indexes(self) -> List[int]:
+        """Get the indexes of the public keys in the JWS public key repository."""
+        public_key_repository = self._key_repository_path(JWS_PUBLIC_KEY_REPOSITORY)
+        return [
+            int(Path(file.name).stem)
+            for file in self.container.list_files(public_key_repository, pattern="*.pem")
+        ]
+
+    def _jws_public_keys(self) -> Optional[List[str]]:
+        """Get the JWS public keys from the relation data.
+
+        Returns:
+            Optional[List[str]]: Public keys, sorted by index, if the JWS token provider is
+                configured. Otherwise, None.
+        """
+        if not self._jws_enabled:
+            return None
+        public_keys = self.cluster.get_keys().get(JWS_PUBLIC_KEY_REPOSITORY, {})
+        return [
+            public_keys[name]
+            for name in sorted(public_keys, key=lambda name: int(Path(name).stem))
+        ]
 
     def _key_setup(self) -> None:
         """Initialize Fernet and Credential encryption key repositories.
@@ -301,7 +1373,8 @@ class KeystoneCharm(CharmBase):
             keystone-manage credential_setup
 
         In addition we migrate any credentials currently stored in database using
-        the null key to be encrypted by the new credential key:
+        the null key to be encrypted by the new credential key, once every unit has it
+        (see `_continue_credential_rotation`):
 
             keystone-manage credential_migrate
 
@@ -313,24 +1386,41 @@ class KeystoneCharm(CharmBase):
 
         logger.debug("Setting up key repositories for Fernet tokens and Credential encryption.")
         try:
-            for command in ["fernet_setup", "credential_setup"]:
-                exec_command = [
-                    "keystone-manage",
-                    command,
-                    "--keystone-user",
-                    KEYSTONE_USER,
-                    "--keystone-group",
-                    KEYSTONE_GROUP,
-                ]
-                logger.debug(f'Executing command: {" ".join(exec_command)}')
-                self.container.exec(exec_command).wait()
+            # The setup commands are independent: run them in a single exec
+            self.command_runner.run_batch(
+                [
+                    [
+                        "keystone-manage",
+                        command,
+                        "--keystone-user",
+                        KEYSTONE_USER,
+                        "--keystone-group",
+                        KEYSTONE_GROUP,
+                    ]
+                    for command in ["fernet_setup", "credential_setup"]
+                ],
+                environment=self._key_repository_environment(),
+            )
             self.container.push(KEY_SETUP_FILE, "")
+            self.cluster.save_credential_migration({"state": CREDENTIAL_KEYS_DISTRIBUTING})
             logger.info("Key repositories initialized successfully.")
-        except pebble.ExecError as e:
-            logger.error("Failed initializing key repositories.")
-            logger.error("Exited with code %d. Stderr:", e.exit_code)
-            for line in e.stderr.splitlines():
+        except (pebble.ExecError, pebble.ChangeError) as e:
+            self._log_command_error("Failed initializing key repositories.", e)
+
+    def _log_command_error(self, message: str, error: Exception) -> None:
+        """Log the error of a command executed in the container.
+
+        Args:
+            message (str): Error message.
+            error (Exception): pebble.ExecError or pebble.ChangeError raised by the command.
+        """
+        logger.error(message)
+        if isinstance(error, pebble.ExecError):
+            logger.error("Exited with code %d. Stderr:", error.exit_code)
+            for line in (error.stderr or "").splitlines():
                 logger.error("    %s", line)
+        else:
+            logger.error(str(error))
 
     def _file_exists(self, path: str) -> bool:
         """Check if a file exists in the container.
@@ -351,36 +1441,325 @@ class KeystoneCharm(CharmBase):
         logger.debug(f"File {path} {exist_str}.")
         return file_exists
 
-    def _safe_restart(self) -> None:
+    @traced
+    def _safe_restart(self) -> bool:
         """Safely restart the keystone service.
 
         This function (re)starts the keystone service after doing some safety checks,
         like validating the charm configuration, checking the mysql relation is ready.
+
+        Returns:
+            bool: True if the keystone service has been (re)started.
         """
+        from config import validate_config
+
         validate_config(self.config)
         self._check_mysql_data()
         # Workaround: OS_AUTH_URL is not ready when the entrypoint restarts apache2.
         # The function `self._patch_entrypoint` fixes that.
         self._patch_entrypoint()
-        self._replan()
+        config_changed = self._configure_logging()
+        config_changed = self._configure_database() or config_changed
+        config_changed = self._configure_backpressure() or config_changed
+        # Kept until the reload, which may wait for the restart lock
+        self._stored.reload_pending = self._stored.reload_pending or config_changed
+        restarted = self._replan()
+        if restarted:
+            self._stored.reload_pending = False
+        elif self._stored.reload_pending and self._acquire_restart_lock():
+            self._reload_apache()
+        return restarted
 
+    @traced
     def _patch_entrypoint(self) -> None:
         """Patches the entrypoint of the Keystone service.
 
         The entrypoint that restarts apache2, expects immediate communication to OS_AUTH_URL.
         This does not happen instantly. This function patches the entrypoint to wait until a
         curl to OS_AUTH_URL succeeds.
+
+        The markers of the startup timeline are added to the entrypoint as well.
         """
         installer_script = self.container.pull("/app/start.sh").read()
         wait_until_ready_command = "until $(curl --output /dev/null --silent --head --fail $OS_AUTH_URL); do echo '...'; sleep 5; done"
+        wait_until_ready_command = (
+            f"{{ {marker_command('api-wait')}; {wait_until_ready_command};"
+            f" {marker_command('serving')}; }}"
+        )
         self.container.push(
             "/app/start-patched.sh",
-            installer_script.replace(
-                "source setup_env", f"source setup_env && {wait_until_ready_command}"
+            instrument_entrypoint(
+                installer_script.replace(
+                    "source setup_env", f"source setup_env && {wait_until_ready_command}"
+                )
             ),
             permissions=0o755,
         )
 
+    @traced
+    def _configure_logging(self) -> bool:
+        """Write the logging configuration of keystone and apache.
+
+        The log level is set in a drop-in of keystone.conf and in the apache configuration,
+        and the access logs are enabled or disabled in the apache sites.
+
+        Returns:
+            bool: True if the logging configuration has changed.
+        """
+        from workload_logging import (
+            APACHE_LOGGING_CONFIG,
+            KEYSTONE_LOGGING_CONFIG,
+            apache_logging_config,
+            keystone_logging_config,
+            toggle_access_log,
+        )
+
+        level = self.config["log-level"]
+        access_log = self.config["access-log"]
+        changed = False
+        for path, content in [
+            (KEYSTONE_LOGGING_CONFIG, keystone_logging_config(level)),
+            (APACHE_LOGGING_CONFIG, apache_logging_config(level)),
+        ]:
+            if self._file_changed(path, content):
+                self.container.push(path, content, make_dirs=True)
+                changed = True
+        for site in self._apache_sites():
+            site_config = self.container.pull(site.path).read()
+            new_site_config = toggle_access_log(site_config, access_log)
+            if new_site_config != site_config:
+                self.container.push(site.path, new_site_config)
+                changed = True
+        return changed
+
+    @traced
+    def _configure_backpressure(self) -> bool:
+        """Write the limits of the keystone front end.
+
+        The limits are rendered in the WSGI daemon processes of the apache sites, and the rate
+        limit of every client address in the apache configuration.
+
+        Returns:
+            bool: True if the limits have changed.
+        """
+        from backpressure import (
+            APACHE_BACKPRESSURE_CONFIG,
+            QOS_MODULE,
+            limit_daemon_processes,
+            rate_limit_config,
+        )
+
+        rate_limit = self.config["source-rate-limit"]
+        if rate_limit and not self._file_exists(QOS_MODULE):
+            logger.warning("mod_qos is not installed, the source rate limit is disabled")
+            rate_limit = 0
+        changed = False
+        content = rate_limit_config(rate_limit)
+        if self._file_changed(APACHE_BACKPRESSURE_CONFIG, content):
+            self.container.push(APACHE_BACKPRESSURE_CONFIG, content, make_dirs=True)
+            changed = True
+        for site in self._apache_sites():
+            site_config = self.container.pull(site.path).read()
+            new_site_config = limit_daemon_processes(
+                site_config,
+                self.config["max-concurrent-requests"],
+                self.config["listen-backlog"],
+                self.config["queue-timeout"],
+                self.config["request-timeout"],
+            )
+            if new_site_config != site_config:
+                self.container.push(site.path, new_site_config)
+                changed = True
+        return changed
+
+    def _apache_sites(self) -> List[pebble.FileInfo]:
+        """Get the configuration files of the enabled apache sites."""
+        from workload_logging import APACHE_SITES_FOLDER
+
+        try:
+            return self.container.list_files(APACHE_SITES_FOLDER, pattern="*.conf")
+        except (pebble.APIError, pebble.PathError):
+            return []
+
+    def _reload_apache(self) -> None:
+        """Reload the apache and keystone configuration gracefully.
+
+        The in-flight requests are completed before the workers are replaced. Apache is started
+        by the entrypoint of the keystone service, so Pebble cannot signal it: the reload is
+        run with apache2ctl, holding the restart lock like a restart of keystone.
+        """
+        try:
+            self.command_runner.run(["apache2ctl", "graceful"])
+            self._stored.reload_pending = False
+            logger.info("Apache configuration reloaded.")
+        except (pebble.ExecError, pebble.ChangeError) as e:
+            self._log_command_error("Failed reloading the apache configuration.", e)
+
+    @traced
+    def _configure_database(self) -> bool:
+        """Write the timeouts of the database connections of keystone.
+
+        A connection to a failed MySQL endpoint is closed at the read timeout, and opened
+        again, through the db router if there are several endpoints. Without timeouts, the
+        configuration file is removed, and the driver defaults apply.
+
+        Returns:
+            bool: True if the database configuration has changed.
+        """
+        parameters = []
+        if self.config["mysql-connect-timeout"]:
+            parameters.append(f"connect_timeout={self.config['mysql-connect-timeout']}")
+        if self.config["mysql-read-timeout"]:
+            parameters += [
+                f"read_timeout={self.config['mysql-read-timeout']}",
+                f"write_timeout={self.config['mysql-read-timeout']}",
+            ]
+        if not parameters:
+            if not self._file_exists(DATABASE_CONFIG):
+                return False
+            self.container.remove_path(DATABASE_CONFIG)
+            return True
+        content = f"[database]\nconnection_parameters = {'&'.join(parameters)}\n"
+        if not self._file_changed(DATABASE_CONFIG, content):
+            return False
+        self.container.push(DATABASE_CONFIG, content, make_dirs=True)
+        return True
+
+    @traced
+    def _update_log_forwarding(self) -> None:
+        """Forward the workload logs to the Loki units of the logging relation.
+
+        The log files are followed by the log forwarder service, and Pebble ships the logs of
+        the services to Loki in batches. The log forwarder is started by `_replan`, so keystone
+        is never restarted without the restart lock. Without Loki units, it is stopped.
+        """
+        from workload_logging import (
+            LOG_FORWARDER_SERVICE,
+            log_forwarding_layer,
+            log_target_name,
+        )
+
+        endpoints = self.logging.endpoints
+        if not endpoints and not self._stored.log_targets:
+            return
+        layer = log_forwarding_layer(
+            endpoints,
+            list(self._stored.log_targets),
+            {
+                "juju_model": self.model.name,
+                "juju_model_uuid": self.model.uuid,
+                "juju_application": self.app.name,
+                "juju_unit": self.unit.name,
+                "charm": self.meta.name,
+            },
+        )
+        try:
+            self.container.add_layer("logging", layer, combine=True)
+        except pebble.APIError as e:
+            logger.warning(f"Pebble cannot forward the logs: {e}")
+            return
+        self._stored.log_targets = sorted(log_target_name(unit_name) for unit_name in endpoints)
+        if not endpoints and self.container.get_service(LOG_FORWARDER_SERVICE).is_running():
+            self.container.stop(LOG_FORWARDER_SERVICE)
+
+    def _drain_command(self) -> List[str]:
+        """Command draining the connections to keystone, in the keystone container."""
+        return [
+            "python3",
+            DRAIN_PATH,
+            "--port",
+            str(PORT),
+            "--drain-file",
+            DRAIN_FILE,
+            "--grace-period",
+            str(self.config["drain-grace-period"]),
+        ]
+
+    @traced
+    def _drain(self) -> bool:
+        """Drain the connections to keystone before restarting it.
+
+        The unit fails its ready check, so it is taken out of the endpoints of the Kubernetes
+        service, and the requests in flight finish before keystone is restarted, for up to
+        `drain-grace-period` seconds.
+
+        Returns:
+            bool: True if keystone has been taken out of service.
+        """
+        grace_period = self.config["drain-grace-period"]
+        services = self.container.get_services("keystone")
+        if not grace_period or "keystone" not in services or not services["keystone"].is_running():
+            return False
+        try:
+            result = json.loads(
+                self.command_runner.run(
+                    self._drain_command(), timeout=grace_period + TERMINATION_GRACE_MARGIN
+                )
+            )
+        except (pebble.ExecError, pebble.ChangeError, ValueError) as e:
+            self._log_command_error("Failed draining the keystone connections.", e)
+            return self._file_exists(DRAIN_FILE)
+        if result["drained"]:
+            logger.info(f"Keystone connections drained in {result['seconds']} seconds")
+        else:
+            logger.warning(
+                f"{result['connections']} keystone connections left after {result['seconds']}"
+                " seconds of drain"
+            )
+        return True
+
+    def _acquire_restart_lock(self) -> bool:
+        """Take the restart lock of the cluster before restarting keystone.
+
+        The lock is only needed if keystone is serving requests, and there are other units
+        serving them while this one restarts. The leader grants the lock to `restart-batch-size`
+        units at a time, and to the next batch once the previous one is healthy.
+
+        Returns:
+            bool: True if keystone can be restarted now.
+        """
+        services = self.container.get_services("keystone")
+        if (
+            "keystone" not in services
+            or not services["keystone"].is_running()
+            or not self.cluster.has_peers
+        ):
+            return True
+        self.cluster.request_restart()
+        self._grant_restarts()
+        self._stored.restart_waiting = not self.cluster.restart_granted
+        if self._stored.restart_waiting:
+            logger.info("Keystone restart waiting for the restart lock.")
+        return not self._stored.restart_waiting
+
+    def _release_restart_lock(self) -> bool:
+        """Release the restart lock of the cluster, once keystone passes its health check.
+
+        Returns:
+            bool: False if the unit holds the lock, and keystone has not passed its health check.
+        """
+        if self._stored.restart_waiting or not self.cluster.restart_requested:
+            return True
+        if not self._keystone_healthy():
+            logger.info("Keystone has not passed its health check after the restart yet.")
+            return False
+        self.cluster.release_restart()
+        self._grant_restarts()
+        return True
+
+    def _grant_restarts(self) -> None:
+        """Grant the restart lock to the next batch of units, if this unit is the leader."""
+        if self.unit.is_leader():
+            self.cluster.grant_restarts(self.config["restart-batch-size"])
+
+    def _keystone_healthy(self) -> bool:
+        """Whether keystone passes its Pebble ready check."""
+        checks = self.container.get_checks(KEYSTONE_READY_CHECK)
+        return (
+            KEYSTONE_READY_CHECK in checks
+            and checks[KEYSTONE_READY_CHECK].status == pebble.CheckStatus.UP
+        )
+
     def _check_mysql_data(self) -> None:
         """Check if the mysql relation is ready.
 
@@ -390,17 +1769,60 @@ class KeystoneCharm(CharmBase):
         if self.mysql_client.is_missing_data_in_unit() and not self.config.get("mysql-uri"):
             raise CharmError("mysql relation is missing")
 
-    def _replan(self) -> None:
+    def _mysql_data(self) -> "MysqlConnectionData":
+        """Get the mysql connection data, from the mysql-uri option or the db relation.
+
+        Returns:
+            MysqlConnectionData: Mysql connection data.
+        """
+        from config import MysqlConnectionData
+
+        return MysqlConnectionData(
+            self.config.get("mysql-uri")
+            or f"mysql://root:{self.mysql_client.root_password}@{','.join(self.mysql_client.endpoints)}/"
+        )
+
+    def _db_address(self, mysql_data: "MysqlConnectionData") -> Tuple[str, int]:
+        """Get the address of the database in the keystone container.
+
+        If there are several MySQL endpoints, keystone connects to the db router, which fails
+        over between them.
+
+        Args:
+            mysql_data (MysqlConnectionData): Mysql connection data.
+
+        Returns:
+            Tuple[str, int]: The host and port of the database.
+        """
+        if len(mysql_data.endpoints) > 1:
+            return DB_ROUTER_HOST, DB_ROUTER_PORT
+        return mysql_data.host, mysql_data.port
+
+    @traced
+    def _replan(self) -> bool:
         """Replan keystone service.
 
         This function starts the keystone service if it is not running.
         If the service started already, this function will restart the
-        service if there are any changes to the layer.
+        service if there are any changes to the layer. Keystone is warmed up after
+        every (re)start, whatever the hook that (re)started it.
+
+        Returns:
+            bool: True if the keystone service has been (re)started.
         """
-        mysql_data = MysqlConnectionData(
-            self.config.get("mysql-uri")
-            or f"mysql://root:{self.mysql_client.root_password}@{self.mysql_client.host}:{self.mysql_client.port}/"
-        )
+        from config import get_environment
+
+        mysql_data = self._mysql_data()
+        environment = get_environment(self.service_host, self.config, mysql_data)
+        environment["DB_HOST"], environment["DB_PORT"] = self._db_address(mysql_data)
+        environment.update(self._key_repository_environment())
+        # Like the fernet keys, the JWS keypair of the followers comes from the leader: keystone
+        # keeps the fernet token provider until it has arrived
+        self._stored.jws_keys_pending = self._jws_enabled and not self._jws_keys_ready
+        if self._jws_enabled and not self._stored.jws_keys_pending:
+            environment["OS_TOKEN__PROVIDER"] = "jws"
+        elif self._jws_enabled:
+            logger.info("Waiting for the JWS keys to enable the JWS token provider.")
         layer = {
             "summary": "keystone layer",
             "description": "pebble config layer for keystone",
@@ -410,12 +1832,83 @@ class KeystoneCharm(CharmBase):
                     "summary": "keystone service",
                     "command": "/app/start-patched.sh",
                     "startup": "enabled",
-                    "environment": get_environment(self.app.name, self.config, mysql_data),
-                }
+                    "environment": environment,
+                    "after": [DB_ROUTER_SERVICE],
+                },
+                "metrics-exporter": {
+                    "override": "replace",
+                    "summary": "keystone metrics exporter",
+                    "command": f"python3 {EXPORTER_PATH} --port {METRICS_PORT}"
+                    f" --state-file {EXPORTER_STATE_FILE}",
+                    "startup": "enabled",
+                },
+                DB_ROUTER_SERVICE: {
+                    "override": "replace",
+                    "summary": "keystone database router",
+                    "command": f"python3 {DB_ROUTER_PATH} --port {DB_ROUTER_PORT}"
+                    " --connect-timeout"
+                    f" {self.config['mysql-connect-timeout'] or DB_ROUTER_CONNECT_TIMEOUT} "
+                    + " ".join(f"--endpoint {host}:{port}" for host, port in mysql_data.endpoints),
+                    "startup": "enabled" if len(mysql_data.endpoints) > 1 else "disabled",
+                },
             },
         }
+        layer["checks"] = {
+            KEYSTONE_READY_CHECK: {
+                "override": "replace",
+                "level": "ready",
+                "period": "5s",
+                "threshold": 1,
+                "exec": {
+                    "command": f"sh -c 'test ! -e {DRAIN_FILE}"
+                    f" && curl --output /dev/null --silent --head --fail http://localhost:{PORT}/v3'"
+                },
+            }
+        }
+        self.container.push(EXPORTER_PATH, EXPORTER_SCRIPT.read_text(), make_dirs=True)
+        self.container.push(DRAIN_PATH, DRAIN_SCRIPT.read_text(), make_dirs=True)
+        if len(mysql_data.endpoints) > 1:
+            self.container.push(DB_ROUTER_PATH, DB_ROUTER_SCRIPT.read_text(), make_dirs=True)
+        previous_services = self.container.get_plan().services
+        previous_service = previous_services.get("keystone")
         self.container.add_layer("keystone", layer, combine=True)
-        self.container.replan()
+        keystone_service = self.container.get_plan().services["keystone"]
+        restart = (
+            previous_service is None or previous_service.to_dict() != keystone_service.to_dict()
+        )
+        if not restart and self._stored.restart_waiting and not self._stored.reload_pending:
+            # The change that needed the restart has been reverted
+            self._stored.restart_waiting = False
+            self.cluster.release_restart()
+            self._grant_restarts()
+        if restart and not self._acquire_restart_lock():
+            # The previous services are restored, so no replan restarts keystone before the lock
+            # is granted
+            previous_layer = {
+                "services": {
+                    name: previous_services[name].to_dict()
+                    for name in layer["services"]
+                    if name in previous_services
+                }
+            }
+            self.container.add_layer("keystone", previous_layer, combine=True)
+            return False
+        drained = restart and self._drain()
+        if restart:
+            self._stored.warm_up_pending = True
+            self.startup.restarting()
+        try:
+            self.container.replan()
+        finally:
+            # Otherwise the ready check would fail forever
+            if drained:
+                self.container.remove_path(DRAIN_FILE)
+        if (
+            len(mysql_data.endpoints) == 1
+            and self.container.get_service(DB_ROUTER_SERVICE).is_running()
+        ):
+            self.container.stop(DB_ROUTER_SERVICE)
+        return restart
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -40,21 +40,51 @@ class SomeApplication(CharmBase):
 """
 
 
+import hashlib
 import json
 import logging
-from typing import Any, Dict, List
+import time
+from typing import Any, Dict, List, Mapping, Optional, Sequence
 
 from ops.charm import CharmEvents
-from ops.framework import EventBase, EventSource, Object
+from ops.framework import EventBase, EventSource, Object, StoredState
+from ops.jujuversion import JujuVersion
 from ops.model import Relation
 
 # Number of keys need might need to be adjusted in the future
 NUMBER_FERNET_KEYS = 2
 NUMBER_CREDENTIAL_KEYS = 2
+# Unit data key of the restart requests, and application data key of the restarts granted
+RESTART_REQUESTED = "restart_requested"
+RESTART_GRANTED = "restart_granted"
+# Unit data key of the JWS keypair acknowledgements, and application data key of the rollout
+JWS_KEY_HASH = "jws_key_hash"
+JWS_ROLLED_OUT = "jws_rolled_out"
+# Label of the Juju secret of the private keys, and application data key of its ID
+PRIVATE_KEYS_SECRET_LABEL = "private-keys"
+PRIVATE_KEYS_SECRET = "private_keys_secret"
+RESTART_GRANTED_AT = "restart_granted_at"
+# Time, in seconds, after which the leader reclaims the restart lock from a batch of units
+RESTART_LOCK_TIMEOUT = 900
 
 logger = logging.getLogger(__name__)
 
 
+def primary_key_hash(repository_keys: Dict[str, str]) -> Optional[str]:
+    """Hash of the primary key of a key repository, as keystone computes it for the credentials.
+
+    Args:
+        repository_keys (Dict[str, str]): Keys of the repository, by index.
+
+    Returns:
+        Optional[str]: sha1 hex digest of the key with the highest index, if any.
+    """
+    indexes = [index for index in repository_keys if index.isdigit()]
+    if not indexes:
+        return None
+    return hashlib.sha1(repository_keys[max(indexes, key=int)].encode()).hexdigest()
+
+
 class ClusterKeysChangedEvent(EventBase):
     """Event to announce a change in the Guacd service."""
 
@@ -66,49 +96,387 @@ class ClusterEvents(CharmEvents):
 
 
 class Cluster(Object):
-    """Peer relation."""
+    """Peer relation.
+
+    The units are notified of new keys with the cluster_keys_changed event: the leader when
+    it saves them, and the rest of the units when the key generation in the relation data
+    changes. Other changes in the relation data do not fire the event, to avoid hook storms.
+
+    The restarts of the workload are coordinated with a restart lock: the units request it in
+    their unit data, the leader grants it to a batch of units at a time in the application data,
+    and the units release it once they have been restarted and are healthy.
+
+    The private keys given to `save_keys` are kept in a Juju secret of the application, instead
+    of the relation data, if the Juju version supports secrets.
+    """
+
+    _stored = StoredState()
 
     def __init__(self, charm):
         super().__init__(charm, "cluster")
         self.charm = charm
+        self._stored.set_default(key_generation=0)
+        self.framework.observe(charm.on["cluster"].relation_changed, self._on_relation_changed)
+
+    def _on_relation_changed(self, _) -> None:
+        """Fire the cluster_keys_changed event if the key generation has changed."""
+        if self.model.unit.is_leader():
+            return
+        key_generation = self.key_generation
+        if key_generation != self._stored.key_generation:
+            self._stored.key_generation = key_generation
+            self.charm.on.cluster_keys_changed.emit()
+
+    @property
+    def _app_data(self) -> Mapping[str, str]:
+        """Application data of the peer relation, empty if the relation is not created yet."""
+        relation: Optional[Relation] = self.model.get_relation("cluster")
+        return relation.data[self.model.app] if relation is not None else {}
 
     @property
     def fernet_keys(self) -> List[str]:
         """Fernet keys."""
-        relation: Relation = self.model.get_relation("cluster")
-        application_data = relation.data[self.model.app]
-        return json.loads(application_data.get("keys-fernet", "[]"))
+        return json.loads(self._app_data.get("keys-fernet", "[]"))
 
     @property
     def credential_keys(self) -> List[str]:
         """Credential keys."""
-        relation: Relation = self.model.get_relation("cluster")
-        application_data = relation.data[self.model.app]
-        return json.loads(application_data.get("keys-credential", "[]"))
+        return json.loads(self._app_data.get("keys-credential", "[]"))
+
+    @property
+    def key_generation(self) -> int:
+        """Generation of the key repositories, increased every time the keys change."""
+        return int(self._app_data.get("key_generation", "0"))
+
+    @property
+    def invalidation_counter(self) -> int:
+        """Counter increased every time the tokens cached by consumers must be invalidated."""
+        return int(self._app_data.get("invalidation_counter", "0"))
+
+    @property
+    def trace_context(self) -> Dict[str, str]:
+        """Trace context of the leader when the keys were last saved, if traced."""
+        return json.loads(self._app_data.get("trace_context", "{}"))
 
-    def save_keys(self, keys: Dict[str, Any]) -> None:
+    @property
+    def last_rotation(self) -> Optional[float]:
+        """Time of the last rotation of the fernet keys (seconds since the epoch), if known."""
+        last_rotation = self._app_data.get("last_rotation")
+        return float(last_rotation) if last_rotation else None
+
+    def save_keys(
+        self,
+        keys: Dict[str, Any],
+        trace_context: Optional[Dict[str, str]] = None,
+        last_rotation: Optional[float] = None,
+        private_repositories: Sequence[str] = (),
+    ) -> None:
         """Generate fernet and credential keys.
 
         This method will generate new keys and fire the cluster_keys_changed event.
+        The key generation and the invalidation counter are increased when the keys change.
+        The trace context, if any, is saved with the keys, so the units can correlate the
+        application of the keys with the leader. The time of the last rotation, if given, is
+        saved as well, so the rotation timing does not depend on the unit that is the leader.
+
+        Args:
+            keys (Dict[str, Any]): Keys, by key repository.
+            trace_context (Optional[Dict[str, str]]): Trace context of the leader.
+            last_rotation (Optional[float]): Time of the last rotation of the fernet keys.
+            private_repositories (Sequence[str]): Key repositories kept in a Juju secret, if
+                the Juju version supports secrets.
         """
         logger.debug("Saving keys...")
         relation: Relation = self.model.get_relation("cluster")
         data = relation.data[self.model.app]
-        current_keys_str = data.get("key_repository", "{}")
-        current_keys = json.loads(current_keys_str)
+        current_keys = self.get_keys()
+        # Saved before firing the event, so its observers see the time of this rotation
+        if last_rotation is not None:
+            data["last_rotation"] = str(last_rotation)
         if current_keys != keys:
-            data["key_repository"] = json.dumps(keys)
+            private_keys = {}
+            if JujuVersion.from_environ().has_secrets:
+                private_keys = {
+                    repository: keys[repository]
+                    for repository in private_repositories
+                    if repository in keys
+                }
+            self._save_private_keys(private_keys)
+            data["key_repository"] = json.dumps(
+                {repository: keys[repository] for repository in keys.keys() - private_keys.keys()}
+            )
+            data["key_generation"] = str(self.key_generation + 1)
+            if trace_context:
+                data["trace_context"] = json.dumps(trace_context)
+            elif "trace_context" in data:
+                del data["trace_context"]
+            self._bump_invalidation_counter()
             self.charm.on.cluster_keys_changed.emit()
         logger.info("Keys saved!")
 
+    def track_config(self, fingerprint: str) -> None:
+        """Track the fingerprint of the configuration that affects issued tokens.
+
+        The invalidation counter is increased when the fingerprint differs from the
+        one previously tracked.
+
+        Args:
+            fingerprint (str): Fingerprint of the revocation-sensitive configuration.
+        """
+        relation: Relation = self.model.get_relation("cluster")
+        data = relation.data[self.model.app]
+        if data.get("config_fingerprint") != fingerprint:
+            if "config_fingerprint" in data:
+                self._bump_invalidation_counter()
+            data["config_fingerprint"] = fingerprint
+
+    @property
+    def last_maintenance(self) -> float:
+        """Time of the last maintenance of the keystone database (seconds since the epoch)."""
+        return float(self._app_data.get("last_maintenance", "0"))
+
+    def save_maintenance_results(self, results: Dict[str, float]) -> None:
+        """Save the results of a maintenance of the keystone database.
+
+        The time of the maintenance is only saved if it completed, so an incomplete maintenance
+        continues in the next run.
+
+        Args:
+            results (Dict[str, float]): Rows removed from each table, and the time taken.
+        """
+        relation: Relation = self.model.get_relation("cluster")
+        data = relation.data[self.model.app]
+        if results.get("complete", 1):
+            data["last_maintenance"] = str(time.time())
+        data["maintenance_results"] = json.dumps(results)
+
+    @property
+    def credential_migration(self) -> Dict[str, Any]:
+        """State of the last rotation of the credential keys, and migration of the credentials."""
+        return json.loads(self._app_data.get("credential_migration", "{}"))
+
+    def save_credential_migration(self, migration: Dict[str, Any]) -> None:
+        """Save the state of the rotation of the credential keys.
+
+        Args:
+            migration (Dict[str, Any]): State of the rotation, and migration of the credentials.
+        """
+        relation: Relation = self.model.get_relation("cluster")
+        data = relation.data[self.model.app]
+        data["credential_migration"] = json.dumps(migration, sort_keys=True)
+
+    def ack_credential_keys(self, key_hash: Optional[str]) -> None:
+        """Acknowledge the primary credential key written by this unit, in its unit data.
+
+        The unit data is only written when the key changes, so the acknowledgements only fire
+        relation-changed hooks in the rest of the units when the credential keys are rotated.
+
+        Args:
+            key_hash (Optional[str]): Hash of the primary credential key of the unit.
+        """
+        relation: Relation = self.model.get_relation("cluster")
+        data = relation.data[self.model.unit]
+        if key_hash and data.get("credential_key_hash") != key_hash:
+            data["credential_key_hash"] = key_hash
+
+    def units_missing_credential_keys(self, key_hash: Optional[str]) -> List[str]:
+        """Get the rest of the units that have not acknowledged a primary credential key.
+
+        Args:
+            key_hash (Optional[str]): Hash of the primary credential key.
+
+        Returns:
+            List[str]: Names of the units.
+        """
+        relation: Optional[Relation] = self.model.get_relation("cluster")
+        if relation is None:
+            return []
+        return sorted(
+            unit.name
+            for unit in relation.units
+            if relation.data[unit].get("credential_key_hash") != key_hash
+        )
+
+    @property
+    def has_peers(self) -> bool:
+        """Whether there are other units in the peer relation."""
+        relation: Optional[Relation] = self.model.get_relation("cluster")
+        return relation is not None and bool(relation.units)
+
+    @property
+    def restart_requested(self) -> bool:
+        """Whether this unit has requested the restart lock, and not released it yet."""
+        relation: Optional[Relation] = self.model.get_relation("cluster")
+        return relation is not None and RESTART_REQUESTED in relation.data[self.model.unit]
+
+    @property
+    def restart_granted(self) -> bool:
+        """Whether this unit has been granted the restart lock."""
+        relation: Optional[Relation] = self.model.get_relation("cluster")
+        if relation is None:
+            return False
+        granted = json.loads(relation.data[self.model.app].get(RESTART_GRANTED, "[]"))
+        return self.restart_requested and self.model.unit.name in granted
+
+    def request_restart(self) -> None:
+        """Request the restart lock, in the unit data.
+
+        The time of the request is written in the unit data, so the leader grants the lock to
+        the units in the order they requested it.
+        """
+        relation: Relation = self.model.get_relation("cluster")
+        data = relation.data[self.model.unit]
+        if RESTART_REQUESTED not in data:
+            data[RESTART_REQUESTED] = str(time.time())
+
+    def release_restart(self) -> None:
+        """Release the restart lock, once the unit has been restarted and is healthy."""
+        relation: Relation = self.model.get_relation("cluster")
+        data = relation.data[self.model.unit]
+        if RESTART_REQUESTED in data:
+            del data[RESTART_REQUESTED]
+
+    def grant_restarts(self, batch_size: int, timeout: float = RESTART_LOCK_TIMEOUT) -> List[str]:
+        """Grant the restart lock to the next batch of units.
+
+        The lock is granted to a new batch once every unit of the previous batch has released
+        it, or has left the relation. With a batch size of 1, N-1 units serve requests during
+        the restarts; larger batches lower the capacity accordingly. The batch never takes all
+        the units of the application, so at least one unit serves requests while the rest
+        restart.
+
+        A batch that holds the lock longer than the timeout (e.g. a unit that never becomes
+        healthy) loses it, so the restarts of the rest of the units do not stall. Its units
+        are granted the lock again after the other units that requested it.
+
+        Args:
+            batch_size (int): Maximum number of units restarting at the same time.
+            timeout (float): Time, in seconds, after which the lock is reclaimed from a batch.
+
+        Returns:
+            List[str]: Names of the units holding the lock.
+        """
+        relation: Optional[Relation] = self.model.get_relation("cluster")
+        if relation is None:
+            return []
+        data = relation.data[self.model.app]
+        requests = {
+            unit.name: float(relation.data[unit][RESTART_REQUESTED])
+            for unit in relation.units | {self.model.unit}
+            if RESTART_REQUESTED in relation.data[unit]
+        }
+        previous_granted = json.loads(data.get(RESTART_GRANTED, "[]"))
+        granted = [name for name in previous_granted if name in requests]
+        expired = bool(granted) and time.time() - float(data.get(RESTART_GRANTED_AT, 0)) > timeout
+        if expired:
+            logger.warning(f"Restart lock reclaimed from {', '.join(granted)}")
+            # The expired units go last, behind every unit that requested the lock
+            requests.update({name: float("inf") for name in granted})
+        if not granted or expired:
+            # The leader is not one of the units of the relation: they are the rest of the units
+            batch_size = max(1, min(batch_size, len(relation.units)))
+            granted = sorted(requests, key=lambda name: (requests[name], name))[:batch_size]
+        if granted != previous_granted or expired:
+            logger.info(f"Restart lock granted to {', '.join(granted) or 'no unit'}")
+            data[RESTART_GRANTED] = json.dumps(granted)
+            data[RESTART_GRANTED_AT] = str(time.time())
+        return granted
+
+    def _bump_invalidation_counter(self) -> None:
+        """Increase the counter that tells the consumers to drop their cached tokens."""
+        relation: Relation = self.model.get_relation("cluster")
+        data = relation.data[self.model.app]
+        data["invalidation_counter"] = str(self.invalidation_counter + 1)
+
     def get_keys(self) -> Dict[str, Any]:
         """Get keys from the relation.
 
         Returns:
             Dict[str, Any]: Dictionary with the keys.
         """
-        relation: Relation = self.model.get_relation("cluster")
-        data = relation.data[self.model.app]
+        data = self._app_data
         current_keys_str = data.get("key_repository", "{}")
         current_keys = json.loads(current_keys_str)
+        if PRIVATE_KEYS_SECRET in data:
+            secret = self.model.get_secret(id=data[PRIVATE_KEYS_SECRET])
+            current_keys.update(json.loads(secret.get_content()["keys"]))
         return current_keys
+
+    def _save_private_keys(self, private_keys: Dict[str, Any]) -> None:
+        """Save the private keys in the Juju secret of the application.
+
+        The secret is created with the first private keys, and removed if there are none.
+
+        Args:
+            private_keys (Dict[str, Any]): Private keys, by key repository.
+        """
+        relation: Relation = self.model.get_relation("cluster")
+        data = relation.data[self.model.app]
+        content = {"keys": json.dumps(private_keys, sort_keys=True)}
+        if PRIVATE_KEYS_SECRET in data:
+            secret = self.model.get_secret(id=data[PRIVATE_KEYS_SECRET])
+            if not private_keys:
+                secret.remove_all_revisions()
+                del data[PRIVATE_KEYS_SECRET]
+            elif secret.get_content() != content:
+                secret.set_content(content)
+        elif private_keys:
+            secret = self.model.app.add_secret(content, label=PRIVATE_KEYS_SECRET_LABEL)
+            data[PRIVATE_KEYS_SECRET] = secret.id
+
+    def ack_jws_keys(self, key_hash: Optional[str]) -> None:
+        """Acknowledge the JWS keypair written by this unit, in its unit data.
+
+        Args:
+            key_hash (Optional[str]): Hash of the last JWS public key of the unit.
+        """
+        relation: Optional[Relation] = self.model.get_relation("cluster")
+        if relation is None:
+            return
+        data = relation.data[self.model.unit]
+        if key_hash and data.get(JWS_KEY_HASH) != key_hash:
+            data[JWS_KEY_HASH] = key_hash
+
+    @property
+    def jws_keys_acknowledged(self) -> bool:
+        """Whether this unit has acknowledged a JWS keypair, so it can sign JWS tokens."""
+        relation: Optional[Relation] = self.model.get_relation("cluster")
+        return relation is not None and JWS_KEY_HASH in relation.data[self.model.unit]
+
+    def units_missing_jws_keys(self, key_hash: Optional[str]) -> List[str]:
+        """Get the rest of the units that have not acknowledged a JWS keypair.
+
+        Args:
+            key_hash (Optional[str]): Hash of the last JWS public key.
+
+        Returns:
+            List[str]: Names of the units.
+        """
+        relation: Optional[Relation] = self.model.get_relation("cluster")
+        if relation is None:
+            return []
+        return sorted(
+            unit.name
+            for unit in relation.units
+            if relation.data[unit].get(JWS_KEY_HASH) != key_hash
+        )
+
+    @property
+    def jws_rolled_out(self) -> bool:
+        """Whether every unit has had the JWS keypair, so the JWS token provider can be used."""
+        relation: Optional[Relation] = self.model.get_relation("cluster")
+        return relation is not None and relation.data[self.model.app].get(JWS_ROLLED_OUT) == "true"
+
+    def set_jws_rolled_out(self, rolled_out: bool) -> None:
+        """Record whether every unit has had the JWS keypair, in the application data.
+
+        Args:
+            rolled_out (bool): True once every unit has acknowledged the JWS keypair.
+        """
+        relation: Relation = self.model.get_relation("cluster")
+        data = relation.data[self.model.app]
+        if rolled_out and data.get(JWS_ROLLED_OUT) != "true":
+            logger.info("JWS keypair acknowledged by every unit")
+            data[JWS_ROLLED_OUT] = "true"
+        elif not rolled_out and JWS_ROLLED_OUT in data:
+            del data[JWS_ROLLED_OUT]
@@ -0,0 +1,209 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Command runner module.
+
+This module runs commands in a workload container through Pebble. The output of the commands
+is streamed into the log as it arrives, and every command is bounded by a timeout.
+
+```python
+# ...
+from command_runner import CommandRunner
+
+class SomeCharm(CharmBase):
+  def __init__(self, *args):
+    # ...
+    self.command_runner = CommandRunner(self.unit.get_container("some-container"))
+
+  def _setup(self):
+    # Independent commands are batched in a single exec
+    self.command_runner.run_batch([["some-command", "setup"], ["other-command", "setup"]])
+
+  def _on_long_action(self, event):
+    # Long commands run as a one-shot Pebble service, checked in a later hook
+    self.command_runner.start_background("long-command", ["some-command", "long"])
+
+  def _on_update_status(self, _):
+    exit_code = self.command_runner.background_exit_code("long-command")
+    # ...
+```
+"""
+
+import logging
+import shlex
+import threading
+from typing import Dict, List, Optional
+
+from ops import pebble
+from ops.model import Container
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 300
+BACKGROUND_STATUS_FOLDER = "/tmp/background-commands/"
+
+
+class CommandRunner:
+    """Runner of commands in a workload container."""
+
+    def __init__(self, container: Container, default_timeout: float = DEFAULT_TIMEOUT):
+        """Constructor for CommandRunner.
+
+        Args:
+            container: workload container in which the commands run.
+            default_timeout: timeout, in seconds, of the commands that do not set one.
+        """
+        self.container = container
+        self.default_timeout = default_timeout
+
+    def run(
+        self,
+        command: List[str],
+        timeout: Optional[float] = None,
+        environment: Optional[Dict[str, str]] = None,
+        working_dir: Optional[str] = None,
+    ) -> str:
+        """Run a command, streaming its output into the log.
+
+        The stdout is logged at debug level, as it can be long or hold data like tokens, and the
+        stderr at info level.
+
+        Args:
+            command: command to run.
+            timeout: timeout in seconds. If none given, the default timeout is used.
+            environment: environment variables of the command.
+            working_dir: working directory of the command.
+
+        Returns:
+            str: The stdout of the command.
+
+        Raises:
+            pebble.ExecError: if the command exits with a non-zero exit code.
+            pebble.ChangeError: if the command could not run, or it timed out.
+        """
+        logger.debug(f"Executing command: {shlex.join(command)}")
+        process = self.container.exec(
+            command,
+            timeout=timeout or self.default_timeout,
+            environment=environment,
+            working_dir=working_dir,
+        )
+        stderr_lines: List[str] = []
+        stderr_thread = threading.Thread(
+            target=self._stream,
+            args=(command[0], "stderr", process.stderr, stderr_lines, logging.INFO),
+        )
+        stderr_thread.start()
+        stdout_lines: List[str] = []
+        self._stream(command[0], "stdout", process.stdout, stdout_lines, logging.DEBUG)
+        stderr_thread.join()
+        stdout, stderr = "".join(stdout_lines), "".join(stderr_lines)
+        try:
+            process.wait()
+        except pebble.ExecError as e:
+            # The output has been consumed while streaming it
+            e.stdout = stdout if e.stdout is None else e.stdout
+            e.stderr = stderr if e.stderr is None else e.stderr
+            raise
+        return stdout
+
+    def run_batch(
+        self,
+        commands: List[List[str]],
+        timeout: Optional[float] = None,
+        environment: Optional[Dict[str, str]] = None,
+    ) -> str:
+        """Run independent commands in a single exec.
+
+        The commands run sequentially, and the batch stops at the first failing command.
+
+        Args:
+            commands: commands to run.
+            timeout: timeout in seconds of the whole batch.
+            environment: environment variables of the commands.
+
+        Returns:
+            str: The stdout of the commands.
+        """
+        script = " && ".join(shlex.join(command) for command in commands)
+        return self.run(["sh", "-c", script], timeout=timeout, environment=environment)
+
+    def start_background(
+        self, name: str, command: List[str], environment: Optional[Dict[str, str]] = None
+    ) -> None:
+        """Run a long command in the background, as a one-shot Pebble service.
+
+        The exit code of the command is written in a status file, so the completion
+        can be checked in a later hook with `background_exit_code`. The file is written
+        atomically, so it is never read half-written.
+
+        Pebble reports an error when a one-shot service exits within its first second. The
+        error is ignored if the command has already written its exit code.
+
+        Args:
+            name: name of the Pebble service.
+            command: command to run.
+            environment: environment variables of the command.
+
+        Raises:
+            pebble.ChangeError: if the command could not be started.
+        """
+        status_file = self._status_file(name)
+        script = (
+            f"{shlex.join(command)}; echo $? > {status_file}.tmp"
+            f" && mv {status_file}.tmp {status_file}"
+        )
+        layer = {
+            "summary": f"{name} layer",
+            "description": f"one-shot pebble service for {name}",
+            "services": {
+                name: {
+                    "override": "replace",
+                    "summary": f"{name} one-shot command",
+                    "command": f"sh -c {shlex.quote(script)}",
+                    "startup": "disabled",
+                    "on-success": "ignore",
+                    "on-failure": "ignore",
+                    "environment": environment or {},
+                }
+            },
+        }
+        self.container.make_dir(BACKGROUND_STATUS_FOLDER, make_parents=True)
+        if self.container.exists(status_file):
+            self.container.remove_path(status_file)
+        self.container.add_layer(name, layer, combine=True)
+        try:
+            self.container.restart(name)
+        except pebble.ChangeError:
+            if self.background_exit_code(name) is None:
+                raise
+            logger.debug(f"Background command {name} exited immediately")
+        logger.info(f"Started background command {name}: {shlex.join(command)}")
+
+    def background_exit_code(self, name: str) -> Optional[int]:
+        """Get the exit code of a background command.
+
+        Args:
+            name: name of the Pebble service of the command.
+
+        Returns:
+            Optional[int]: The exit code, or None if the command has not finished.
+        """
+        status_file = self._status_file(name)
+        if not self.container.exists(status_file):
+            return None
+        try:
+            return int(self.container.pull(status_file).read().strip())
+        except ValueError:
+            logger.warning(f"Invalid status file of the background command {name}")
+            return None
+
+    def _status_file(self, name: str) -> str:
+        """Path of the file where the exit code of a background command is written."""
+        return f"{BACKGROUND_STATUS_FOLDER}{name}"
+
+    def _stream(self, name: str, stream_name: str, stream, lines: List[str], level: int) -> None:
+        """Log the lines of an output stream as they arrive, at the given level."""
+        for line in stream:
+            lines.append(line)
+            logger.log(level, "[%s %s] %s", name, stream_name, line.rstrip("\n"))
@@ -5,19 +5,24 @@
 """Module that takes take of the charm configuration."""
 
 import re
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Literal, Optional, Tuple
 
 from config_validator import ConfigValidator, ValidationError
 from ops.model import ConfigData
 
 
 class MysqlConnectionData:
-    """Mysql Connection Data class."""
+    """Mysql Connection Data class.
+
+    The URI may have a comma-separated list of endpoints, e.g.
+    mysql://<user>:<password>@<host1>:<port1>,<host2>:<port2>/<database>.
+    The host and port are the ones of the first endpoint.
+    """
 
     _compiled_regex = re.compile(
         r"^mysql\:\/\/{}@{}\/{}?$".format(
             r"(?P<username>[_\w]+):(?P<password>[\w\W]+)",
-            r"(?P<host>[\-\.\w]+):(?P<port>\d+)",
+            r"(?P<endpoints>[\-\.\w]+:\d+(,[\-\.\w]+:\d+)*)",
             r"(?P<database>[_\w]+)",
         )
     )
@@ -27,8 +32,11 @@ class MysqlConnectionData:
         if not match:
             raise ValidationError("mysql_uri is not properly formed")
         mysql_data = match.groupdict()
-        self.host = mysql_data.get("host")
-        self.port = int(mysql_data.get("port"))
+        self.endpoints: List[Tuple[str, int]] = []
+        for endpoint in mysql_data.get("endpoints").split(","):
+            host, port = endpoint.rsplit(":", 1)
+            self.endpoints.append((host, int(port)))
+        self.host, self.port = self.endpoints[0]
         self.username = mysql_data.get("username")
         self.password = mysql_data.get("password")
         self.database = mysql_data.get("database")
@@ -55,8 +63,9 @@ def get_environment(
     """Get environment variables.
 
     Args:
-        service_name (str): Cluster IP service name.
+        service_name (str): Cluster IP service name, or its fully qualified domain name.
         config (ConfigData): Charm configuration.
+        mysql_data (MysqlConnectionData): Mysql connection data.
 
     Returns:
         Dict[str, Any]: Dictionary with the environment variables for Keystone service.
@@ -133,7 +142,39 @@ class ConfigModel(ConfigValidator):
     user_domain_name: str
     project_domain_name: str
     token_expiration: int
+    fernet_max_active_keys: int
+    token_provider: Literal["fernet", "jws"]
+    command_timeout: int
+    warm_up_requests: int
+    maintenance_interval: int
+    credential_rotation_interval: int
+    prune_application_credentials: bool
+    publish_fqdn: bool
+    cluster_domain: str
+    service_internal_traffic_policy: Literal["Cluster", "Local"]
+    service_topology_aware_hints: bool
+    service_session_affinity: Literal["None", "ClientIP"]
+    service_session_affinity_timeout: int
+    cpu_request: Optional[str]
+    cpu_limit: Optional[str]
+    memory_request: Optional[str]
+    memory_limit: Optional[str]
+    pod_spread: Literal["none", "soft", "hard"]
+    pod_spread_topology_key: str
+    drain_grace_period: int
+    restart_batch_size: int
+    memory_backed_key_repositories: bool
+    tracing_endpoint: Optional[str]
+    log_level: Literal["debug", "info", "warning", "error"]
+    access_log: bool
+    max_concurrent_requests: int
+    listen_backlog: int
+    queue_timeout: int
+    request_timeout: int
+    source_rate_limit: int
     mysql_uri: Optional[str]
+    mysql_connect_timeout: int
+    mysql_read_timeout: int
 
 
 class ConfigLdapModel(ConfigValidator):
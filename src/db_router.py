@@ -0,0 +1,148 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Keystone database router.
+
+This script runs as a Pebble service in the keystone container when there are several MySQL
+endpoints, and keystone connects to the database through it. It only depends on the python
+standard library, so it runs with the python interpreter of the keystone image.
+
+Every connection is forwarded to the current endpoint, so keystone does not write to several
+nodes of the cluster at once. If the current endpoint does not accept a connection within the
+connect timeout, the router fails over to the next endpoint, and keeps using it. The connections
+to a failed endpoint are closed by keystone at its read timeout, and opened again through the
+router.
+
+Every connection is served by two threads copying its data, one per direction. The router adds
+latency to every query, and all the database traffic of the unit goes through this process, so
+its throughput is capped to what one CPU can copy with the GIL. A mysql-router sidecar is the
+better fit for heavy loads.
+"""
+
+import argparse
+import logging
+import socket
+import socketserver
+import sys
+import threading
+from typing import List, Optional, Tuple
+
+BUFFER_SIZE = 65536
+
+logger = logging.getLogger("db-router")
+
+
+def parse_endpoint(endpoint: str) -> Tuple[str, int]:
+    """Parse a `host:port` endpoint."""
+    host, _, port = endpoint.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"invalid endpoint: {endpoint}")
+    return host, int(port)
+
+
+class Router:
+    """Picker of the endpoint of every connection, failing over to the next one."""
+
+    def __init__(self, endpoints: List[Tuple[str, int]], connect_timeout: float):
+        """Constructor for Router.
+
+        Args:
+            endpoints: endpoints, in order of preference.
+            connect_timeout: time to wait for an endpoint to accept a connection, in seconds.
+        """
+        self.endpoints = endpoints
+        self.connect_timeout = connect_timeout
+        self.current = 0
+        self._lock = threading.Lock()
+
+    def connect(self) -> Optional[socket.socket]:
+        """Connect to the current endpoint, or to the next ones if it fails.
+
+        Returns:
+            Optional[socket.socket]: The connection, or None if no endpoint accepted it.
+        """
+        with self._lock:
+            start = self.current
+        for offset in range(len(self.endpoints)):
+            index = (start + offset) % len(self.endpoints)
+            host, port = self.endpoints[index]
+            try:
+                upstream = socket.create_connection((host, port), timeout=self.connect_timeout)
+            except OSError as e:
+                logger.warning(f"endpoint {host}:{port} failed: {e}")
+                continue
+            upstream.settimeout(None)
+            upstream.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            with self._lock:
+                if self.current != index:
+                    logger.warning(f"failing over to endpoint {host}:{port}")
+                    self.current = index
+            return upstream
+        logger.error("no endpoint accepted the connection")
+        return None
+
+
+def _pipe(source: socket.socket, destination: socket.socket) -> None:
+    """Copy the data from a socket to another, until one of them is closed."""
+    try:
+        while True:
+            data = source.recv(BUFFER_SIZE)
+            if not data:
+                break
+            destination.sendall(data)
+    except OSError:
+        pass
+    finally:
+        for sock in (source, destination):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class RouterServer(socketserver.ThreadingTCPServer):
+    """Server forwarding every connection to an endpoint of the router."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], router: Router):
+        """Constructor for RouterServer."""
+        self.router = router
+        super().__init__(address, RouterHandler)
+
+
+class RouterHandler(socketserver.BaseRequestHandler):
+    """Handler of a connection to the router."""
+
+    server: RouterServer
+
+    def handle(self) -> None:
+        """Forward the connection to an endpoint, in both directions."""
+        upstream = self.server.router.connect()
+        if upstream is None:
+            return
+        with upstream:
+            downstream = threading.Thread(target=_pipe, args=(upstream, self.request), daemon=True)
+            downstream.start()
+            _pipe(self.request, upstream)
+            downstream.join()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Serve the router."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bind", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3307)
+    parser.add_argument("--endpoint", action="append", required=True, type=parse_endpoint)
+    parser.add_argument("--connect-timeout", type=float, default=5)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    server = RouterServer((args.bind, args.port), Router(args.endpoint, args.connect_timeout))
+    server.serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
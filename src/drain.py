@@ -0,0 +1,126 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Keystone connection drain.
+
+This script runs in the keystone container before keystone is stopped: it is run by the charm
+before restarting keystone, and by the preStop hook of the container before Kubernetes stops
+the pod. It only depends on the python standard library, so it runs with the python
+interpreter of the keystone image.
+
+It creates the drain file, which fails the ready check of keystone, so the unit is taken out of
+the endpoints of the Kubernetes service and does not get new requests. Then it waits until the
+requests in flight finish: until no client is connected to keystone, or the grace period ends.
+The connections from the container itself (e.g. the probes) are not counted.
+
+The result is printed as JSON: whether the connections were drained, the time it took and the
+connections left.
+"""
+
+import argparse
+import json
+import sys
+import time
+from typing import List, Optional
+
+PROC_NET_TCP = ["/proc/net/tcp", "/proc/net/tcp6"]
+TCP_ESTABLISHED = "01"
+# Loopback addresses, as written in /proc/net/tcp and /proc/net/tcp6
+IPV4_LOOPBACK_SUFFIX = "7F"
+IPV6_LOOPBACK = "00000000000000000000000001000000"
+IPV4_MAPPED_PREFIX = "0000000000000000FFFF0000"
+
+
+def _is_loopback(address: str) -> bool:
+    """Whether a hexadecimal address of /proc/net/tcp(6) is a loopback address."""
+    if len(address) == 8:
+        # Host byte order (little endian): the first octet is the last byte
+        return address.upper().endswith(IPV4_LOOPBACK_SUFFIX)
+    address = address.upper()
+    if address == IPV6_LOOPBACK:
+        return True
+    return address.startswith(IPV4_MAPPED_PREFIX) and address.endswith(IPV4_LOOPBACK_SUFFIX)
+
+
+def active_connections(tables: List[str], port: int) -> int:
+    """Count the established connections of the clients to a local port.
+
+    Args:
+        tables: contents of /proc/net/tcp and /proc/net/tcp6.
+        port: local port.
+
+    Returns:
+        int: The established connections to the port, not counting the loopback ones.
+    """
+    connections = 0
+    for table in tables:
+        for line in table.splitlines()[1:]:
+            fields = line.split()
+            if len(fields) < 4 or fields[3] != TCP_ESTABLISHED:
+                continue
+            local_port = int(fields[1].rpartition(":")[2], 16)
+            remote_address = fields[2].rpartition(":")[0]
+            if local_port == port and not _is_loopback(remote_address):
+                connections += 1
+    return connections
+
+
+def _read_tables() -> List[str]:
+    tables = []
+    for path in PROC_NET_TCP:
+        try:
+            with open(path, "r") as f:
+                tables.append(f.read())
+        except OSError:
+            continue
+    return tables
+
+
+def drain(port: int, grace_period: float, min_wait: float, interval: float) -> dict:
+    """Wait until the connections to the port are drained, or the grace period ends.
+
+    Args:
+        port: port of keystone.
+        grace_period: maximum time to wait, in seconds.
+        min_wait: minimum time to wait, in seconds, so the unit is taken out of the
+            endpoints of the Kubernetes service before the connections are counted again. It
+            is not waited if no client is connected in the first place.
+        interval: time between two counts of the connections, in seconds.
+
+    Returns:
+        dict: Whether the connections were drained, the time it took and the connections left.
+    """
+    start = time.monotonic()
+    deadline = start + grace_period
+    connections = active_connections(_read_tables(), port)
+    if connections:
+        time.sleep(min(min_wait, grace_period))
+        connections = active_connections(_read_tables(), port)
+    while connections and time.monotonic() < deadline:
+        time.sleep(interval)
+        connections = active_connections(_read_tables(), port)
+    return {
+        "drained": not connections,
+        "seconds": round(time.monotonic() - start, 1),
+        "connections": connections,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Drain the connections, and print the result as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--drain-file", default="/tmp/keystone-drain/draining")
+    parser.add_argument("--grace-period", type=float, default=30)
+    parser.add_argument("--min-wait", type=float, default=10)
+    parser.add_argument("--interval", type=float, default=0.5)
+    args = parser.parse_args(argv)
+
+    with open(args.drain_file, "w"):
+        pass
+    json.dump(drain(args.port, args.grace_period, args.min_wait, args.interval), sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
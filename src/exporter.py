@@ -0,0 +1,380 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Keystone metrics exporter.
+
+This script runs as a Pebble service in the keystone container, and serves the metrics of the
+unit in the Prometheus text format. It only depends on the python standard library, so it runs
+with the python interpreter of the keystone image.
+
+The metrics are collected at scrape time from:
+
+- The key repositories: age of the primary key, number of keys and time until the next
+  rotation of each repository.
+- The state file written by the charm at the end of every hook: last successful key sync,
+  last hook durations and Pebble calls of the charm, and the phases of the last startup.
+- The request log written by apache for every request, whether the access logs are enabled or
+  not: requests served by keystone, by status code, and their duration (`%D`).
+- A synthetic probe of the keystone API: whether keystone is up, and the latency of the probe
+  itself, which is not the latency of the requests of the clients.
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, Iterable, List, Optional, Tuple
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# Lines of the request log: status code and duration in microseconds (`%>s %D`)
+REQUEST_LOG_REGEX = re.compile(r"^(\d{3}) (\d+)$")
+# The request log is truncated once read beyond this size, so it does not grow forever
+MAX_REQUEST_LOG_SIZE = 10 * 1024 * 1024
+
+
+class MetricFamily:
+    """Metric family in the Prometheus text format."""
+
+    def __init__(self, name: str, metric_type: str, documentation: str):
+        """Constructor for MetricFamily."""
+        self.name = name
+        self.metric_type = metric_type
+        self.documentation = documentation
+        self.samples: List[Tuple[str, Dict[str, str], float]] = []
+
+    def add(self, value: float, suffix: str = "", **labels: str) -> "MetricFamily":
+        """Add a sample to the metric family."""
+        self.samples.append((suffix, labels, value))
+        return self
+
+    def render(self) -> str:
+        """Render the metric family in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        for suffix, labels, value in self.samples:
+            label_string = ",".join(
+                f'{key}="{_escape(str(label))}"' for key, label in sorted(labels.items())
+            )
+            label_string = f"{{{label_string}}}" if label_string else ""
+            lines.append(f"{self.name}{suffix}{label_string} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def parse_request(line: str) -> Optional[Tuple[str, float]]:
+    """Get the status code and the duration of a line of the request log.
+
+    Args:
+        line: line of the request log.
+
+    Returns:
+        Optional[Tuple[str, float]]: The status code, and the duration in seconds, or None if
+            the line is not a request.
+    """
+    match = REQUEST_LOG_REGEX.match(line.strip())
+    return (match.group(1), int(match.group(2)) / 1e6) if match else None
+
+
+class Histogram:
+    """Histogram of latencies, in seconds."""
+
+    def __init__(self, name: str, documentation: str):
+        """Constructor for Histogram."""
+        self.name = name
+        self.documentation = documentation
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        """Add a value to the histogram."""
+        self.count += 1
+        self.total += value
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+
+    def metric(self) -> MetricFamily:
+        """Get the metric of the histogram."""
+        metric = MetricFamily(self.name, "histogram", self.documentation)
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            metric.add(count, "_bucket", le=str(bound))
+        metric.add(self.count, "_bucket", le="+Inf")
+        return metric.add(self.count, "_count").add(round(self.total, 6), "_sum")
+
+
+def key_repository_metrics(
+    key_repositories: Dict[str, str],
+    rotation_times: Dict[str, float],
+    now: float,
+    last_rotations: Optional[Dict[str, float]] = None,
+) -> List[MetricFamily]:
+    """Collect the metrics of the key repositories.
+
+    The primary key is the key with the highest index. The next rotation is due the rotation
+    time after the last rotation. If the time of the last rotation is unknown, the creation of
+    the staged key (index 0) is used, as it is created at every rotation.
+
+    Args:
+        key_repositories: path of each key repository, by name.
+        rotation_times: time between rotations of the keys, in seconds, of the repositories
+            rotated periodically.
+        now: current time.
+        last_rotations: time of the last rotation of the repositories, if known.
+
+    Returns:
+        List[MetricFamily]: The metrics.
+    """
+    count = MetricFamily("keystone_keys", "gauge", "Number of keys in the key repository.")
+    age = MetricFamily(
+        "keystone_primary_key_age_seconds", "gauge", "Age of the primary key of the repository."
+    )
+    next_rotation = MetricFamily(
+        "keystone_key_rotation_due_seconds",
+        "gauge",
+        "Time until the next key rotation. Negative if the rotation is overdue.",
+    )
+    for name, path in sorted(key_repositories.items()):
+        try:
+            keys = [key for key in os.listdir(path) if key.isdigit()]
+        except OSError:
+            continue
+        count.add(len(keys), repository=name)
+        if not keys:
+            continue
+        primary_key = max(keys, key=int)
+        age.add(round(now - os.path.getmtime(os.path.join(path, primary_key)), 3), repository=name)
+        rotation_time = rotation_times.get(name)
+        last_rotation = (last_rotations or {}).get(name)
+        if rotation_time and (last_rotation or "0" in keys):
+            last_rotation = last_rotation or os.path.getmtime(os.path.join(path, "0"))
+            next_rotation.add(round(last_rotation + rotation_time - now, 3), repository=name)
+    return [count, age, next_rotation]
+
+
+def charm_metrics(state: dict, now: float) -> List[MetricFamily]:
+    """Collect the metrics of the charm, from its state file.
+
+    Args:
+        state: content of the state file written by the charm.
+        now: current time.
+
+    Returns:
+        List[MetricFamily]: The metrics.
+    """
+    metrics = []
+    last_key_sync = state.get("last_key_sync")
+    if last_key_sync:
+        metrics.append(
+            MetricFamily(
+                "keystone_key_sync_age_seconds",
+                "gauge",
+                "Time since the last successful sync of the keys in this unit.",
+            ).add(round(now - last_key_sync, 3))
+        )
+    hook_duration = MetricFamily(
+        "keystone_charm_hook_duration_seconds", "gauge", "Duration of the last run of each hook."
+    )
+    hook_timestamp = MetricFamily(
+        "keystone_charm_hook_last_run_timestamp_seconds",
+        "gauge",
+        "Time of the last run of each hook.",
+    )
+    for hook, run in sorted(state.get("hooks", {}).items()):
+        hook_duration.add(run["duration"], hook=hook)
+        hook_timestamp.add(run["timestamp"], hook=hook)
+    pebble_calls = MetricFamily(
+        "keystone_charm_pebble_calls_total", "counter", "Pebble calls of the charm, by method."
+    )
+    for method, calls in sorted(state.get("pebble_calls", {}).items()):
+        pebble_calls.add(calls, method=method)
+    return metrics + [hook_duration, hook_timestamp, pebble_calls]
+
+
+def startup_metrics(startup: Optional[dict]) -> List[MetricFamily]:
+    """Collect the metrics of the last startup of keystone, recorded by the charm.
+
+    Args:
+        startup: last startup in the state file, if any.
+
+    Returns:
+        List[MetricFamily]: The metrics.
+    """
+    if not startup:
+        return []
+    phase_duration = MetricFamily(
+        "keystone_startup_phase_duration_seconds",
+        "gauge",
+        "Duration of each phase of the last startup.",
+    )
+    phase_regressed = MetricFamily(
+        "keystone_startup_phase_regressed",
+        "gauge",
+        "Whether the phase of the last startup took much longer than in the previous ones.",
+    )
+    for phase, duration in startup["phases"].items():
+        phase_duration.add(duration, phase=phase)
+        phase_regressed.add(1 if phase in startup["regressions"] else 0, phase=phase)
+    duration = MetricFamily(
+        "keystone_startup_duration_seconds",
+        "gauge",
+        "Time from the restart of keystone until it serves requests, in the last startup.",
+    ).add(startup["duration"])
+    return [duration, phase_duration, phase_regressed]
+
+
+class RequestLog:
+    """Requests served by keystone, by status code, and their duration, from the request log."""
+
+    def __init__(self, path: str, max_size: int = MAX_REQUEST_LOG_SIZE):
+        """Constructor for RequestLog.
+
+        Args:
+            path: path of the request log.
+            max_size: size, in bytes, beyond which the log is truncated once read.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.offset = 0
+        self.requests: Dict[str, int] = {}
+        self.duration = Histogram(
+            "keystone_http_request_duration_seconds",
+            "Duration of the requests served by keystone, as measured by apache.",
+        )
+
+    def collect(self) -> List[MetricFamily]:
+        """Count the new requests, and get the metrics."""
+        for line in self._new_lines():
+            request = parse_request(line)
+            if request:
+                code, duration = request
+                self.requests[code] = self.requests.get(code, 0) + 1
+                self.duration.observe(duration)
+        requests = MetricFamily(
+            "keystone_http_requests_total", "counter", "Requests served by keystone."
+        )
+        for code, count in sorted(self.requests.items()):
+            requests.add(count, code=code)
+        return [requests, self.duration.metric()]
+
+    def _new_lines(self) -> Iterable[str]:
+        try:
+            if os.path.getsize(self.path) < self.offset:
+                # The log has been truncated
+                self.offset = 0
+            with open(self.path, "r", errors="replace") as f:
+                f.seek(self.offset)
+                lines = f.readlines()
+                self.offset = f.tell()
+            if self.offset > self.max_size:
+                # Apache appends to the log, so the next lines are written from the start
+                os.truncate(self.path, 0)
+                self.offset = 0
+        except OSError:
+            return []
+        return lines
+
+
+class Probe:
+    """Synthetic probe of the keystone API, with a histogram of the latency of the probe."""
+
+    def __init__(self, url: str, timeout: float = 5):
+        """Constructor for Probe."""
+        self.url = url
+        self.timeout = timeout
+        self.duration = Histogram(
+            "keystone_probe_duration_seconds",
+            "Latency of the synthetic probe of the keystone API, once per scrape.",
+        )
+
+    def collect(self) -> List[MetricFamily]:
+        """Probe keystone, and get the metrics."""
+        start = time.monotonic()
+        try:
+            with urllib.request.urlopen(self.url, timeout=self.timeout) as response:
+                up = 1 if response.status < 500 else 0
+        except urllib.error.HTTPError as e:
+            up = 1 if e.code < 500 else 0
+        except (OSError, ValueError):
+            up = 0
+        self.duration.observe(time.monotonic() - start)
+        up_metric = MetricFamily("keystone_up", "gauge", "Keystone API is up.").add(up)
+        return [up_metric, self.duration.metric()]
+
+
+class Exporter:
+    """Collector of all the metrics of the unit."""
+
+    def __init__(self, state_file: str, request_log: str, probe_url: str):
+        """Constructor for Exporter."""
+        self.state_file = state_file
+        self.request_log = RequestLog(request_log)
+        self.probe = Probe(probe_url)
+
+    def collect(self) -> str:
+        """Collect the metrics, in the Prometheus text format."""
+        now = time.time()
+        state = self._read_state()
+        metrics = key_repository_metrics(
+            state.get("key_repositories", {}),
+            state.get("rotation_times", {}),
+            now,
+            state.get("last_rotations"),
+        )
+        metrics += charm_metrics(state, now)
+        metrics += startup_metrics(state.get("last_startup"))
+        metrics += self.request_log.collect()
+        metrics += self.probe.collect()
+        return "".join(metric.render() for metric in metrics)
+
+    def _read_state(self) -> dict:
+        try:
+            with open(self.state_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Serve the metrics."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=9180)
+    parser.add_argument("--state-file", required=True)
+    parser.add_argument("--request-log", default="/var/log/apache2/keystone-requests.metrics")
+    parser.add_argument("--probe-url", default="http://localhost:5000/v3")
+    args = parser.parse_args(argv)
+    exporter = Exporter(args.state_file, args.request_log, args.probe_url)
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = exporter.collect().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    # Scrapes are served one at a time, the collectors are not thread-safe
+    server = HTTPServer(("", args.port), MetricsHandler)
+    server.serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,9 @@
 
 """Interfaces used by this charm."""
 
+import json
+from typing import Dict, List, Optional
+
 import ops.charm
 import ops.framework
 import ops.model
@@ -79,6 +82,20 @@ class MysqlClient(BaseRelationClient):
         """Port."""
         return self.get_data_from_unit("port")
 
+    @property
+    def endpoints(self) -> List[str]:
+        """The `host:port` endpoints of all the units, without duplicates."""
+        # The units of the relation change in the life of the charm, e.g. in the unit tests
+        self._update_relation()
+        endpoints = []
+        if self.relation:
+            for unit in sorted(self.relation.units, key=lambda unit: int(unit.name.split("/")[1])):
+                host = self.relation.data[unit].get("host")
+                port = self.relation.data[unit].get("port")
+                if host and port and f"{host}:{port}" not in endpoints:
+                    endpoints.append(f"{host}:{port}")
+        return endpoints
+
     @property
     def user(self):
         """User."""
@@ -150,8 +167,19 @@ class KeystoneServer(ops.framework.Object):
         admin_username: str,
         admin_password: str,
         admin_project_name: str,
+        token_cache_ttl: int,
+        key_generation: int,
+        invalidation_counter: int,
+        jws_public_keys: Optional[List[str]] = None,
     ):
-        """Publish information in Keystone relation."""
+        """Publish information in Keystone relation.
+
+        Besides the connection details, caching hints are published so the consumers
+        can cache validated tokens: the recommended token cache TTL (in seconds), the
+        current key generation, and a counter that is increased every time the
+        cached tokens must be invalidated. If the JWS token provider is used, the public
+        keys are published as well, so the consumers can validate the tokens offline.
+        """
         if self.framework.model.unit.is_leader():
             for relation in self.framework.model.relations[self.relation_name]:
                 relation_data = relation.data[self.framework.model.app]
@@ -167,3 +195,89 @@ class KeystoneServer(ops.framework.Object):
                 relation_data["admin_username"] = str(admin_username)
                 relation_data["admin_password"] = str(admin_password)
                 relation_data["admin_project_name"] = str(admin_project_name)
+                relation_data["token_cache_ttl"] = str(token_cache_ttl)
+                relation_data["key_generation"] = str(key_generation)
+                relation_data["cache_invalidation_counter"] = str(invalidation_counter)
+                if jws_public_keys is not None:
+                    relation_data["jws_public_keys"] = json.dumps(jws_public_keys)
+                elif "jws_public_keys" in relation_data:
+                    del relation_data["jws_public_keys"]
+
+
+class PrometheusScrapeProvider(ops.framework.Object):
+    """Provides side of a prometheus_scrape Endpoint.
+
+    The scrape job targets the metrics port of every unit of the application, at the ingress
+    address of the unit in the relation. The relation data is the one of the
+    `MetricsEndpointProvider` of the prometheus_k8s charm library.
+    """
+
+    def __init__(
+        self,
+        charm: ops.charm.CharmBase,
+        relation_name: str,
+        port: int,
+        metrics_path: str = "/metrics",
+    ):
+        super().__init__(charm, relation_name)
+        self.relation_name = relation_name
+        self.port = port
+        self.metrics_path = metrics_path
+        self.framework.observe(charm.on[relation_name].relation_joined, self._publish)
+        self.framework.observe(charm.on.leader_elected, self._publish)
+        # The address of the pod changes when it is recreated
+        self.framework.observe(charm.on.start, self._publish)
+        self.framework.observe(charm.on.upgrade_charm, self._publish)
+
+    def _publish(self, _=None) -> None:
+        """Publish the scrape job and the address of the unit."""
+        model = self.framework.model
+        for relation in model.relations[self.relation_name]:
+            unit_data = relation.data[model.unit]
+            binding = model.get_binding(relation)
+            if binding and binding.network.ingress_address:
+                unit_data["prometheus_scrape_unit_address"] = str(binding.network.ingress_address)
+            unit_data["prometheus_scrape_unit_name"] = model.unit.name
+            if not model.unit.is_leader():
+                continue
+            relation_data = relation.data[model.app]
+            relation_data["scrape_jobs"] = json.dumps(
+                [
+                    {
+                        "metrics_path": self.metrics_path,
+                        "static_configs": [{"targets": [f"*:{self.port}"]}],
+                    }
+                ]
+            )
+            relation_data["scrape_metadata"] = json.dumps(
+                {
+                    "model": model.name,
+                    "model_uuid": model.uuid,
+                    "application": model.app.name,
+                    "charm_name": self.framework.meta.name,
+                }
+            )
+
+
+class LokiPushApiConsumer(ops.framework.Object):
+    """Requires side of a loki_push_api Endpoint.
+
+    Every unit of the Loki application publishes the URL of its push API in its unit data, as
+    read by the `LokiPushApiConsumer` of the loki_k8s charm library.
+    """
+
+    def __init__(self, charm: ops.charm.CharmBase, relation_name: str):
+        super().__init__(charm, relation_name)
+        self.relation_name = relation_name
+
+    @property
+    def endpoints(self) -> Dict[str, str]:
+        """Push API URL of each Loki unit, by unit name."""
+        endpoints = {}
+        for relation in self.framework.model.relations[self.relation_name]:
+            for unit in relation.units:
+                try:
+                    endpoints[unit.name] = json.loads(relation.data[unit]["endpoint"])["url"]
+                except (KeyError, TypeError, ValueError):
+                    continue
+        return endpoints
@@ -0,0 +1,302 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Keystone load generator.
+
+This script is pushed into the keystone container by the `benchmark` action, and runs there
+against the local keystone API. It only depends on the python standard library, so it runs with
+the python interpreter of the keystone image.
+
+Every worker keeps a persistent connection to keystone, and loops over three operations until
+the duration elapses, or the requested number of loops is done:
+
+- issue: issue a project-scoped token (`POST /v3/auth/tokens`).
+- validate: validate the token (`GET /v3/auth/tokens`).
+- catalog: list the catalog with the token (`GET /v3/auth/catalog`).
+
+The results are printed as JSON: for each operation and in total, the requests, errors, status
+codes, requests per second and the p50, p95 and p99 latencies in milliseconds.
+
+With `--wait-ready`, the load generator waits until keystone responds before starting, and exits
+with code 2 if it does not respond in time. This is used to warm up keystone after a restart.
+
+The password is read from the KEYSTONE_PASSWORD environment variable, so it is not visible in
+the command line.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+OPERATIONS = ["issue", "validate", "catalog"]
+PERCENTILES = [50, 95, 99]
+NOT_READY_EXIT_CODE = 2
+
+
+class Recorder:
+    """Thread-safe recorder of request latencies and status codes."""
+
+    def __init__(self):
+        """Constructor for Recorder."""
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {operation: [] for operation in OPERATIONS}
+        self.status_codes: Dict[str, Dict[str, int]] = {operation: {} for operation in OPERATIONS}
+
+    def record(self, operation: str, latency: float, status: str) -> None:
+        """Record a request.
+
+        Args:
+            operation: name of the operation.
+            latency: latency of the request, in seconds.
+            status: status code of the response, or "error" if there was no response.
+        """
+        with self._lock:
+            self.latencies[operation].append(latency)
+            codes = self.status_codes[operation]
+            codes[status] = codes.get(status, 0) + 1
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of values.
+
+    Args:
+        values: values, in any order.
+        pct: percentile, from 0 to 100.
+
+    Returns:
+        float: The percentile, or 0 if there are no values.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(
+    latencies: List[float], status_codes: Dict[str, int], elapsed: float
+) -> Dict[str, object]:
+    """Summarize the requests of an operation.
+
+    Args:
+        latencies: latencies of the requests, in seconds.
+        status_codes: number of responses by status code.
+        elapsed: duration of the benchmark, in seconds.
+
+    Returns:
+        Dict[str, object]: Requests, errors, status codes, requests per second and latency
+            percentiles in milliseconds.
+    """
+    summary: Dict[str, object] = {
+        "requests": len(latencies),
+        "errors": sum(count for code, count in status_codes.items() if not code.startswith("2")),
+        "status-codes": dict(sorted(status_codes.items())),
+        "requests-per-second": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+    }
+    for pct in PERCENTILES:
+        summary[f"p{pct}-ms"] = round(percentile(latencies, pct) * 1000, 1)
+    return summary
+
+
+def report(recorder: Recorder, elapsed: float) -> Dict[str, Dict[str, object]]:
+    """Summarize the requests of every operation, and of all of them.
+
+    Args:
+        recorder: recorder of the requests.
+        elapsed: duration of the benchmark, in seconds.
+
+    Returns:
+        Dict[str, Dict[str, object]]: Summary of each operation, and the total.
+    """
+    results = {}
+    all_latencies: List[float] = []
+    all_status_codes: Dict[str, int] = {}
+    for operation in OPERATIONS:
+        latencies = recorder.latencies[operation]
+        status_codes = recorder.status_codes[operation]
+        results[operation] = summarize(latencies, status_codes, elapsed)
+        all_latencies.extend(latencies)
+        for code, count in status_codes.items():
+            all_status_codes[code] = all_status_codes.get(code, 0) + count
+    results["total"] = summarize(all_latencies, all_status_codes, elapsed)
+    return results
+
+
+class LoopBudget:
+    """Thread-safe budget of loops shared by the workers."""
+
+    def __init__(self, loops: Optional[int]):
+        """Constructor for LoopBudget.
+
+        Args:
+            loops: number of loops, or None for unlimited loops.
+        """
+        self._lock = threading.Lock()
+        self.remaining = loops
+
+    def take(self) -> bool:
+        """Take a loop from the budget, if any left."""
+        with self._lock:
+            if self.remaining is None:
+                return True
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+def wait_ready(url: str, timeout: float) -> bool:
+    """Wait until keystone responds.
+
+    Args:
+        url: keystone API URL.
+        timeout: time to wait, in seconds.
+
+    Returns:
+        bool: True if keystone responded before the timeout.
+    """
+    parsed_url = urlparse(url)
+    deadline = time.monotonic() + timeout
+    while True:
+        connection = http.client.HTTPConnection(parsed_url.hostname, parsed_url.port or 80, 5)
+        try:
+            connection.request("GET", parsed_url.path or "/")
+            if connection.getresponse().status < 500:
+                return True
+        except (OSError, http.client.HTTPException):
+            pass
+        finally:
+            connection.close()
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(1)
+
+
+class Worker(threading.Thread):
+    """Worker looping over the operations with a persistent connection."""
+
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        password: str,
+        recorder: Recorder,
+        deadline: float,
+        budget: LoopBudget,
+    ):
+        """Constructor for Worker."""
+        super().__init__(daemon=True)
+        self.args = args
+        self.password = password
+        self.recorder = recorder
+        self.deadline = deadline
+        self.budget = budget
+        url = urlparse(args.url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.path = url.path.rstrip("/")
+        self.connection: Optional[http.client.HTTPConnection] = None
+
+    def run(self) -> None:
+        """Loop over the operations until the deadline."""
+        while time.monotonic() < self.deadline and self.budget.take():
+            token = self._request("issue", "POST", "/auth/tokens", body=self._auth_body())
+            if token is None:
+                continue
+            headers = {"X-Auth-Token": token}
+            self._request("validate", "GET", "/auth/tokens", {**headers, "X-Subject-Token": token})
+            self._request("catalog", "GET", "/auth/catalog", headers)
+
+    def _auth_body(self) -> str:
+        return json.dumps(
+            {
+                "auth": {
+                    "identity": {
+                        "methods": ["password"],
+                        "password": {
+                            "user": {
+                                "name": self.args.username,
+                                "domain": {"name": self.args.user_domain},
+                                "password": self.password,
+                            }
+                        },
+                    },
+                    "scope": {
+                        "project": {
+                            "name": self.args.project,
+                            "domain": {"name": self.args.project_domain},
+                        }
+                    },
+                }
+            }
+        )
+
+    def _request(
+        self, operation: str, method: str, path: str, headers=None, body=None
+    ) -> Optional[str]:
+        """Send a request, and record its latency and status.
+
+        Returns:
+            Optional[str]: The X-Subject-Token header of the response, if successful.
+        """
+        headers = {"Content-Type": "application/json", **(headers or {})}
+        start = time.monotonic()
+        try:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(
+                    self.host, self.port, timeout=self.args.timeout
+                )
+            self.connection.request(method, f"{self.path}{path}", body=body, headers=headers)
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.recorder.record(operation, time.monotonic() - start, "error")
+            if self.connection is not None:
+                self.connection.close()
+            self.connection = None
+            return None
+        self.recorder.record(operation, time.monotonic() - start, str(response.status))
+        if response.status >= 300:
+            return None
+        return response.getheader("X-Subject-Token")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run the benchmark, and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:5000/v3")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--project", required=True)
+    parser.add_argument("--user-domain", default="default")
+    parser.add_argument("--project-domain", default="default")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--timeout", type=float, default=30, help="timeout of each request")
+    parser.add_argument("--loops", type=int, help="stop after this number of loops")
+    parser.add_argument("--wait-ready", type=float, help="wait until keystone responds")
+    args = parser.parse_args(argv)
+
+    if args.wait_ready is not None and not wait_ready(args.url, args.wait_ready):
+        print(f"keystone is not ready after {args.wait_ready} seconds", file=sys.stderr)
+        return NOT_READY_EXIT_CODE
+    recorder = Recorder()
+    budget = LoopBudget(args.loops)
+    start = time.monotonic()
+    deadline = start + args.duration
+    password = os.environ.get("KEYSTONE_PASSWORD", "")
+    workers = [Worker(args, password, recorder, deadline, budget) for _ in range(args.concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    json.dump(report(recorder, time.monotonic() - start), sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
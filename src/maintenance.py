@@ -0,0 +1,243 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Keystone database maintenance module.
+
+Keystone never removes some rows that are not needed anymore, and the tables keep growing.
+This module prunes them:
+
+- Expired and soft-deleted trusts, with `keystone-manage trust_flush`.
+- Revocation events older than the tokens they could revoke. Token validation checks the
+  revocation events, so keeping the table bounded keeps the validation fast.
+- Optionally, expired application credentials.
+
+It also reports the progress of the migration of the credentials to a new credential key, by
+counting the credentials encrypted with it.
+
+The SQL statements are executed with the mysql client of the keystone container, which reads
+the credentials from an option file in memory. The rows are deleted in batches of
+PRUNE_BATCH_SIZE rows, each one in its own transaction, so the tables are never locked for long.
+A pruning can be bounded in time: `keystone-manage trust_flush` is killed at the deadline, and
+the rows left are deleted in the next pruning.
+"""
+
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from ops import pebble
+
+from command_runner import CommandRunner
+
+logger = logging.getLogger(__name__)
+
+# Option file of the mysql client, in the tmpfs of the container, readable only by root
+MYSQL_OPTION_FILE = "/dev/shm/keystone-maintenance/client.cnf"
+# Keystone keeps the revocation events for the token expiration plus this buffer
+# (`[revoke] expiration_buffer`), in seconds.
+REVOCATION_EXPIRATION_BUFFER = 1800
+
+COUNT_FLUSHABLE_TRUSTS = (
+    "SELECT COUNT(*) FROM trust WHERE deleted_at IS NOT NULL OR expires_at < UTC_TIMESTAMP();"
+)
+# Rows deleted by every DELETE statement, and DELETE statements run by every mysql client
+PRUNE_BATCH_SIZE = 1000
+PRUNE_BATCHES_PER_QUERY = 10
+DELETE_REVOCATION_EVENTS = (
+    "DELETE FROM revocation_event WHERE revoked_at < UTC_TIMESTAMP() - INTERVAL {} SECOND"
+)
+# expires_at is stored in microseconds since the epoch
+DELETE_APPLICATION_CREDENTIALS = (
+    "DELETE FROM application_credential"
+    " WHERE expires_at IS NOT NULL AND expires_at < UNIX_TIMESTAMP() * 1000000"
+)
+# key_hash is the hash of the credential key that encrypted each credential
+COUNT_MIGRATED_CREDENTIALS = "SELECT COUNT(*), COALESCE(SUM(key_hash = '{}'), 0) FROM credential;"
+
+
+class KeystoneMaintenance:
+    """Pruning of the keystone database."""
+
+    def __init__(
+        self,
+        command_runner: CommandRunner,
+        db_host: str,
+        db_port: int,
+        db_password: str,
+        token_expiration: int,
+    ):
+        """Constructor for KeystoneMaintenance.
+
+        Args:
+            command_runner: runner of commands in the keystone container.
+            db_host: host of the keystone database.
+            db_port: port of the keystone database.
+            db_password: password of the keystone database user.
+            token_expiration: token expiration of keystone, in seconds.
+        """
+        self.command_runner = command_runner
+        self.db_host = db_host
+        self.db_port = db_port
+        self.db_password = db_password
+        self.token_expiration = token_expiration
+        self._option_file_written = False
+
+    def prune(
+        self, application_credentials: bool = False, time_budget: Optional[float] = None
+    ) -> Dict[str, float]:
+        """Prune the keystone database.
+
+        Args:
+            application_credentials: also delete the expired application credentials.
+            time_budget: time, in seconds, after which no more batches are deleted, and
+                `keystone-manage trust_flush` is killed. If none given, every row is deleted.
+
+        Returns:
+            Dict[str, float]: Rows removed from each table, the time taken in seconds, and
+                whether every row was deleted ("complete", 1 or 0).
+
+        Raises:
+            pebble.ExecError: if any of the commands fails.
+            pebble.ChangeError: if any of the commands could not run, or timed out.
+            pebble.PathError: if the option file of mysql could not be written.
+        """
+        start = time.monotonic()
+        deadline = start + time_budget if time_budget is not None else None
+        results: Dict[str, float] = {}
+        flushable_trusts = int(self._query(COUNT_FLUSHABLE_TRUSTS))
+        trusts_flushed = self._flush_trusts(deadline)
+        results["trusts"] = flushable_trusts - int(self._query(COUNT_FLUSHABLE_TRUSTS))
+        results["revocation-events"], complete = self._delete_in_batches(
+            DELETE_REVOCATION_EVENTS.format(self.token_expiration + REVOCATION_EXPIRATION_BUFFER),
+            deadline,
+        )
+        complete = complete and trusts_flushed
+        if application_credentials and complete:
+            results["application-credentials"], complete = self._delete_in_batches(
+                DELETE_APPLICATION_CREDENTIALS, deadline
+            )
+        results["complete"] = int(complete)
+        results["seconds"] = round(time.monotonic() - start, 1)
+        logger.info(f"Keystone database pruned: {results}")
+        return results
+
+    def _flush_trusts(self, deadline: Optional[float]) -> bool:
+        """Flush the expired and soft-deleted trusts, until the deadline.
+
+        trust_flush deletes the trusts in a single transaction: if it is killed at the
+        deadline, the transaction is rolled back and the trusts are flushed in the next pruning.
+
+        Args:
+            deadline: time, as returned by time.monotonic(), at which trust_flush is killed. If
+                none given, the default timeout of the commands is used.
+
+        Returns:
+            bool: True if the trusts were flushed, False if the deadline was reached.
+        """
+        if deadline is None:
+            self.command_runner.run(["keystone-manage", "trust_flush"])
+            return True
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            return False
+        try:
+            self.command_runner.run(["keystone-manage", "trust_flush"], timeout=timeout)
+        except pebble.ChangeError:
+            if time.monotonic() < deadline:
+                raise
+            logger.warning("keystone-manage trust_flush killed at the end of the time budget")
+            return False
+        return True
+
+    def _delete_in_batches(self, delete: str, deadline: Optional[float]) -> Tuple[int, bool]:
+        """Delete rows in batches of PRUNE_BATCH_SIZE rows, until none is left or the deadline.
+
+        Args:
+            delete: DELETE statement, without LIMIT.
+            deadline: time, as returned by time.monotonic(), after which no more batches are
+                deleted. If none given, every row is deleted.
+
+        Returns:
+            Tuple[int, bool]: The rows deleted, and whether every row was deleted.
+        """
+        statements = f"{delete} LIMIT {PRUNE_BATCH_SIZE}; SELECT ROW_COUNT();"
+        deleted = 0
+        while True:
+            output = self._query_lines(" ".join([statements] * PRUNE_BATCHES_PER_QUERY))
+            batches = [int(rows) for rows in output]
+            deleted += sum(batches)
+            if batches[-1] < PRUNE_BATCH_SIZE:
+                return deleted, True
+            if deadline is not None and time.monotonic() >= deadline:
+                return deleted, False
+
+    def credential_migration_progress(self, key_hash: str) -> Dict[str, int]:
+        """Get the progress of the migration of the credentials to a credential key.
+
+        Args:
+            key_hash: hash of the primary credential key.
+
+        Returns:
+            Dict[str, int]: Credentials encrypted with the key ("migrated"), and in total.
+
+        Raises:
+            pebble.ExecError: if the query fails.
+            pebble.ChangeError: if the query could not run, or timed out.
+            pebble.PathError: if the option file of mysql could not be written.
+        """
+        total, migrated = self._query(COUNT_MIGRATED_CREDENTIALS.format(key_hash)).split()
+        return {"migrated": int(migrated), "total": int(total)}
+
+    def _query(self, sql: str) -> str:
+        """Execute SQL statements in the keystone database.
+
+        Args:
+            sql: SQL statements.
+
+        Returns:
+            str: The last line of the output.
+        """
+        return self._query_lines(sql)[-1]
+
+    def _query_lines(self, sql: str) -> List[str]:
+        """Execute SQL statements in the keystone database.
+
+        Args:
+            sql: SQL statements.
+
+        Returns:
+            List[str]: The lines of the output.
+        """
+        if not self._option_file_written:
+            self._write_option_file()
+        output = self.command_runner.run(
+            [
+                "mysql",
+                f"--defaults-extra-file={MYSQL_OPTION_FILE}",
+                "--batch",
+                "--skip-column-names",
+                "-h",
+                self.db_host,
+                "-P",
+                str(self.db_port),
+                "-e",
+                sql,
+                "keystone",
+            ],
+        )
+        return output.strip().splitlines()
+
+    def _write_option_file(self) -> None:
+        """Write the credentials of the keystone database in the option file of mysql.
+
+        The password is neither passed in the command line nor in the environment, which are
+        visible to the other processes of the container.
+        """
+        password = self.db_password.replace("\\", "\\\\").replace('"', '\\"')
+        self.command_runner.container.push(
+            MYSQL_OPTION_FILE,
+            f'[client]\nuser = keystone\npassword = "{password}"\n',
+            permissions=0o600,
+            make_dirs=True,
+        )
+        self._option_file_written = True
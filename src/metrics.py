@@ -0,0 +1,181 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Charm metrics module.
+
+This module tracks the health of the charm: the duration of the hooks, the Pebble calls to the
+workload container and the last successful sync of the keys. At the end of every hook, the
+metrics are written in a state file in the workload container, where the exporter (`exporter.py`)
+serves them along with the metrics of the workload. The state file is only written when the hook
+made Pebble calls, synced the keys or changed the metrics of the workload: the duration of the
+other hooks is kept, and written along with the next change.
+
+The Pebble calls are counted through an `InstrumentedContainer`, which wraps the workload
+container. The charm must use the wrapper to access the container.
+
+```python
+# ...
+from metrics import CharmMetrics, InstrumentedContainer
+
+class SomeCharm(CharmBase):
+  def __init__(self, *args):
+    # ...
+    self.container = InstrumentedContainer(self.unit.get_container("some-container"))
+    self.metrics = CharmMetrics(self, self.container)
+
+  def _sync_keys(self):
+    # ...
+    self.metrics.key_synced()
+```
+"""
+
+import contextlib
+import functools
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import Counter
+from typing import Callable, ContextManager, Dict, Iterator, List
+
+from ops import pebble
+from ops.charm import CharmBase
+from ops.framework import Object, StoredState
+from ops.model import Container
+
+logger = logging.getLogger(__name__)
+
+EXPORTER_STATE_FILE = "/tmp/keystone-exporter/state.json"
+# Container methods that call Pebble
+PEBBLE_METHODS = [
+    "add_layer",
+    "can_connect",
+    "exec",
+    "exists",
+    "get_plan",
+    "get_services",
+    "isdir",
+    "list_files",
+    "make_dir",
+    "pull",
+    "push",
+    "remove_path",
+    "replan",
+    "restart",
+    "start",
+    "stop",
+]
+
+
+def hook_name() -> str:
+    """Name of the running hook or action, from the dispatch path (e.g. "hooks/install")."""
+    dispatch_path = os.environ.get("JUJU_DISPATCH_PATH", "")
+    kind, _, name = dispatch_path.partition("/")
+    if kind == "actions":
+        return f"{name}-action"
+    return name or "unknown"
+
+
+class InstrumentedContainer:
+    """Workload container whose Pebble calls are instrumented.
+
+    The container of the charm is wrapped, rather than patched, so the instruments only apply
+    to the calls made through the wrapper. An instrument is called with the name of the
+    container method before every Pebble call, and returns a context manager around the call.
+
+    The attributes set in the wrapper (e.g. mocks in the unit tests) take precedence over the
+    ones of the container, and are not instrumented.
+    """
+
+    def __init__(self, container: Container):
+        """Constructor for InstrumentedContainer.
+
+        Args:
+            container: the workload container.
+        """
+        self._container = container
+        self.instruments: List[Callable[[str], ContextManager]] = []
+
+    def __getattr__(self, name: str):
+        """Get an attribute of the container, instrumented if it is a Pebble call."""
+        attribute = getattr(self._container, name)
+        if name not in PEBBLE_METHODS:
+            return attribute
+
+        @functools.wraps(attribute)
+        def wrapper(*args, **kwargs):
+            with contextlib.ExitStack() as stack:
+                for instrument in self.instruments:
+                    stack.enter_context(instrument(name))
+                return attribute(*args, **kwargs)
+
+        return wrapper
+
+
+class CharmMetrics(Object):
+    """Metrics of the charm."""
+
+    _stored = StoredState()
+
+    def __init__(self, charm: CharmBase, container: InstrumentedContainer):
+        """Constructor for CharmMetrics.
+
+        The Pebble calls of the container are counted from now on.
+
+        Args:
+            charm: the charm.
+            container: workload container, where the state file is written.
+        """
+        super().__init__(charm, "charm-metrics")
+        self._stored.set_default(hooks={}, pebble_calls={}, last_key_sync=0.0, state_hash="")
+        self.container = container
+        self.start = time.monotonic()
+        self.pebble_calls: Counter = Counter()
+        # Metrics of the workload computed by the charm, added to the state file
+        self.workload_state: Dict[str, object] = {}
+        container.instruments.append(self._count)
+        # The state must be updated before the commit, when the stored state is saved
+        self.framework.observe(self.framework.on.pre_commit, self._on_pre_commit)
+
+    def key_synced(self) -> None:
+        """Record a successful sync of the keys."""
+        self._stored.last_key_sync = time.time()
+
+    @contextlib.contextmanager
+    def _count(self, method: str) -> Iterator[None]:
+        self.pebble_calls[method] += 1
+        yield
+
+    def _on_pre_commit(self, _) -> None:
+        """Record the duration of the hook, and write the state file."""
+        self._stored.hooks[hook_name()] = {
+            "duration": round(time.monotonic() - self.start, 3),
+            "timestamp": round(time.time(), 3),
+        }
+        pebble_calls = self._stored.pebble_calls
+        for method, calls in self.pebble_calls.items():
+            pebble_calls[method] = pebble_calls.get(method, 0) + calls
+        self.pebble_calls.clear()
+        values = {
+            "pebble_calls": dict(self._stored.pebble_calls),
+            "last_key_sync": self._stored.last_key_sync,
+            **self.workload_state,
+        }
+        state_hash = hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()
+        if state_hash == self._stored.state_hash:
+            return
+        # The calls writing the state file are not counted, or every hook would change it
+        container = self.container._container
+        if not container.can_connect():
+            return
+        state = {
+            "hooks": {hook: dict(run) for hook, run in self._stored.hooks.items()},
+            **values,
+        }
+        try:
+            container.push(EXPORTER_STATE_FILE, json.dumps(state), make_dirs=True)
+        except (pebble.ConnectionError, pebble.APIError, pebble.PathError) as e:
+            logger.warning(f"Failed to write the metrics state file: {e}")
+        else:
+            self._stored.state_hash = state_hash
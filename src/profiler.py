@@ -0,0 +1,230 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Workload profiler module.
+
+This module profiles the keystone WSGI workers with py-spy, a sampling profiler that attaches
+to running python processes. The samples are recorded in the collapsed stack format (one line
+per stack: `frame;frame;frame count`), which flamegraph tools take as input, and summarized in
+the hottest functions and in the share of the samples spent in the database, LDAP and the
+token cryptography.
+
+py-spy is used from the keystone container if available. Otherwise, the py-spy binary shipped
+with the charm is pushed into the container.
+"""
+
+import logging
+import shlex
+import shutil
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from ops import pebble
+from ops.model import Container
+
+from command_runner import CommandRunner
+
+logger = logging.getLogger(__name__)
+
+PY_SPY_PATH = "/tmp/py-spy"
+PROFILES_FOLDER = "/var/log/keystone/profiles/"
+# Processes running keystone code: mod_wsgi daemon processes, or the keystone WSGI scripts.
+# If there are none, keystone runs embedded in the apache processes.
+WORKER_PATTERNS = ["wsgi:keystone", "keystone-wsgi"]
+EMBEDDED_WORKER_PATTERN = "apache2"
+# Frames that identify where the time goes, matched against the file of each frame
+CATEGORIES = {
+    "database": ["sqlalchemy", "pymysql", "MySQLdb", "oslo_db"],
+    "ldap": ["ldap", "ldappool"],
+    "crypto": ["fernet", "cryptography", "jwt", "passlib", "bcrypt"],
+}
+
+LIST_PROCESSES = (
+    'for d in /proc/[0-9]*; do echo "${d#/proc/} $(tr "\\0" " " < $d/cmdline)"; done 2>/dev/null'
+)
+
+
+class ProfilerError(Exception):
+    """Profiler error exception."""
+
+
+def parse_collapsed(output: str) -> Counter:
+    """Parse collapsed stacks.
+
+    Args:
+        output: collapsed stacks, one `frame;frame;frame count` line per stack.
+
+    Returns:
+        Counter: Number of samples of each stack, the stacks being tuples of frames.
+    """
+    stacks: Counter = Counter()
+    for line in output.splitlines():
+        stack, _, count = line.rstrip().rpartition(" ")
+        if not stack or not count.isdigit():
+            continue
+        stacks[tuple(stack.split(";"))] += int(count)
+    return stacks
+
+
+def top_functions(stacks: Counter, limit: int = 10) -> List[str]:
+    """Get the functions with the most samples on top of the stack (self time).
+
+    Args:
+        stacks: number of samples of each stack.
+        limit: number of functions to return.
+
+    Returns:
+        List[str]: The functions, with their share of the samples.
+    """
+    total = sum(stacks.values())
+    leaves: Counter = Counter()
+    for stack, count in stacks.items():
+        leaves[stack[-1]] += count
+    return [f"{100 * count / total:.1f}% {frame}" for frame, count in leaves.most_common(limit)]
+
+
+def categorize(stacks: Counter) -> Dict[str, float]:
+    """Get the share of the samples spent in each category of `CATEGORIES`.
+
+    A sample counts in a category if any frame of its stack belongs to it, so the shares of
+    the categories can add up to more than 100%.
+
+    Args:
+        stacks: number of samples of each stack.
+
+    Returns:
+        Dict[str, float]: Percentage of the samples of each category.
+    """
+    total = sum(stacks.values())
+    shares = {}
+    for category, patterns in CATEGORIES.items():
+        count = sum(
+            count
+            for stack, count in stacks.items()
+            if any(pattern in _frame_file(frame) for frame in stack for pattern in patterns)
+        )
+        shares[category] = round(100 * count / total, 1) if total else 0.0
+    return shares
+
+
+def find_worker_pids(process_list: str) -> List[int]:
+    """Find the keystone worker processes.
+
+    Args:
+        process_list: one `pid command line` line per process.
+
+    Returns:
+        List[int]: PIDs of the keystone workers.
+    """
+    processes = []
+    for line in process_list.splitlines():
+        pid, _, cmdline = line.strip().partition(" ")
+        if pid.isdigit():
+            processes.append((int(pid), cmdline))
+    pids = [pid for pid, cmdline in processes if any(p in cmdline for p in WORKER_PATTERNS)] or [
+        pid for pid, cmdline in processes if EMBEDDED_WORKER_PATTERN in cmdline
+    ]
+    return pids
+
+
+def _frame_file(frame: str) -> str:
+    """Get the file of a frame (`function (file:line)`), or the frame if it has none."""
+    _, _, location = frame.partition(" (")
+    return location or frame
+
+
+class WorkloadProfiler:
+    """Profiler of the keystone WSGI workers."""
+
+    def __init__(self, container: Container, command_runner: CommandRunner, charm_dir: Path):
+        """Constructor for WorkloadProfiler.
+
+        Args:
+            container: keystone container.
+            command_runner: runner of commands in the keystone container.
+            charm_dir: directory of the charm, where the shipped py-spy binary is looked up.
+        """
+        self.container = container
+        self.command_runner = command_runner
+        self.charm_dir = charm_dir
+
+    def profile(self, duration: int, rate: int = 100) -> Dict[str, object]:
+        """Profile the keystone workers.
+
+        Args:
+            duration: duration of the profile, in seconds.
+            rate: samples per second.
+
+        Returns:
+            Dict[str, object]: The file with the collapsed stacks in the container, the
+                profiled PIDs, the samples, the hottest functions and the categories.
+
+        Raises:
+            ProfilerError: if py-spy is not available, or there are no keystone workers.
+            pebble.ExecError: if py-spy fails (e.g. the container lacks CAP_SYS_PTRACE).
+        """
+        py_spy = self._py_spy()
+        pids = find_worker_pids(self.command_runner.run(["sh", "-c", LIST_PROCESSES]))
+        if not pids:
+            raise ProfilerError("no keystone worker processes found")
+        self.container.make_dir(PROFILES_FOLDER, make_parents=True)
+        output_file = f"{PROFILES_FOLDER}{time.strftime('%Y%m%d-%H%M%S')}.collapsed"
+        records = [
+            shlex.join(
+                [py_spy, "record", "--pid", str(pid), "--duration", str(duration)]
+                + ["--rate", str(rate), "--format", "raw", "--nonblocking"]
+                + ["--output", f"{output_file}.{pid}"]
+            )
+            for pid in pids
+        ]
+        # All the workers are recorded at the same time, then the stacks are merged
+        script = "\n".join(
+            [f'{record} &\npids="$pids $!"' for record in records]
+            + [
+                "status=0",
+                "for pid in $pids; do wait $pid || status=$?; done",
+                f"cat {output_file}.* > {output_file}; rm -f {output_file}.*",
+                "exit $status",
+            ]
+        )
+        self.command_runner.run(["sh", "-c", script], timeout=duration + 60)
+        stacks = parse_collapsed(self.container.pull(output_file).read())
+        logger.info(f"Profile of keystone workers {pids} saved in {output_file}")
+        return {
+            "file": output_file,
+            "pids": " ".join(str(pid) for pid in pids),
+            "samples": sum(stacks.values()),
+            "top-functions": top_functions(stacks),
+            "categories": categorize(stacks),
+        }
+
+    def _py_spy(self) -> str:
+        """Get py-spy in the container, pushing the binary shipped with the charm if needed.
+
+        Returns:
+            str: The path of py-spy in the container.
+
+        Raises:
+            ProfilerError: if py-spy is neither in the container nor shipped with the charm.
+        """
+        try:
+            return self.command_runner.run(["sh", "-c", "command -v py-spy"]).strip()
+        except pebble.ExecError:
+            logger.debug("py-spy not found in the container")
+        if self.container.exists(PY_SPY_PATH):
+            return PY_SPY_PATH
+        shipped = self._shipped_py_spy()
+        if shipped is None:
+            raise ProfilerError("py-spy is not available in the container nor in the charm")
+        with open(shipped, "rb") as f:
+            self.container.push(PY_SPY_PATH, f, permissions=0o755)
+        return PY_SPY_PATH
+
+    def _shipped_py_spy(self) -> Optional[str]:
+        """Get the py-spy binary installed with the charm dependencies."""
+        venv_binary = self.charm_dir / "venv" / "bin" / "py-spy"
+        if venv_binary.exists():
+            return str(venv_binary)
+        return shutil.which("py-spy")
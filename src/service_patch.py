@@ -0,0 +1,233 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Kubernetes Service patch module.
+
+This module wraps the KubernetesServicePatch library, which is kept as published upstream. The
+library builds the Service of the application with the ports of the workload; this module adds
+the traffic routing options of the Service, and patches it only when the live Service differs.
+
+```python
+# ...
+from service_patch import ServicePatch
+
+class SomeCharm(CharmBase):
+  def __init__(self, *args):
+    # ...
+    self.service_patch = ServicePatch(
+        self,
+        [(f"{self.app.name}", 8080)],
+        internal_traffic_policy="Local",
+        topology_aware_hints=True,
+        session_affinity="ClientIP",
+    )
+    # ...
+```
+
+The patch is applied by the leader in the `install` and `upgrade-charm` events. The charm calls
+`patch` to apply a new configuration, once it is validated.
+
+lightkube and the library are imported lazily, only in the hooks that patch the Service: loading
+them is expensive, and most of the hooks do not need them. A single lightkube client is shared by
+the patches of the process.
+"""
+
+import logging
+from typing import TYPE_CHECKING, Literal, Optional, Sequence
+
+from ops.charm import CharmBase
+from ops.framework import Object
+
+if TYPE_CHECKING:  # pragma: no cover
+    from charms.observability_libs.v0.kubernetes_service_patch import PortDefinition
+    from lightkube import Client
+    from lightkube.resources.core_v1 import Service
+
+logger = logging.getLogger(__name__)
+
+InternalTrafficPolicy = Literal["Cluster", "Local"]
+SessionAffinity = Literal["None", "ClientIP"]
+
+# Annotations enabling topology aware routing. The first one is used by Kubernetes < 1.27.
+TOPOLOGY_AWARE_HINTS_ANNOTATION = "service.kubernetes.io/topology-aware-hints"
+TOPOLOGY_MODE_ANNOTATION = "service.kubernetes.io/topology-mode"
+# Seconds a "ClientIP" session affinity is kept by default in Kubernetes
+DEFAULT_SESSION_AFFINITY_TIMEOUT = 10800
+
+# Lightkube client shared by all the patches of the process
+_client: Optional["Client"] = None
+
+
+def _get_client() -> "Client":
+    """Get the lightkube client of the process, creating it on the first call.
+
+    Creating a client reads the service account token and CA, and opens a new connection
+    to the API server, so a single client is reused.
+
+    Returns:
+        Client: The lightkube client.
+    """
+    global _client
+    if _client is None:
+        from lightkube import Client
+
+        _client = Client()
+    return _client
+
+
+class ServicePatch(Object):
+    """Patch of the Kubernetes Service created by Juju, with traffic routing options."""
+
+    def __init__(
+        self,
+        charm: CharmBase,
+        ports: Sequence["PortDefinition"],
+        internal_traffic_policy: Optional[InternalTrafficPolicy] = None,
+        topology_aware_hints: Optional[bool] = None,
+        session_affinity: Optional[SessionAffinity] = None,
+        session_affinity_timeout: Optional[int] = None,
+    ):
+        """Constructor for ServicePatch.
+
+        Args:
+            charm: the charm that is instantiating the patch.
+            ports: a list of tuples (name, port, targetPort, nodePort) for every service port.
+            internal_traffic_policy: "Local" to route the traffic originated in the cluster only
+                to endpoints in the node of the client. If none given, it is not patched.
+            topology_aware_hints: enable (or disable) topology aware routing, which prefers the
+                endpoints in the zone of the client. If none given, it is not patched.
+            session_affinity: "ClientIP" to stick the connections of a client to the same
+                endpoint. If none given, it is not patched.
+            session_affinity_timeout: seconds a "ClientIP" session affinity is kept. If none
+                given, the Kubernetes default is used.
+        """
+        super().__init__(charm, "kubernetes-service-patch")
+        self.charm = charm
+        self.ports = ports
+        self.internal_traffic_policy = internal_traffic_policy
+        self.topology_aware_hints = topology_aware_hints
+        self.session_affinity = session_affinity
+        self.session_affinity_timeout = session_affinity_timeout
+        self._service: Optional["Service"] = None
+
+        self.framework.observe(charm.on.install, self._on_patch_event)
+        self.framework.observe(charm.on.upgrade_charm, self._on_patch_event)
+
+    @property
+    def service(self) -> "Service":
+        """Representation of the patched Service, built on first use."""
+        if self._service is None:
+            self._service = self._service_object()
+        return self._service
+
+    def patch(self) -> None:
+        """Patch the Kubernetes Service, if this unit is the leader and the Service differs."""
+        if not self.charm.unit.is_leader():
+            return
+
+        from lightkube import ApiError
+        from lightkube.resources.core_v1 import Service
+        from lightkube.types import PatchType
+
+        client = _get_client()
+        try:
+            live_service = client.get(Service, name=self._app, namespace=self._namespace)
+            if self._service_matches(live_service):
+                logger.debug("Kubernetes service '%s' already patched", self._app)
+                return
+            patch = self.service.to_dict()
+            if self.service.spec.sessionAffinity == "None":
+                # A merge patch only removes the fields set to null, and the config of a
+                # previous "ClientIP" session affinity would be left behind
+                patch["spec"]["sessionAffinityConfig"] = None
+            client.patch(Service, self._app, patch, patch_type=PatchType.MERGE)
+        except ApiError as e:
+            if e.status.code == 403:
+                logger.error("Kubernetes service patch failed: `juju trust` this application.")
+            else:
+                logger.error("Kubernetes service patch failed: %s", str(e))
+        else:
+            logger.info("Kubernetes service '%s' patched successfully", self._app)
+
+    def _on_patch_event(self, _) -> None:
+        """Patch the Kubernetes Service in the `install` and `upgrade-charm` events."""
+        self.patch()
+
+    def _service_object(self) -> "Service":
+        """Create the representation of the Service, with the traffic routing options.
+
+        The Service with the ports is created by the KubernetesServicePatch library.
+
+        Returns:
+            Service: A valid representation of a Kubernetes Service.
+        """
+        from charms.observability_libs.v0.kubernetes_service_patch import (
+            KubernetesServicePatch,
+        )
+        from lightkube.models.core_v1 import ClientIPConfig, SessionAffinityConfig
+
+        service = KubernetesServicePatch._service_object(self, self.ports)
+        if self.topology_aware_hints is not None:
+            service.metadata.annotations = {
+                TOPOLOGY_AWARE_HINTS_ANNOTATION: (
+                    "auto" if self.topology_aware_hints else "disabled"
+                ),
+                TOPOLOGY_MODE_ANNOTATION: "Auto" if self.topology_aware_hints else "Disabled",
+            }
+        service.spec.internalTrafficPolicy = self.internal_traffic_policy
+        service.spec.sessionAffinity = self.session_affinity
+        if self.session_affinity == "ClientIP":
+            service.spec.sessionAffinityConfig = SessionAffinityConfig(
+                clientIP=ClientIPConfig(
+                    timeoutSeconds=self.session_affinity_timeout
+                    or DEFAULT_SESSION_AFFINITY_TIMEOUT
+                )
+            )
+        return service
+
+    def _service_matches(self, service: "Service") -> bool:
+        """Reports if a service already has everything the MERGE patch would set.
+
+        Args:
+            service: the live service fetched from the cluster.
+
+        Returns:
+            bool: True if patching the service would not change it.
+        """
+        expected, live = self.service.spec, service.spec
+        if live is None:
+            return False
+        expected_ports, live_ports = expected.ports, live.ports or []
+        if len(expected_ports) != len(live_ports):
+            return False
+        for expected_port, live_port in zip(expected_ports, live_ports):
+            if (expected_port.name, expected_port.port, expected_port.targetPort) != (
+                live_port.name,
+                live_port.port,
+                live_port.targetPort,
+            ) or expected_port.nodePort not in (None, live_port.nodePort):
+                return False
+        expected_annotations = self.service.metadata.annotations or {}
+        live_annotations = (service.metadata.annotations if service.metadata else None) or {}
+        return (
+            expected.type == live.type
+            and expected.selector.items() <= (live.selector or {}).items()
+            and expected_annotations.items() <= live_annotations.items()
+            and expected.internalTrafficPolicy in (None, live.internalTrafficPolicy)
+            and expected.sessionAffinity in (None, live.sessionAffinity)
+            and (
+                expected.sessionAffinity is None
+                or expected.sessionAffinityConfig == live.sessionAffinityConfig
+            )
+        )
+
+    @property
+    def _app(self) -> str:
+        """Name of the current Juju application."""
+        return self.charm.app.name
+
+    @property
+    def _namespace(self) -> str:
+        """The Kubernetes namespace we're running in."""
+        with open("/var/run/secrets/kubernetes.io/serviceaccount/namespace", "r") as f:
+            return f.read().strip()
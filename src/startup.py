@@ -0,0 +1,263 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Startup timeline module.
+
+This module measures where the time goes between the hook that (re)starts keystone and keystone
+serving requests. The charm and the entrypoint of the workload write timestamped markers in a
+timeline file in the container, each marker starting a phase of the startup:
+
+- charm: the hook that restarts keystone, until the service is replanned.
+- replan: Pebble (re)starting the service, until the entrypoint runs.
+- entrypoint, db-wait, db-sync, key-setup, bootstrap, apache-start: the steps of the entrypoint.
+  The markers are added to the entrypoint before the first line of each step, and a step that
+  is not found is merged into the previous phase.
+- api-wait: the wait until the keystone API answers.
+- serving: keystone serves requests, the end of the startup.
+
+The charm reads the timeline back once the startup is complete, logs the duration of every
+phase, and keeps the last startups in its stored state. A phase that takes much longer than in
+the previous startups is flagged as a regression.
+
+```python
+# ...
+from startup import StartupTimeline
+
+class SomeCharm(CharmBase):
+  def __init__(self, *args):
+    # ...
+    self.startup = StartupTimeline(self, self.unit.get_container("some-container"))
+
+  def _restart(self):
+    self.startup.restarting()
+    # ...
+
+  def _on_update_status(self, _):
+    self.startup.collect()
+```
+"""
+
+import logging
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+from ops import pebble
+from ops.charm import CharmBase
+from ops.framework import Object, StoredState
+from ops.model import Container
+
+logger = logging.getLogger(__name__)
+
+TIMELINE_FILE = "/tmp/keystone-startup/timeline"
+START_MARKER = "entrypoint"
+END_MARKER = "serving"
+# Steps of the entrypoint, by the first line of each step
+ENTRYPOINT_STEPS = [
+    ("db-wait", re.compile(r"^\s*wait_db\b")),
+    ("db-sync", re.compile(r"keystone-manage\s+db_sync")),
+    ("key-setup", re.compile(r"keystone-manage\s+fernet_setup")),
+    ("bootstrap", re.compile(r"keystone-manage\s+bootstrap")),
+    ("apache-start", re.compile(r"^\s*(service\s+apache2|apache2ctl)\b")),
+]
+# Endings of a line continued in the next one, where a marker cannot be inserted
+LINE_CONTINUATIONS = ("\\", "&&", "||", "|")
+HISTORY_LENGTH = 5
+# A phase regresses if it takes this many times its median duration in the previous startups...
+REGRESSION_FACTOR = 2
+# ... and at least this many seconds more
+REGRESSION_MIN_SECONDS = 10
+
+
+def marker_command(marker: str) -> str:
+    """Shell command appending a marker to the timeline. It never fails."""
+    return f'{{ echo "{marker} $(date +%s.%N)" >> {TIMELINE_FILE}; }} 2>/dev/null || true'
+
+
+def instrument_entrypoint(script: str) -> str:
+    """Add the markers of the entrypoint steps to the entrypoint script.
+
+    Args:
+        script: entrypoint script.
+
+    Returns:
+        str: The entrypoint script with the markers.
+    """
+    lines = script.splitlines()
+    steps = list(ENTRYPOINT_STEPS)
+    instrumented: List[str] = []
+    for line in lines:
+        previous_line = instrumented[-1].rstrip() if instrumented else ""
+        for step in steps:
+            marker, regex = step
+            if regex.search(line) and not previous_line.endswith(LINE_CONTINUATIONS):
+                indentation = line[: len(line) - len(line.lstrip())]
+                instrumented.append(f"{indentation}{marker_command(marker)}")
+                steps.remove(step)
+                break
+        instrumented.append(line)
+    start = [marker_command(START_MARKER)]
+    if instrumented and instrumented[0].startswith("#!"):
+        instrumented = instrumented[:1] + start + instrumented[1:]
+    else:
+        instrumented = start + instrumented
+    return "\n".join(instrumented) + "\n"
+
+
+def parse_timeline(content: str) -> List[Tuple[str, float]]:
+    """Parse the markers of a timeline.
+
+    Args:
+        content: content of the timeline file.
+
+    Returns:
+        List[Tuple[str, float]]: The markers and their timestamps. Malformed lines are skipped.
+    """
+    markers = []
+    for line in content.splitlines():
+        try:
+            marker, timestamp = line.split()
+            markers.append((marker, float(timestamp)))
+        except ValueError:
+            continue
+    return markers
+
+
+def last_startup(markers: List[Tuple[str, float]]) -> List[Tuple[str, float]]:
+    """Get the markers of the last startup of a timeline.
+
+    The entrypoint may have run more than once since the charm restarted keystone, e.g. if
+    Pebble restarted it after a failure: the markers of the charm only belong to the first run.
+
+    Args:
+        markers: markers of the timeline.
+
+    Returns:
+        List[Tuple[str, float]]: The markers of the last startup.
+    """
+    starts = [index for index, (marker, _) in enumerate(markers) if marker == START_MARKER]
+    if not starts:
+        return []
+    last_start = starts[-1]
+    return markers[last_start:] if len(starts) > 1 else markers
+
+
+def phase_durations(markers: List[Tuple[str, float]]) -> Dict[str, float]:
+    """Get the duration of every phase, from its marker until the next one.
+
+    Args:
+        markers: markers of a startup.
+
+    Returns:
+        Dict[str, float]: Duration of each phase, in seconds.
+    """
+    return {
+        marker: round(next_timestamp - timestamp, 3)
+        for (marker, timestamp), (_, next_timestamp) in zip(markers, markers[1:])
+    }
+
+
+def find_regressions(phases: Dict[str, float], history: List[Dict]) -> List[str]:
+    """Find the phases that take much longer than in the previous startups.
+
+    Args:
+        phases: duration of each phase of the startup.
+        history: previous startups.
+
+    Returns:
+        List[str]: The phases that regressed.
+    """
+    # Only imported when a startup is collected
+    import statistics
+
+    regressions = []
+    for phase, duration in phases.items():
+        previous = [startup["phases"][phase] for startup in history if phase in startup["phases"]]
+        if not previous:
+            continue
+        baseline = statistics.median(previous)
+        if (
+            duration > REGRESSION_FACTOR * baseline
+            and duration - baseline > REGRESSION_MIN_SECONDS
+        ):
+            regressions.append(phase)
+    return regressions
+
+
+class StartupTimeline(Object):
+    """Timeline of the startups of the workload."""
+
+    _stored = StoredState()
+
+    def __init__(self, charm: CharmBase, container: Container):
+        """Constructor for StartupTimeline.
+
+        Args:
+            charm: the charm.
+            container: workload container, where the timeline file is written.
+        """
+        super().__init__(charm, "startup-timeline")
+        self._stored.set_default(history=[], pending=False)
+        self.container = container
+        self.hook_start = time.time()
+
+    @property
+    def last(self) -> Optional[Dict]:
+        """The last recorded startup, if any."""
+        return _copy(self._stored.history[-1]) if self._stored.history else None
+
+    @property
+    def pending(self) -> bool:
+        """Whether the workload has been restarted, and its startup has not been recorded yet."""
+        return self._stored.pending
+
+    def restarting(self) -> None:
+        """Start a new timeline, with the markers of the charm, before restarting the workload."""
+        content = f"charm {self.hook_start:.6f}\nreplan {time.time():.6f}\n"
+        self.container.push(TIMELINE_FILE, content, make_dirs=True)
+        self._stored.pending = True
+
+    def collect(self) -> Optional[Dict]:
+        """Record the startup, if the workload has started since it was restarted.
+
+        Returns:
+            Optional[Dict]: The recorded startup, or None if the startup is not complete.
+        """
+        if not self._stored.pending:
+            return None
+        try:
+            markers = last_startup(parse_timeline(self.container.pull(TIMELINE_FILE).read()))
+        except pebble.PathError:
+            markers = []
+        if not markers or markers[-1][0] != END_MARKER:
+            logger.debug("keystone startup not complete yet")
+            return None
+        history = [_copy(startup) for startup in self._stored.history]
+        phases = phase_durations(markers)
+        startup = {
+            "started": markers[0][1],
+            "duration": round(markers[-1][1] - markers[0][1], 3),
+            "phases": phases,
+            "regressions": find_regressions(phases, history),
+        }
+        self._stored.history = (history + [startup])[-HISTORY_LENGTH:]
+        self._stored.pending = False
+        logger.info(
+            f"Keystone started in {startup['duration']:.1f} seconds: "
+            + ", ".join(f"{phase} {duration:.1f}s" for phase, duration in phases.items())
+        )
+        for phase in startup["regressions"]:
+            logger.warning(
+                f"Keystone startup phase {phase} regressed: {phases[phase]:.1f} seconds"
+            )
+        return startup
+
+
+def _copy(startup) -> Dict:
+    """Copy a startup out of the stored state."""
+    return {
+        "started": startup["started"],
+        "duration": startup["duration"],
+        "phases": dict(startup["phases"]),
+        "regressions": list(startup["regressions"]),
+    }
@@ -0,0 +1,258 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Kubernetes StatefulSet patch module.
+
+This module patches the StatefulSet created by Juju for the application, in the same way the
+KubernetesServicePatch library patches the Service. It sets the resource requests and limits of
+a workload container, and spreads the pods of the application across the nodes. It can also set
+a preStop hook in the workload container, and the termination grace period of the pods, so the
+workload drains its connections before it is stopped.
+
+```python
+# ...
+from statefulset_patch import KubernetesStatefulSetPatch
+
+class SomeCharm(CharmBase):
+  def __init__(self, *args):
+    # ...
+    self.statefulset_patch = KubernetesStatefulSetPatch(
+        self,
+        "some-container",
+        requests={"cpu": "500m", "memory": "512Mi"},
+        limits={"memory": "1Gi"},
+        spread="soft",
+        pre_stop=["/drain.sh"],
+        termination_grace_period=60,
+        refresh_event=self.on.config_changed,
+    )
+    # ...
+```
+
+The patch is applied by the leader in the `install` and `upgrade-charm` events, and in the
+refresh events. Note that Kubernetes restarts the pods of the application after any change in
+the pod template.
+"""
+
+import logging
+from typing import TYPE_CHECKING, Dict, List, Literal, Optional, Union
+
+from ops.charm import CharmBase
+from ops.framework import BoundEvent, Object
+
+from service_patch import _get_client
+
+# lightkube is imported lazily, only in the hooks that patch the StatefulSet
+if TYPE_CHECKING:  # pragma: no cover
+    from lightkube import Client
+    from lightkube.models.core_v1 import TopologySpreadConstraint
+    from lightkube.resources.apps_v1 import StatefulSet
+
+logger = logging.getLogger(__name__)
+
+PodSpread = Literal["none", "soft", "hard"]
+
+WHEN_UNSATISFIABLE = {"soft": "ScheduleAnyway", "hard": "DoNotSchedule"}
+
+
+def _same_quantities(live: Dict[str, str], expected: Dict[str, str]) -> bool:
+    """Reports if the live resources have the same quantities as the expected ones.
+
+    Kubernetes normalizes the quantities it stores (e.g. "1000m" to "1", "1024Mi" to "1Gi"),
+    so the quantities are compared by value.
+
+    Args:
+        live: resources of the container in the cluster.
+        expected: configured resources.
+
+    Returns:
+        bool: True if the resources are the same.
+    """
+    from lightkube.utils.quantity import parse_quantity
+
+    if live.keys() != expected.keys():
+        return False
+    try:
+        return all(parse_quantity(live[k]) == parse_quantity(expected[k]) for k in expected)
+    except ValueError:
+        # Invalid quantities are rejected by Kubernetes when patched
+        return live == expected
+
+
+class KubernetesStatefulSetPatch(Object):
+    """A utility for patching the Kubernetes StatefulSet set up by Juju."""
+
+    def __init__(
+        self,
+        charm: CharmBase,
+        container_name: str,
+        requests: Optional[Dict[str, str]] = None,
+        limits: Optional[Dict[str, str]] = None,
+        spread: PodSpread = "none",
+        topology_key: str = "kubernetes.io/hostname",
+        pre_stop: Optional[List[str]] = None,
+        termination_grace_period: Optional[int] = None,
+        refresh_event: Optional[Union[BoundEvent, List[BoundEvent]]] = None,
+        client: Optional["Client"] = None,
+    ):
+        """Constructor for KubernetesStatefulSetPatch.
+
+        Args:
+            charm: the charm that is instantiating the patch.
+            container_name: name of the container to set the resources to.
+            requests: resource requests of the container (e.g. {"cpu": "500m"}).
+            limits: resource limits of the container (e.g. {"memory": "1Gi"}).
+            spread: "soft" or "hard" to spread the pods across the topology domains, preferably
+                or mandatorily. "none" to not spread them.
+            topology_key: node label that defines the topology domains.
+            pre_stop: command run in the container before it is stopped. If none given, the
+                container has no preStop hook.
+            termination_grace_period: time, in seconds, given to the pods to stop, including
+                the preStop hook. If none given, the termination grace period is not patched.
+            refresh_event: an optional bound event or list of bound events which
+                will be observed to re-apply the patch (e.g. on config-changed).
+            client: lightkube client. If none given, the client of the process is used.
+        """
+        super().__init__(charm, "kubernetes-statefulset-patch")
+        self.charm = charm
+        self.container_name = container_name
+        self.requests = {k: v for k, v in (requests or {}).items() if v}
+        self.limits = {k: v for k, v in (limits or {}).items() if v}
+        self.spread = spread
+        self.topology_key = topology_key
+        self.pre_stop = pre_stop or None
+        self.termination_grace_period = termination_grace_period or None
+        self._client = client
+
+        self.framework.observe(charm.on.install, self._patch)
+        self.framework.observe(charm.on.upgrade_charm, self._patch)
+        if refresh_event:
+            if not isinstance(refresh_event, list):
+                refresh_event = [refresh_event]
+            for evt in refresh_event:
+                self.framework.observe(evt, self._patch)
+
+    @property
+    def client(self) -> "Client":
+        """Lightkube client."""
+        return self._client or _get_client()
+
+    @property
+    def topology_spread_constraints(self) -> List["TopologySpreadConstraint"]:
+        """Topology spread constraints of the pods."""
+        from lightkube.models.core_v1 import TopologySpreadConstraint
+        from lightkube.models.meta_v1 import LabelSelector
+
+        if self.spread not in WHEN_UNSATISFIABLE:
+            return []
+        return [
+            TopologySpreadConstraint(
+                maxSkew=1,
+                topologyKey=self.topology_key,
+                whenUnsatisfiable=WHEN_UNSATISFIABLE[self.spread],
+                labelSelector=LabelSelector(matchLabels={"app.kubernetes.io/name": self._app}),
+            )
+        ]
+
+    def _patch(self, _) -> None:
+        """Patch the Kubernetes StatefulSet created by Juju."""
+        if not self.charm.unit.is_leader():
+            return
+
+        from lightkube import ApiError
+        from lightkube.resources.apps_v1 import StatefulSet
+        from lightkube.types import PatchType
+
+        try:
+            statefulset = self.client.get(StatefulSet, name=self._app, namespace=self._namespace)
+            if self.is_patched(statefulset):
+                logger.debug("Kubernetes statefulset '%s' already patched", self._app)
+                return
+            self.client.patch(
+                StatefulSet,
+                self._app,
+                self._patch_body(),
+                namespace=self._namespace,
+                patch_type=PatchType.STRATEGIC,
+            )
+        except ApiError as e:
+            if e.status.code == 403:
+                logger.error("Kubernetes statefulset patch failed: `juju trust` this application.")
+            else:
+                logger.error("Kubernetes statefulset patch failed: %s", str(e))
+        else:
+            logger.info("Kubernetes statefulset '%s' patched successfully", self._app)
+
+    def _patch_body(self) -> dict:
+        """Strategic merge patch for the StatefulSet.
+
+        Returns:
+            dict: The patch. Null values remove the resources that are not configured anymore.
+        """
+        patch = {
+            "spec": {
+                "template": {
+                    "spec": {
+                        "containers": [
+                            {
+                                "name": self.container_name,
+                                "resources": {
+                                    "requests": self.requests or None,
+                                    "limits": self.limits or None,
+                                },
+                                "lifecycle": (
+                                    {"preStop": {"exec": {"command": self.pre_stop}}}
+                                    if self.pre_stop
+                                    else None
+                                ),
+                            }
+                        ],
+                        "topologySpreadConstraints": [
+                            c.to_dict() for c in self.topology_spread_constraints
+                        ]
+                        or None,
+                    }
+                }
+            }
+        }
+        if self.termination_grace_period:
+            pod_spec = patch["spec"]["template"]["spec"]
+            pod_spec["terminationGracePeriodSeconds"] = self.termination_grace_period
+        return patch
+
+    def is_patched(self, statefulset: "StatefulSet") -> bool:
+        """Reports if the patch has been applied to the StatefulSet.
+
+        Args:
+            statefulset: the StatefulSet fetched from the cluster.
+
+        Returns:
+            bool: A boolean indicating if the patch has been applied.
+        """
+        pod_spec = statefulset.spec.template.spec
+        container = next((c for c in pod_spec.containers if c.name == self.container_name), None)
+        if container is None:
+            return False
+        resources = container.resources
+        requests = (resources.requests if resources else None) or {}
+        limits = (resources.limits if resources else None) or {}
+        lifecycle = container.lifecycle
+        pre_stop = lifecycle.preStop.exec.command if lifecycle and lifecycle.preStop else None
+        return (
+            _same_quantities(requests, self.requests)
+            and _same_quantities(limits, self.limits)
+            and (pod_spec.topologySpreadConstraints or []) == self.topology_spread_constraints
+            and pre_stop == self.pre_stop
+            and self.termination_grace_period in (None, pod_spec.terminationGracePeriodSeconds)
+        )
+
+    @property
+    def _app(self) -> str:
+        """Name of the current Juju application."""
+        return self.charm.app.name
+
+    @property
+    def _namespace(self) -> str:
+        """The Kubernetes namespace we're running in."""
+        with open("/var/run/secrets/kubernetes.io/serviceaccount/namespace", "r") as f:
+            return f.read().strip()
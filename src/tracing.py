@@ -0,0 +1,208 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Charm tracing module.
+
+This module traces the hooks of the charm with OpenTelemetry. Every hook is a trace, with a
+root span named after the hook, a span for every method decorated with `traced`, and a span for
+every Pebble call to the workload container.
+
+The traces are exported to an OTLP/HTTP endpoint (e.g. `http://tempo:4318/v1/traces`), or
+appended as JSON lines to a local file (e.g. `file:///var/log/charm-traces.jsonl`). Tracing is
+disabled if no endpoint is set, and opentelemetry is only imported if it is enabled.
+
+opentelemetry is an optional dependency: tracing requires the `opentelemetry-sdk` package, and
+the `opentelemetry-exporter-otlp-proto-http` package for OTLP/HTTP endpoints. If they are not
+installed, tracing is disabled with a warning.
+
+```python
+# ...
+from tracing import Tracing, traced
+
+class SomeCharm(CharmBase):
+  def __init__(self, *args):
+    # ...
+    self.container = InstrumentedContainer(self.unit.get_container("some-container"))
+    self.tracing = Tracing(self, self.config.get("tracing-endpoint"), self.container)
+
+  @traced
+  def _some_method(self):
+    # ...
+```
+
+The trace context can be propagated to other units (e.g. in the peer relation data) with
+`inject`, and the spans of the other units linked to it with `link`.
+"""
+
+import contextlib
+import functools
+import logging
+import threading
+from typing import TYPE_CHECKING, ContextManager, Dict, Iterator, Optional
+
+from ops.charm import CharmBase
+from ops.framework import Object
+
+from metrics import InstrumentedContainer, hook_name
+
+if TYPE_CHECKING:  # pragma: no cover
+    from opentelemetry.trace import Span
+
+logger = logging.getLogger(__name__)
+
+FILE_SCHEME = "file://"
+# Time given to export the spans at the end of the hook, in seconds
+EXPORT_TIMEOUT = 5
+
+
+def traced(method):
+    """Decorator tracing a method of the charm, in a span named after the method."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.tracing.span(method.__name__):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class Tracing(Object):
+    """Tracing of the charm hooks."""
+
+    def __init__(
+        self, charm: CharmBase, endpoint: Optional[str], container: InstrumentedContainer
+    ):
+        """Constructor for Tracing.
+
+        Args:
+            charm: the charm.
+            endpoint: OTLP/HTTP endpoint, or `file://` path, of the traces. If none given,
+                tracing is disabled.
+            container: workload container, whose Pebble calls are traced.
+        """
+        super().__init__(charm, "tracing")
+        self._tracer = None
+        self._traces_file = None
+        if not endpoint:
+            return
+        try:
+            self._setup(charm, endpoint)
+        except ImportError:
+            logger.warning("opentelemetry is not installed, tracing is disabled")
+            return
+        container.instruments.append(self._trace_pebble)
+        self.framework.observe(self.framework.on.commit, self._on_commit)
+
+    @property
+    def enabled(self) -> bool:
+        """Whether tracing is enabled."""
+        return self._tracer is not None
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Optional["Span"]]:
+        """Trace a block of code in a span.
+
+        Args:
+            name: name of the span.
+            attributes: attributes of the span.
+
+        Yields:
+            Optional[Span]: The span, or None if tracing is disabled.
+        """
+        if not self.enabled:
+            yield None
+            return
+        with self._tracer.start_as_current_span(name, attributes=attributes) as span:
+            yield span
+
+    def inject(self) -> Dict[str, str]:
+        """Get the context of the current span, to propagate it.
+
+        Returns:
+            Dict[str, str]: The W3C trace context (traceparent), or empty if tracing is disabled.
+        """
+        if not self.enabled:
+            return {}
+        from opentelemetry.trace.propagation.tracecontext import (
+            TraceContextTextMapPropagator,
+        )
+
+        carrier: Dict[str, str] = {}
+        TraceContextTextMapPropagator().inject(carrier)
+        return carrier
+
+    def link(self, carrier: Optional[Dict[str, str]], **attributes) -> None:
+        """Link the current span to a propagated span context.
+
+        Args:
+            carrier: the propagated trace context (see `inject`).
+            attributes: attributes of the link.
+        """
+        if not self.enabled or not carrier:
+            return
+        from opentelemetry import trace
+        from opentelemetry.trace.propagation.tracecontext import (
+            TraceContextTextMapPropagator,
+        )
+
+        context = TraceContextTextMapPropagator().extract(carrier)
+        span_context = trace.get_current_span(context).get_span_context()
+        if span_context.is_valid:
+            trace.get_current_span().add_link(span_context, attributes)
+
+    def _setup(self, charm: CharmBase, endpoint: str) -> None:
+        """Set up the tracer, and start the root span of the hook."""
+        from opentelemetry import context, trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import (
+            BatchSpanProcessor,
+            ConsoleSpanExporter,
+        )
+
+        if endpoint.startswith(FILE_SCHEME):
+            self._traces_file = open(endpoint.partition(FILE_SCHEME)[2], "a")
+            exporter = ConsoleSpanExporter(
+                out=self._traces_file,
+                formatter=lambda span: span.to_json(indent=None) + "\n",
+            )
+        else:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+                OTLPSpanExporter,
+            )
+
+            exporter = OTLPSpanExporter(endpoint=endpoint, timeout=EXPORT_TIMEOUT)
+        self._provider = TracerProvider(
+            resource=Resource.create(
+                {
+                    "service.name": charm.app.name,
+                    "service.instance.id": charm.unit.name,
+                    "juju.model": charm.model.name,
+                }
+            )
+        )
+        self._provider.add_span_processor(BatchSpanProcessor(exporter))
+        self._tracer = self._provider.get_tracer(__name__)
+        self._root_span = self._tracer.start_span(hook_name())
+        self._context_token = context.attach(trace.set_span_in_context(self._root_span))
+
+    def _trace_pebble(self, method: str) -> ContextManager[Optional["Span"]]:
+        return self.span(f"pebble.{method}")
+
+    def _on_commit(self, _) -> None:
+        """End the root span of the hook, and export the traces.
+
+        The export is bounded by EXPORT_TIMEOUT, so an unreachable endpoint does not block the
+        hook. The spans not exported by then are dropped.
+        """
+        from opentelemetry import context
+
+        self._root_span.end()
+        context.detach(self._context_token)
+        shutdown = threading.Thread(target=self._provider.shutdown, daemon=True)
+        shutdown.start()
+        shutdown.join(EXPORT_TIMEOUT)
+        if shutdown.is_alive():
+            logger.warning("Traces not exported in %s seconds, dropping them", EXPORT_TIMEOUT)
+        elif self._traces_file:
+            self._traces_file.close()
@@ -0,0 +1,167 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Workload logging module.
+
+This module renders the logging configuration of the keystone container:
+
+- The verbosity of keystone, in a drop-in of keystone.conf, and of apache. Both are read again
+  by a graceful reload of apache, so keystone does not need to be restarted.
+- The access logs of the keystone virtual hosts, which are commented out when disabled. The
+  access logs are buffered by apache, so the requests do not wait for a write each.
+- The request log read by the metrics exporter: the status code and the duration of every
+  request, buffered as well. It is written whether the access logs are enabled or not.
+- The Pebble layer forwarding the workload logs to Loki. The log files are followed by a Pebble
+  service, and Pebble ships its output in batches: the requests never wait for the shipping.
+"""
+
+import re
+from typing import Dict, List
+
+import yaml
+
+KEYSTONE_LOGGING_CONFIG = "/etc/keystone/keystone.conf.d/charm-logging.conf"
+APACHE_LOGGING_CONFIG = "/etc/apache2/conf-enabled/charm-logging.conf"
+APACHE_SITES_FOLDER = "/etc/apache2/sites-enabled/"
+LOG_FORWARDER_SERVICE = "log-forwarder"
+LOG_FILES = ["/var/log/apache2/*.log", "/var/log/keystone/*.log"]
+# Read by the metrics exporter, and not forwarded to Loki
+REQUEST_LOG = "/var/log/apache2/keystone-requests.metrics"
+
+# Apache names of the log levels
+LOG_LEVELS = {"debug": "debug", "info": "info", "warning": "warn", "error": "error"}
+# Levels of the noisy libraries set by oslo.log, which are replaced by default_log_levels
+OSLO_DEFAULT_LOG_LEVELS = [
+    "amqp=WARN",
+    "amqplib=WARN",
+    "boto=WARN",
+    "qpid=WARN",
+    "sqlalchemy=WARN",
+    "suds=INFO",
+    "oslo.messaging=INFO",
+    "oslo_messaging=INFO",
+    "iso8601=WARN",
+    "requests.packages.urllib3.connectionpool=WARN",
+    "urllib3.connectionpool=WARN",
+    "websocket=WARN",
+    "requests.packages.urllib3.util.retry=WARN",
+    "urllib3.util.retry=WARN",
+    "keystonemiddleware=WARN",
+    "routes.middleware=WARN",
+    "stevedore=WARN",
+    "taskflow=WARN",
+    "keystoneauth=WARN",
+    "oslo.cache=INFO",
+    "oslo_policy=INFO",
+    "dogpile.core.dogpile=INFO",
+]
+DISABLED_ACCESS_LOG = "# Disabled by the charm: "
+ACCESS_LOG_REGEX = re.compile(r"^(\s*)(CustomLog\s.*)$", re.MULTILINE)
+DISABLED_ACCESS_LOG_REGEX = re.compile(
+    rf"^(\s*){re.escape(DISABLED_ACCESS_LOG)}(CustomLog\s.*)$", re.MULTILINE
+)
+
+
+def keystone_logging_config(level: str) -> str:
+    """Render the drop-in of keystone.conf with the log level.
+
+    Args:
+        level: log level, one of LOG_LEVELS.
+
+    Returns:
+        str: The configuration file.
+    """
+    lines = ["[DEFAULT]", f"debug = {level == 'debug'}"]
+    if level not in ("debug", "info"):
+        lines.append(
+            "default_log_levels = "
+            + ",".join(OSLO_DEFAULT_LOG_LEVELS + [f"keystone={level.upper()}"])
+        )
+    return "\n".join(lines) + "\n"
+
+
+def apache_logging_config(level: str) -> str:
+    """Render the apache configuration file with the log level and the request log.
+
+    Args:
+        level: log level, one of LOG_LEVELS.
+
+    Returns:
+        str: The configuration file.
+    """
+    lines = [
+        f"LogLevel {LOG_LEVELS[level]}",
+        # The log entries are written when the buffer is full, not in every request
+        "BufferedLogs On",
+        'LogFormat "%>s %D" keystone-requests',
+        f"GlobalLog {REQUEST_LOG} keystone-requests",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def toggle_access_log(site_config: str, enabled: bool) -> str:
+    """Enable or disable the access logs of an apache site.
+
+    The CustomLog directives are commented out to disable the access logs, and restored to
+    enable them again.
+
+    Args:
+        site_config: configuration file of the site.
+        enabled: whether the access logs are enabled.
+
+    Returns:
+        str: The configuration file of the site.
+    """
+    if enabled:
+        return DISABLED_ACCESS_LOG_REGEX.sub(r"\1\2", site_config)
+    return ACCESS_LOG_REGEX.sub(rf"\1{DISABLED_ACCESS_LOG}\2", site_config)
+
+
+def log_target_name(unit_name: str) -> str:
+    """Name of the Pebble log target of a Loki unit."""
+    return f"loki-{unit_name.replace('/', '-')}"
+
+
+def log_forwarding_layer(
+    endpoints: Dict[str, str], previous_targets: List[str], labels: Dict[str, str]
+) -> str:
+    """Render the Pebble layer forwarding the workload logs to Loki.
+
+    The layer is rendered as YAML, as the log targets are not supported by pebble.Layer.
+
+    Args:
+        endpoints: push API URL of each Loki unit, by unit name.
+        previous_targets: log targets of the previous layer. The targets of the Loki units
+            that are gone stop forwarding the logs.
+        labels: labels of the forwarded logs.
+
+    Returns:
+        str: The Pebble layer.
+    """
+    targets = {
+        log_target_name(unit_name): {
+            "override": "replace",
+            "type": "loki",
+            "location": url,
+            "services": ["all"],
+            "labels": labels,
+        }
+        for unit_name, url in sorted(endpoints.items())
+    }
+    for name in previous_targets:
+        targets.setdefault(name, {"override": "merge", "services": ["-all"]})
+    command = "exec tail -n 0 -q -F " + " ".join(LOG_FILES)
+    layer = {
+        "summary": "keystone logging layer",
+        "description": "pebble config layer forwarding the keystone logs",
+        "services": {
+            LOG_FORWARDER_SERVICE: {
+                "override": "replace",
+                "summary": "follows the keystone log files",
+                "command": f"sh -c '{command}'",
+                "startup": "enabled" if endpoints else "disabled",
+            }
+        },
+        "log-targets": targets,
+    }
+    return yaml.safe_dump(layer)
@@ -0,0 +1,69 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Benchmark of token validation with the key repositories in memory (tmpfs) and on disk.
+
+Keystone loads the whole fernet key repository every time it validates a token, so this
+benchmark loads the repository and decrypts a token in each iteration, as keystone does.
+"""
+
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import pytest
+
+fernet = pytest.importorskip("cryptography.fernet")
+
+logger = logging.getLogger(__name__)
+
+TMPFS_PATH = "/dev/shm"
+# Disk-backed directory: /tmp is a tmpfs in some systems
+DISK_PATH = "/var/tmp"
+VALIDATIONS = 5000
+MAX_ACTIVE_KEYS = 3
+
+
+def _create_key_repository(path: Path) -> str:
+    for key_number in range(MAX_ACTIVE_KEYS):
+        (path / str(key_number)).write_bytes(fernet.Fernet.generate_key())
+    # The primary key has the highest index
+    primary_key = (path / str(MAX_ACTIVE_KEYS - 1)).read_bytes()
+    return fernet.Fernet(primary_key).encrypt(b"token payload")
+
+
+def _read_key(key_path: Path, cold: bool) -> bytes:
+    fd = os.open(key_path, os.O_RDONLY)
+    try:
+        if cold:
+            # Evict the key from the page cache, so it is read from the storage
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        return os.read(fd, 1024)
+    finally:
+        os.close(fd)
+
+
+def _load_keys(path: Path, cold: bool):
+    keys = sorted(os.listdir(path), key=int, reverse=True)
+    return fernet.MultiFernet([fernet.Fernet(_read_key(path / key, cold)) for key in keys])
+
+
+def _validations_per_second(base_path: str, cold: bool) -> float:
+    with tempfile.TemporaryDirectory(dir=base_path) as key_repository:
+        path = Path(key_repository)
+        token = _create_key_repository(path)
+        start = time.perf_counter()
+        for _ in range(VALIDATIONS):
+            _load_keys(path, cold).decrypt(token)
+        return VALIDATIONS / (time.perf_counter() - start)
+
+
+@pytest.mark.skipif(not os.path.isdir(TMPFS_PATH), reason=f"{TMPFS_PATH} not available")
+@pytest.mark.parametrize("cold", [False, True], ids=["page-cache", "cold-cache"])
+def test_key_repository_validation_throughput(cold: bool):
+    tmpfs = _validations_per_second(TMPFS_PATH, cold)
+    disk = _validations_per_second(DISK_PATH, cold)
+    logger.info("validations/s: tmpfs %.0f, disk %.0f (%.2fx)", tmpfs, disk, tmpfs / disk)
+    assert tmpfs > 0 and disk > 0
@@ -39,5 +39,29 @@ async def test_build_and_deploy(ops_test: OpsTest):
     await ops_test.model.set_config({"update-status-hook-interval": "60m"})
 
 
+async def test_overload_fails_fast(ops_test: OpsTest):
+    """Overload keystone beyond the limits of its front end.
+
+    The requests that keystone cannot serve in time must be rejected with fast 503s, instead of
+    waiting until the clients time out (30 seconds in the load generator).
+    """
+    keystone = ops_test.model.applications["keystone"]
+    limits = {"max-concurrent-requests": "2", "listen-backlog": "4", "queue-timeout": "2"}
+    await keystone.set_config(limits)
+    await ops_test.model.wait_for_idle(apps=["keystone"], status="active", timeout=300)
+
+    action = await keystone.units[0].run_action("benchmark", concurrency=50, duration=20)
+    action = await action.wait()
+    assert action.status == "completed"
+    total = action.results["total"]
+    logger.info(f"Overload results: {total}")
+    assert "503" in total["status-codes"]
+    assert "error" not in total["status-codes"]
+    assert float(total["p99-ms"]) < 10000
+
+    await keystone.reset_config(list(limits))
+    await ops_test.model.wait_for_idle(apps=["keystone"], status="active", timeout=300)
+
+
 def base64_encode(phrase: str) -> str:
     return base64.b64encode(phrase.encode("utf-8")).decode("utf-8")
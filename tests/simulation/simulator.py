@@ -0,0 +1,414 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Cluster simulator of the keystone charm.
+
+The simulator runs N units of the charm, each one in its own Harness, sharing a simulated
+`cluster` peer relation. The leader writes the relation application data, and every unit its
+own unit data. The changes are delivered to the rest of the units as cluster-relation-changed
+hooks, as Juju does: a single hook per unit for all the changes of a hook.
+
+The hooks are queued and dispatched one at a time, so the simulator measures:
+
+- The hooks fired, by name.
+- The relation writes: leader hooks that changed the application data, and the changed keys,
+  and hooks that changed the unit data.
+- The Pebble calls of the units.
+- The hooks and the time it takes every unit to hold the key repositories of the leader.
+
+The workload containers are the Harness containers, with a fake `keystone-manage` that
+creates and rotates the key repositories. The background commands finish as soon as they start.
+"""
+
+import contextlib
+import json
+import secrets
+import shlex
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+from unittest import mock
+
+from ops import pebble
+from ops.testing import Harness
+
+from charm import (
+    CREDENTIAL_KEY_REPOSITORY,
+    CREDENTIAL_MIGRATE_SERVICE,
+    FERNET_KEY_REPOSITORY,
+    KEYSTONE_FOLDER,
+    MIN_FERNET_MAX_ACTIVE_KEYS,
+    KeystoneCharm,
+)
+from command_runner import BACKGROUND_STATUS_FOLDER
+
+APP_NAME = "osm-keystone"
+PEER_RELATION = "cluster"
+KEY_REPOSITORY_ENVIRONMENT = {
+    "OS_FERNET_TOKENS__KEY_REPOSITORY": FERNET_KEY_REPOSITORY,
+    "OS_CREDENTIAL__KEY_REPOSITORY": CREDENTIAL_KEY_REPOSITORY,
+}
+
+
+class FakeProcess:
+    """Finished process of the fake exec."""
+
+    def __init__(self, command: List[str], exit_code: int = 0, stderr: str = ""):
+        """Constructor for FakeProcess."""
+        self.command = command
+        self.exit_code = exit_code
+        self.stdout: List[str] = []
+        self.stderr = [stderr] if stderr else []
+        self._stderr = stderr
+
+    def wait(self) -> None:
+        """Wait for the process, raising ExecError if it failed."""
+        if self.exit_code:
+            raise pebble.ExecError(self.command, self.exit_code, "", self._stderr)
+
+
+class FakeKeystoneManage:
+    """Fake `keystone-manage`, creating and rotating the key repositories of a container.
+
+    The background commands (one-shot Pebble services) finish successfully when they start.
+    """
+
+    def __init__(self, client):
+        """Constructor for FakeKeystoneManage.
+
+        Args:
+            client: Pebble client of the container.
+        """
+        self.client = client
+        for method in ("start_services", "restart_services"):
+            setattr(client, method, self._finish_background_commands(getattr(client, method)))
+
+    def exec(self, command: List[str], environment=None, **_) -> FakeProcess:
+        """Run a command, or a `sh -c` batch of commands joined with `&&`."""
+        if command[:2] == ["sh", "-c"]:
+            commands = [shlex.split(part) for part in command[2].split(" && ")]
+        else:
+            commands = [command]
+        for args in commands:
+            if args[:1] != ["keystone-manage"]:
+                continue
+            subcommand = args[1]
+            if subcommand in ("fernet_setup", "credential_setup"):
+                self._setup(self._repository(subcommand, environment))
+            elif subcommand in ("fernet_rotate", "credential_rotate"):
+                self._rotate(self._repository(subcommand, environment))
+        return FakeProcess(command)
+
+    def _finish_background_commands(self, function):
+        def wrapper(services: List[str], *args, **kwargs):
+            for service in services:
+                if service == CREDENTIAL_MIGRATE_SERVICE:
+                    self.client.push(f"{BACKGROUND_STATUS_FOLDER}{service}", "0", make_dirs=True)
+            return function(services, *args, **kwargs)
+
+        return wrapper
+
+    def _repository(self, subcommand: str, environment: Optional[Dict[str, str]]) -> str:
+        env = "OS_CREDENTIAL__KEY_REPOSITORY" if "credential" in subcommand else None
+        env = env or "OS_FERNET_TOKENS__KEY_REPOSITORY"
+        return (environment or {}).get(env, KEY_REPOSITORY_ENVIRONMENT[env])
+
+    def _keys(self, repository: str) -> List[int]:
+        try:
+            return sorted(int(file.name) for file in self.client.list_files(repository))
+        except pebble.APIError:
+            return []
+
+    def _push_key(self, path: str) -> None:
+        self.client.push(path, secrets.token_urlsafe(32), make_dirs=True)
+
+    def _setup(self, repository: str) -> None:
+        if not self._keys(repository):
+            self._push_key(f"{repository}0")
+            self._push_key(f"{repository}1")
+
+    def _rotate(self, repository: str) -> None:
+        """Promote the staged key to primary, create a new staged key and drop the oldest.
+
+        The keys are simulated with the default max_active_keys of keystone.
+        """
+        keys = self._keys(repository)
+        staged_key = self.client.pull(f"{repository}0").read()
+        self.client.push(f"{repository}{keys[-1] + 1}", staged_key)
+        self._push_key(f"{repository}0")
+        secondary_keys = [key for key in keys if key] + [keys[-1] + 1]
+        for key in secondary_keys[: -(MIN_FERNET_MAX_ACTIVE_KEYS - 1)]:
+            self.client.remove_path(f"{repository}{key}")
+
+
+@dataclass
+class Measurement:
+    """Measurement of a scenario of the simulation."""
+
+    hooks: Counter = field(default_factory=Counter)
+    relation_writes: int = 0
+    relation_keys_written: int = 0
+    unit_relation_writes: int = 0
+    pebble_calls: int = 0
+    # Hooks dispatched, and seconds elapsed, until every unit held the keys of the leader
+    # for the last time. None if the units have not converged.
+    convergence_hooks: Optional[int] = None
+    convergence_seconds: Optional[float] = None
+
+    @property
+    def total_hooks(self) -> int:
+        """Total hooks fired."""
+        return sum(self.hooks.values())
+
+
+class ClusterSimulator:
+    """Simulation of the units of the charm sharing the cluster peer relation."""
+
+    def __init__(self, config: Optional[Dict[str, object]] = None):
+        """Constructor for ClusterSimulator.
+
+        Args:
+            config: charm config of all the units.
+        """
+        # The warm-up and the scheduled maintenance are out of the scope of the simulation
+        self.config = {"warm-up-requests": 0, "maintenance-interval": 0, **(config or {})}
+        self.units: Dict[str, Harness] = {}
+        self.relation_ids: Dict[str, int] = {}
+        self.leader: Optional[str] = None
+        self.app_data: Dict[str, str] = {}
+        self.unit_data: Dict[str, Dict[str, str]] = {}
+        self.queue: Deque[Tuple[str, str, Callable[[], None]]] = deque()
+        self.measurement = Measurement()
+        # The unit of every Harness is osm-keystone/0: the simulated units are numbered from 1,
+        # so they do not collide with it as remote units of the peer relation
+        self._next_unit = 1
+        self._patches = [
+            mock.patch("charm.ServicePatch"),
+            mock.patch("charm.KubernetesStatefulSetPatch"),
+        ]
+        for patch in self._patches:
+            patch.start()
+
+    def cleanup(self) -> None:
+        """Clean up the harnesses and the patches."""
+        for harness in self.units.values():
+            harness.cleanup()
+        for patch in self._patches:
+            patch.stop()
+
+    def deploy(self, units: int) -> Measurement:
+        """Deploy the application, the first unit being the leader."""
+        with self.measure() as measurement:
+            for _ in range(units):
+                self._add_unit()
+            self._set_leader(next(iter(self.units)))
+            for name in list(self.units):
+                if name != self.leader:
+                    self._enqueue(name, "update-status", self.units[name].charm.on.update_status)
+            self.run()
+        return measurement
+
+    def add_units(self, units: int) -> Measurement:
+        """Add units to the application."""
+        with self.measure() as measurement:
+            for _ in range(units):
+                name = self._add_unit()
+                # The new unit joins the peer relation, with the current application data
+                self._enqueue(name, "cluster-relation-changed", self._relation_changed(name, {}))
+            self.run()
+        return measurement
+
+    def rotate(self) -> Measurement:
+        """Make the fernet keys due for rotation, and run update-status in the leader."""
+        with self.measure() as measurement:
+            leader = self.units[self.leader]
+            # Make the last rotation as old as possible, without triggering any hook
+            leader.update_relation_data(
+                self.relation_ids[self.leader], APP_NAME, {"last_rotation": "1"}
+            )
+            self.app_data["last_rotation"] = "1"
+            self._enqueue(self.leader, "update-status", leader.charm.on.update_status)
+            self.run()
+        return measurement
+
+    def rotate_credential_keys(self) -> Measurement:
+        """Run the rotate-credential-keys action in the leader."""
+        with self.measure() as measurement:
+            charm = self.units[self.leader].charm
+            self._enqueue(
+                self.leader,
+                "rotate-credential-keys-action",
+                lambda: charm._on_rotate_credential_keys_action(mock.Mock()),
+            )
+            self.run()
+        return measurement
+
+    def set_leader(self, name: str) -> Measurement:
+        """Move the leadership to a unit."""
+        with self.measure() as measurement:
+            self._set_leader(name)
+            self.run()
+        return measurement
+
+    def update_status(self) -> Measurement:
+        """Run update-status in every unit."""
+        with self.measure() as measurement:
+            for name, harness in self.units.items():
+                self._enqueue(name, "update-status", harness.charm.on.update_status)
+            self.run()
+        return measurement
+
+    def converged(self) -> bool:
+        """Whether every unit holds the key repositories of the leader."""
+        if self.leader is None:
+            return False
+        leader_keys = self.keys(self.leader)
+        return bool(leader_keys) and all(self.keys(name) == leader_keys for name in self.units)
+
+    def keys(self, name: str) -> Dict[str, Dict[str, str]]:
+        """Key repositories in the container of a unit."""
+        client = self.units[name].charm.container.pebble
+        keys = {}
+        for repository in (FERNET_KEY_REPOSITORY, CREDENTIAL_KEY_REPOSITORY):
+            try:
+                files = client.list_files(repository)
+            except pebble.APIError:
+                files = []
+            keys[repository] = {
+                file.name: client.pull(file.path).read() for file in files if file.name.isdigit()
+            }
+        return keys if any(keys.values()) else {}
+
+    def run(self) -> None:
+        """Dispatch the queued hooks, until there are none left."""
+        while self.queue:
+            name, hook, fire = self.queue.popleft()
+            fire()
+            self.measurement.hooks[hook] += 1
+            if name == self.leader:
+                self._distribute()
+            self._distribute_unit_data(name)
+            self._check_convergence()
+
+    @contextlib.contextmanager
+    def measure(self) -> Iterator[Measurement]:
+        """Measure a scenario in a new measurement."""
+        self.measurement = Measurement()
+        self._start = time.monotonic()
+        pebble_calls = self._total_pebble_calls()
+        self._check_convergence()
+        yield self.measurement
+        self.measurement.pebble_calls = self._total_pebble_calls() - pebble_calls
+
+    def _add_unit(self) -> str:
+        name = f"{APP_NAME}/{self._next_unit}"
+        self._next_unit += 1
+        harness = Harness(KeystoneCharm)
+        harness.set_model_name("simulation")
+        harness.update_config(self.config)
+        relation_id = harness.add_relation(PEER_RELATION, APP_NAME)
+        for other in self.units:
+            harness.add_relation_unit(relation_id, other)
+        harness.update_relation_data(relation_id, APP_NAME, self.app_data)
+        for other, data in self.unit_data.items():
+            harness.update_relation_data(relation_id, other, data)
+        harness.begin()
+        container = harness.charm.unit.get_container("keystone")
+        harness.set_can_connect(container, True)
+        container.pebble.make_dir(KEYSTONE_FOLDER, make_parents=True)
+        container.pebble.exec = FakeKeystoneManage(container.pebble).exec
+        # The existing units see the new unit joining the peer relation
+        for other, other_harness in self.units.items():
+            other_harness.add_relation_unit(self.relation_ids[other], name)
+            self.measurement.hooks["cluster-relation-joined"] += 1
+        self.units[name] = harness
+        self.relation_ids[name] = relation_id
+        return name
+
+    def _set_leader(self, name: str) -> None:
+        if self.leader is not None:
+            self.units[self.leader].set_leader(False)
+        self.leader = name
+        self._enqueue(name, "leader-elected", lambda: self.units[name].set_leader(True))
+
+    def _enqueue(self, name: str, hook: str, fire) -> None:
+        self.queue.append((name, hook, fire.emit if hasattr(fire, "emit") else fire))
+
+    def _relation_changed(
+        self, name: str, changes: Dict[str, str], app_or_unit: str = APP_NAME
+    ) -> Callable[[], None]:
+        def fire() -> None:
+            harness = self.units[name]
+            relation_id = self.relation_ids[name]
+            if changes:
+                harness.update_relation_data(relation_id, app_or_unit, changes)
+            else:
+                relation = harness.charm.model.get_relation(PEER_RELATION, relation_id)
+                harness.charm.on[PEER_RELATION].relation_changed.emit(relation, harness.charm.app)
+
+        return fire
+
+    def _distribute(self) -> None:
+        """Deliver the changes of the relation data by the leader to the rest of the units."""
+        harness = self.units[self.leader]
+        data = dict(harness.get_relation_data(self.relation_ids[self.leader], APP_NAME))
+        changes = {key: value for key, value in data.items() if self.app_data.get(key) != value}
+        changes.update({key: "" for key in self.app_data if key not in data})
+        if not changes:
+            return
+        self.app_data = data
+        self.measurement.relation_writes += 1
+        self.measurement.relation_keys_written += len(changes)
+        for name in self.units:
+            if name != self.leader:
+                self._enqueue(
+                    name, "cluster-relation-changed", self._relation_changed(name, changes)
+                )
+
+    def _distribute_unit_data(self, name: str) -> None:
+        """Deliver the changes of the unit data of a unit to the rest of the units."""
+        harness = self.units[name]
+        data = dict(harness.get_relation_data(self.relation_ids[name], harness.charm.unit.name))
+        previous_data = self.unit_data.get(name, {})
+        changes = {key: value for key, value in data.items() if previous_data.get(key) != value}
+        changes.update({key: "" for key in previous_data if key not in data})
+        if not changes:
+            return
+        self.unit_data[name] = data
+        self.measurement.unit_relation_writes += 1
+        for other in self.units:
+            if other != name:
+                self._enqueue(
+                    other, "cluster-relation-changed", self._relation_changed(other, changes, name)
+                )
+
+    def _check_convergence(self) -> None:
+        """Record when the units converge, and forget it if they diverge afterwards."""
+        if not self.converged():
+            self.measurement.convergence_hooks = None
+            self.measurement.convergence_seconds = None
+        elif self.measurement.convergence_hooks is None:
+            self.measurement.convergence_hooks = self.measurement.total_hooks
+            self.measurement.convergence_seconds = round(time.monotonic() - self._start, 3)
+
+    def _total_pebble_calls(self) -> int:
+        return sum(
+            sum(harness.charm.metrics.pebble_calls.values()) for harness in self.units.values()
+        )
+
+
+def report(measurement: Measurement) -> str:
+    """Report a measurement as JSON."""
+    return json.dumps(
+        {
+            "hooks": dict(sorted(measurement.hooks.items())),
+            "total-hooks": measurement.total_hooks,
+            "relation-writes": measurement.relation_writes,
+            "relation-keys-written": measurement.relation_keys_written,
+            "unit-relation-writes": measurement.unit_relation_writes,
+            "pebble-calls": measurement.pebble_calls,
+            "convergence-hooks": measurement.convergence_hooks,
+            "convergence-seconds": measurement.convergence_seconds,
+        }
+    )
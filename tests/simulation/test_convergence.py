@@ -0,0 +1,127 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Convergence of the key distribution in clusters of increasing size.
+
+Every scenario must converge (every unit holds the keys of the leader), with a number of
+relation writes that does not depend on the number of units, and a single
+cluster-relation-changed hook per follower and write: the hooks grow linearly with the units.
+
+The only exception is the rotation of the credential keys: every follower acknowledges the new
+key in its unit data, which fires a hook in every other unit. The acknowledgements are only
+written when the credential key changes, so the other scenarios do not write the unit data.
+
+The number of units can be set with the SIMULATION_UNITS environment variable, e.g.
+`SIMULATION_UNITS=50 tox -e simulation`.
+"""
+
+import json
+import logging
+import os
+
+import pytest
+from simulator import ClusterSimulator, Measurement, report
+
+logger = logging.getLogger(__name__)
+
+UNITS = [int(os.environ["SIMULATION_UNITS"])] if "SIMULATION_UNITS" in os.environ else [1, 5, 20]
+# Leader hooks writing the relation data in a scenario: the keys, then the rotation time
+MAX_RELATION_WRITES = 2
+
+
+@pytest.fixture
+def simulator():
+    simulator = ClusterSimulator()
+    yield simulator
+    simulator.cleanup()
+
+
+def _check(measurement: Measurement, scenario: str, followers: int, new_units: int = 0) -> None:
+    logger.info(f"{scenario} with {followers} followers: {report(measurement)}")
+    assert measurement.convergence_hooks is not None, f"{scenario} did not converge"
+    assert measurement.relation_writes <= MAX_RELATION_WRITES
+    # At most one acknowledgement of the credential keys per follower
+    assert measurement.unit_relation_writes <= followers
+    # Besides the writes, the new units get the relation data when they join
+    assert measurement.hooks["cluster-relation-changed"] <= (
+        measurement.relation_writes * followers
+        + measurement.unit_relation_writes * followers
+        + new_units
+    )
+
+
+@pytest.mark.parametrize("units", UNITS)
+def test_deploy(simulator: ClusterSimulator, units: int):
+    measurement = simulator.deploy(units)
+    _check(measurement, "deploy", units - 1)
+    assert measurement.hooks["leader-elected"] == 1
+    assert simulator.converged()
+
+
+@pytest.mark.parametrize("units", UNITS)
+def test_rotation(simulator: ClusterSimulator, units: int):
+    simulator.deploy(units)
+    keys = simulator.keys(simulator.leader)
+    for _ in range(3):
+        measurement = simulator.rotate()
+        _check(measurement, "rotation", units - 1)
+        assert simulator.converged()
+        assert simulator.keys(simulator.leader) != keys
+        assert measurement.unit_relation_writes == 0
+        keys = simulator.keys(simulator.leader)
+
+
+@pytest.mark.parametrize("units", UNITS)
+def test_leader_change(simulator: ClusterSimulator, units: int):
+    simulator.deploy(units)
+    keys = simulator.keys(simulator.leader)
+    for name in list(simulator.units)[1:]:
+        measurement = simulator.set_leader(name)
+        _check(measurement, "leader change", units - 1)
+        # The new leader takes over the keys, it does not create new ones
+        assert simulator.keys(simulator.leader) == keys
+        assert measurement.unit_relation_writes == 0
+    measurement = simulator.rotate()
+    _check(measurement, "rotation after leader change", units - 1)
+
+
+@pytest.mark.parametrize("units", UNITS)
+def test_add_units(simulator: ClusterSimulator, units: int):
+    simulator.deploy(units)
+    # The migration of the credentials to the initial key finishes
+    simulator.update_status()
+    measurement = simulator.add_units(units)
+    _check(measurement, "unit additions", 2 * units - 1, new_units=units)
+    # The existing units see every new unit joining, and are not notified of any key change
+    assert measurement.relation_writes == 0
+    assert measurement.hooks["cluster-relation-joined"] == sum(range(units, 2 * units))
+    # The new units get the relation data, and acknowledge the credential key to the rest
+    assert measurement.unit_relation_writes == units
+    assert measurement.hooks["cluster-relation-changed"] == units + units * (2 * units - 1)
+
+
+@pytest.mark.parametrize("units", UNITS)
+def test_credential_key_rotation(simulator: ClusterSimulator, units: int):
+    simulator.deploy(units)
+    simulator.update_status()
+    assert json.loads(simulator.app_data["credential_migration"])["state"] == "migrated"
+    keys = simulator.keys(simulator.leader)
+    measurement = simulator.rotate_credential_keys()
+    _check(measurement, "credential key rotation", units - 1)
+    assert simulator.keys(simulator.leader) != keys
+    # Every follower acknowledges the new key once, then the credentials are migrated
+    assert measurement.unit_relation_writes == units - 1
+    # The background migration finishes right away in the simulation
+    assert json.loads(simulator.app_data["credential_migration"])["state"] == "migrated"
+
+
+@pytest.mark.parametrize("units", UNITS)
+def test_steady_state(simulator: ClusterSimulator, units: int):
+    simulator.deploy(units)
+    # The migration of the credentials to the initial key finishes
+    simulator.update_status()
+    measurement = simulator.update_status()
+    # Without rotations, update-status does not write the relation data
+    assert measurement.relation_writes == 0
+    assert measurement.unit_relation_writes == 0
+    assert measurement.total_hooks == units
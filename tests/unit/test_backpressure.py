@@ -0,0 +1,54 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import backpressure
+
+SITE_CONFIG = """\
+<VirtualHost *:5000>
+    WSGIScriptAlias / /usr/bin/keystone-wsgi-public
+    WSGIDaemonProcess keystone-public processes=5 threads=1 user=keystone display-name=%{GROUP}
+    WSGIProcessGroup keystone-public
+</VirtualHost>
+"""
+
+
+def test_daemon_process_directive():
+    directive = "WSGIDaemonProcess keystone-public processes=5 threads=1 user=keystone"
+    assert backpressure.daemon_process_directive(directive, 0, 0, 0, 0) == directive
+    assert backpressure.daemon_process_directive(directive, 12, 20, 5, 60) == (
+        "WSGIDaemonProcess keystone-public processes=5 threads=3 user=keystone"
+        " listen-backlog=20 queue-timeout=5 connect-timeout=5 request-timeout=60"
+    )
+    # Fewer processes than requested concurrency
+    assert backpressure.daemon_process_directive(directive, 2, 0, 0, 0) == (
+        "WSGIDaemonProcess keystone-public processes=2 threads=1 user=keystone"
+    )
+    # mod_wsgi runs a single process by default
+    assert backpressure.daemon_process_directive("WSGIDaemonProcess ks", 8, 0, 0, 0) == (
+        "WSGIDaemonProcess ks processes=1 threads=8"
+    )
+
+
+def test_limit_daemon_processes():
+    assert backpressure.limit_daemon_processes(SITE_CONFIG, 0, 0, 0, 0) == SITE_CONFIG
+    limited = backpressure.limit_daemon_processes(SITE_CONFIG, 10, 0, 5, 0)
+    assert (
+        "    # Original directive, limited by the charm: WSGIDaemonProcess keystone-public"
+        " processes=5 threads=1 user=keystone display-name=%{GROUP}\n"
+        "    WSGIDaemonProcess keystone-public processes=5 threads=2 user=keystone"
+        " display-name=%{GROUP} queue-timeout=5 connect-timeout=5\n"
+    ) in limited
+    assert backpressure.limit_daemon_processes(limited, 10, 0, 5, 0) == limited
+    # The limits are rendered from the original directive
+    relimited = backpressure.limit_daemon_processes(limited, 0, 0, 10, 0)
+    assert relimited.count("WSGIDaemonProcess") == 2
+    assert "threads=1 user=keystone display-name=%{GROUP} queue-timeout=10" in relimited
+    assert backpressure.limit_daemon_processes(relimited, 0, 0, 0, 0) == SITE_CONFIG
+
+
+def test_rate_limit_config():
+    assert backpressure.rate_limit_config(0) == ""
+    config = backpressure.rate_limit_config(20)
+    assert "LoadModule qos_module /usr/lib/apache2/modules/mod_qos.so" in config
+    assert "QS_ClientEventLimitCount 200 10\n" in config
+    assert "QS_ErrorResponseCode 429\n" in config
@@ -1,21 +1,40 @@
 # Copyright 2021 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import io
+import json
+import time
+
 import pytest
+from config_validator import ValidationError
 from ops import pebble
-from ops.model import ActiveStatus, BlockedStatus
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
 from ops.testing import Harness
 from pytest_mock import MockerFixture
 
-from charm import FERNET_KEY_REPOSITORY, KEYSTONE_FOLDER, KeystoneCharm
+from charm import (
+    CREDENTIAL_KEY_REPOSITORY,
+    FERNET_KEY_REPOSITORY,
+    JWS_KEYPAIR_FOLDER,
+    JWS_PRIVATE_KEY_REPOSITORY,
+    JWS_PUBLIC_KEY_REPOSITORY,
+    JWS_STAGED_KEY_REPOSITORY,
+    KEYSTONE_FOLDER,
+    KeystoneCharm,
+)
+from command_runner import CommandRunner
 
 
 @pytest.fixture
 def harness_no_relations(mocker: MockerFixture):
     mocker.patch("charm.cluster")
-    mocker.patch("charm.KubernetesServicePatch")
+    mocker.patch("charm.ServicePatch")
+    mocker.patch("charm.KubernetesStatefulSetPatch")
     keystone_harness = Harness(KeystoneCharm)
     keystone_harness.begin()
+    keystone_harness.charm.cluster.last_rotation = None
+    keystone_harness.charm.cluster.has_peers = False
+    keystone_harness.charm.cluster.restart_requested = False
     container = keystone_harness.charm.unit.get_container("keystone")
     keystone_harness.set_can_connect(container, True)
     container.make_dir(KEYSTONE_FOLDER, make_parents=True)
@@ -23,7 +42,7 @@ def harness_no_relations(mocker: MockerFixture):
     container.push(f"{FERNET_KEY_REPOSITORY}0", "token")
     container.make_dir("/app", make_parents=True)
     container.push("/app/start.sh", "")
-    container.exec = mocker.Mock()
+    keystone_harness.charm.container.exec = mocker.MagicMock()
     yield keystone_harness
     keystone_harness.cleanup()
 
@@ -64,12 +83,46 @@ def test_mysql_relation_ready(mocker: MockerFixture, harness: Harness):
     assert spy.call_count == 1
 
 
+def test_warm_up(mocker: MockerFixture, harness: Harness):
+    container = harness.charm.container
+    container.exec.return_value.wait.side_effect = pebble.ExecError([], 2, "", "not ready")
+    # Keystone is restarted with the new region
+    harness.update_config({"warm-up-requests": 4, "region-id": "other"})
+    assert harness.charm._stored.warm_up_pending
+    assert harness.charm.unit.status == MaintenanceStatus("waiting for keystone to warm up")
+
+    container.exec.return_value.wait.side_effect = None
+    container.exec.return_value.stdout = io.StringIO(
+        json.dumps(
+            {
+                "total": {
+                    "requests": 12,
+                    "errors": 0,
+                    "requests-per-second": 24.0,
+                    "p50-ms": 30.0,
+                    "p99-ms": 80.0,
+                }
+            }
+        )
+    )
+    harness.charm.on.update_status.emit()
+    assert harness.charm.unit.status == ActiveStatus()
+    command = container.exec.call_args.args[0]
+    assert command[command.index("--loops") + 1] == "4"
+    assert command[command.index("--concurrency") + 1] == "4"
+
+    # Nothing to warm up if keystone has not been restarted
+    container.exec.reset_mock()
+    harness.charm.on.config_changed.emit()
+    assert harness.charm.unit.status == ActiveStatus()
+    container.exec.assert_not_called()
+
+
 def test_db_sync_action(mocker: MockerFixture, harness: Harness):
     event_mock = mocker.Mock()
+    event_mock.params = {}
     harness.charm._on_db_sync_action(event_mock)
-    event_mock.set_results.assert_called_once_with(
-        {"output": "db-sync was successfully executed."}
-    )
+    event_mock.set_results.assert_called_once_with({"output": "No database migrations pending."})
     event_mock.fail.assert_not_called()
     harness.charm.container.exec().wait.side_effect = pebble.ExecError(
         ["keystone-manage", "db_sync"], 1, "", "Error"
@@ -78,6 +131,34 @@ def test_db_sync_action(mocker: MockerFixture, harness: Harness):
     event_mock.fail.assert_called_once_with("db-sync action failed with code 1 and stderr Error.")
 
 
+def test_db_sync_action_phases(mocker: MockerFixture, harness_no_relations: Harness):
+    container = harness_no_relations.charm.container
+    commands = []
+
+    def keystone_manage(command, **kwargs):
+        commands.append(command)
+        process = mocker.MagicMock()
+        if command[-1] == "--check":
+            # Migrate phase pending
+            process.wait.side_effect = pebble.ExecError(command, 3, None, None)
+        return process
+
+    container.exec.side_effect = keystone_manage
+    event_mock = mocker.Mock()
+    event_mock.params = {"timeout": 600}
+    harness_no_relations.charm._on_db_sync_action(event_mock)
+    assert commands == [
+        ["keystone-manage", "db_sync", "--check"],
+        ["keystone-manage", "db_sync", "--migrate"],
+        ["keystone-manage", "db_sync", "--contract"],
+    ]
+    results = event_mock.set_results.call_args.args[0]
+    assert results["phases"] == "migrate contract"
+    assert results["output"] == "db-sync was successfully executed."
+    assert "migrate-seconds" in results and "contract-seconds" in results
+    assert event_mock.log.call_count == 4
+
+
 def test_provide_keystone_relation(mocker: MockerFixture, harness: Harness):
     # Non-leader
     mon_rel_id = harness.add_relation("keystone", "mon")
@@ -86,6 +167,8 @@ def test_provide_keystone_relation(mocker: MockerFixture, harness: Harness):
     assert data == {}
     # Leader
     harness.set_leader(True)
+    harness.charm.cluster.key_generation = 2
+    harness.charm.cluster.invalidation_counter = 3
     nbi_rel_id = harness.add_relation("keystone", "nbi")
     harness.add_relation_unit(nbi_rel_id, "nbi/0")
     data = harness.get_relation_data(nbi_rel_id, harness.charm.app)
@@ -102,9 +185,28 @@ def test_provide_keystone_relation(mocker: MockerFixture, harness: Harness):
         "admin_username": "admin",
         "admin_password": "admin",
         "admin_project_name": "admin",
+        "token_cache_ttl": "3600",
+        "key_generation": "2",
+        "cache_invalidation_counter": "3",
     }
 
 
+def test_token_cache_ttl(harness: Harness):
+    assert harness.charm._fernet_rotation_time(3600) == 3600
+    assert harness.charm._token_cache_ttl(3600) == 3600
+    # The keys are rotated every 1800 seconds, and kept for two rotations
+    harness.update_config({"fernet-max-active-keys": 4})
+    assert harness.charm._fernet_rotation_time(3601) == 1800
+    assert harness.charm._token_cache_ttl(3601) == 3600
+    assert harness.charm._key_repository_environment() == {
+        "OS_FERNET_TOKENS__MAX_ACTIVE_KEYS": "4"
+    }
+    # Less than 3 keys are not supported
+    harness.update_config({"fernet-max-active-keys": 1})
+    assert harness.charm._fernet_rotation_time(3600) == 3600
+    assert harness.charm._key_repository_environment() == {}
+
+
 def test_update_status_rotation(mocker: MockerFixture, harness: Harness):
     spy_fernet_rotate = mocker.spy(harness.charm, "_fernet_rotate")
     harness.set_leader(True)
@@ -119,3 +221,462 @@ def test_update_status_no_rotation(mocker: MockerFixture, harness: Harness):
     harness._update_config({"token-expiration": 3600})
     harness.charm.on.update_status.emit()
     assert spy_fernet_rotate.call_count == 0
+
+
+def test_leader_elected_syncs_keys(mocker: MockerFixture, harness_no_relations: Harness):
+    spy_fernet_rotate = mocker.spy(harness_no_relations.charm, "_fernet_rotate")
+    cluster = harness_no_relations.charm.cluster
+    cluster.get_keys.return_value = {
+        FERNET_KEY_REPOSITORY: {"0": "staged", "1": "primary"},
+        CREDENTIAL_KEY_REPOSITORY: {"0": "credential"},
+    }
+    # The keys were rotated by the previous leader just now, the local keys are stale
+    cluster.last_rotation = time.time()
+    harness_no_relations.set_leader(True)
+    container = harness_no_relations.charm.container
+    assert container.pull(f"{FERNET_KEY_REPOSITORY}0").read() == "staged"
+    assert container.pull(f"{FERNET_KEY_REPOSITORY}1").read() == "primary"
+    assert spy_fernet_rotate.call_count == 0
+    # The following hooks trust the local keys of the leader
+    cluster.get_keys.return_value = {FERNET_KEY_REPOSITORY: {"0": "other"}}
+    harness_no_relations.charm.on.update_status.emit()
+    assert container.pull(f"{FERNET_KEY_REPOSITORY}0").read() == "staged"
+
+
+def test_rotation_uses_peer_last_rotation(mocker: MockerFixture, harness_no_relations: Harness):
+    mocker.patch.object(harness_no_relations.charm, "_fernet_rotate")
+    harness_no_relations.charm.cluster.get_keys.return_value = {}
+    harness_no_relations.charm.cluster.last_rotation = time.time() - 7200
+    harness_no_relations.charm.container.make_dir(CREDENTIAL_KEY_REPOSITORY, make_parents=True)
+    harness_no_relations.set_leader(True)
+    # The local staging key is new, but the keys were last rotated 2 hours ago
+    assert harness_no_relations.charm._fernet_rotate.call_count == 1
+    save_keys = harness_no_relations.charm.cluster.save_keys
+    assert save_keys.call_args.kwargs["last_rotation"] > time.time() - 60
+
+
+def test_publish_fqdn(mocker: MockerFixture, harness: Harness):
+    mocker.patch(
+        "charm.KeystoneCharm._namespace", new_callable=mocker.PropertyMock, return_value="osm"
+    )
+    harness.charm.cluster.key_generation = 1
+    harness.charm.cluster.invalidation_counter = 1
+    harness.set_leader(True)
+    harness.update_config({"publish-fqdn": True})
+    assert harness.charm.service_host == "osm-keystone.osm.svc.cluster.local."
+    nbi_rel_id = harness.add_relation("keystone", "nbi")
+    harness.add_relation_unit(nbi_rel_id, "nbi/0")
+    data = harness.get_relation_data(nbi_rel_id, harness.charm.app)
+    assert data["host"] == "http://osm-keystone.osm.svc.cluster.local.:5000/v3"
+    environment = harness.get_container_pebble_plan("keystone").services["keystone"].environment
+    assert environment["KEYSTONE_HOST"] == "osm-keystone.osm.svc.cluster.local."
+
+
+def test_memory_backed_key_repositories(mocker: MockerFixture, harness: Harness):
+    harness.charm.cluster.get_keys.return_value = {
+        FERNET_KEY_REPOSITORY: {"0": "staged", "1": "primary"},
+        CREDENTIAL_KEY_REPOSITORY: {"0": "credential"},
+    }
+    harness.update_config({"memory-backed-key-repositories": True})
+    container = harness.charm.container
+    assert container.pull("/dev/shm/keystone/fernet-keys/1").read() == "primary"
+    assert container.pull("/dev/shm/keystone/credential-keys/0").read() == "credential"
+    environment = harness.get_container_pebble_plan("keystone").services["keystone"].environment
+    assert environment["OS_FERNET_TOKENS__KEY_REPOSITORY"] == "/dev/shm/keystone/fernet-keys/"
+    assert environment["OS_CREDENTIAL__KEY_REPOSITORY"] == "/dev/shm/keystone/credential-keys/"
+
+
+def test_jws_provider_waits_for_keys(mocker: MockerFixture, harness: Harness):
+    cluster = harness.charm.cluster
+    cluster.get_keys.return_value = {}
+    cluster.jws_rolled_out = False
+    cluster.jws_keys_acknowledged = False
+    harness.update_config({"token-provider": "jws"})
+    environment = harness.get_container_pebble_plan("keystone").services["keystone"].environment
+    assert "OS_TOKEN__PROVIDER" not in environment
+    # The keys of the leader arrive, and are acknowledged
+    cluster.get_keys.return_value = {
+        JWS_PRIVATE_KEY_REPOSITORY: {"private.pem": "private-0"},
+        JWS_PUBLIC_KEY_REPOSITORY: {"1.pem": "public-0", "2.pem": "public-1"},
+    }
+    harness.charm.on.cluster_keys_changed.emit()
+    cluster.ack_jws_keys.assert_called()
+    cluster.jws_keys_acknowledged = True
+    environment = harness.get_container_pebble_plan("keystone").services["keystone"].environment
+    # The rest of the units may not have the keys yet
+    assert "OS_TOKEN__PROVIDER" not in environment
+    cluster.jws_rolled_out = True
+    harness.charm._on_cluster_relation_changed(mocker.Mock())
+    environment = harness.get_container_pebble_plan("keystone").services["keystone"].environment
+    assert environment["OS_TOKEN__PROVIDER"] == "jws"
+
+
+def test_jws_rollout(harness: Harness):
+    cluster = harness.charm.cluster
+    cluster.get_keys.return_value = {JWS_PUBLIC_KEY_REPOSITORY: {"1.pem": "public-0"}}
+    cluster.jws_rolled_out = False
+    cluster.jws_keys_acknowledged = True
+    cluster.units_missing_jws_keys.return_value = ["osm-keystone/1"]
+    with harness.hooks_disabled():
+        harness.update_config({"token-provider": "jws"})
+    harness.set_leader(True)
+    harness.charm._update_jws_rollout()
+    cluster.set_jws_rolled_out.assert_called_with(False)
+    cluster.units_missing_jws_keys.return_value = []
+    harness.charm._update_jws_rollout()
+    cluster.set_jws_rolled_out.assert_called_with(True)
+
+
+def test_jws_key_setup_and_rotation(mocker: MockerFixture, harness_no_relations: Harness):
+    harness = harness_no_relations
+    container = harness.charm.container
+    keypair_numbers = iter(range(10))
+
+    def create_jws_keypair(command, **kwargs):
+        if command[:2] == ["keystone-manage", "create_jws_keypair"]:
+            number = next(keypair_numbers)
+            container.push(f"{JWS_KEYPAIR_FOLDER}private.pem", f"private-{number}")
+            container.push(f"{JWS_KEYPAIR_FOLDER}public.pem", f"public-{number}")
+        return mocker.MagicMock()
+
+    container.exec.side_effect = create_jws_keypair
+    harness.set_leader(True)
+    harness._update_config({"token-provider": "jws"})
+    harness.charm._jws_key_setup()
+    assert container.pull(f"{JWS_PRIVATE_KEY_REPOSITORY}private.pem").read() == "private-0"
+    assert container.pull(f"{JWS_STAGED_KEY_REPOSITORY}private.pem").read() == "private-1"
+    assert harness.charm._jws_public_key_indexes() == [1, 2]
+    # Nothing to do if the repositories are initialized
+    harness.charm._jws_key_setup()
+    assert harness.charm._jws_public_key_indexes() == [1, 2]
+
+    harness.charm._jws_rotate()
+    harness.charm._jws_rotate()
+    assert container.pull(f"{JWS_PRIVATE_KEY_REPOSITORY}private.pem").read() == "private-2"
+    assert container.pull(f"{JWS_STAGED_KEY_REPOSITORY}private.pem").read() == "private-3"
+    assert sorted(harness.charm._jws_public_key_indexes()) == [2, 3, 4]
+    assert container.pull(f"{JWS_PUBLIC_KEY_REPOSITORY}4.pem").read() == "public-3"
+
+
+def test_rotate_credential_keys_action(mocker: MockerFixture, harness_no_relations: Harness):
+    harness = harness_no_relations
+    start_background = mocker.patch.object(CommandRunner, "start_background")
+    cluster = harness.charm.cluster
+    cluster.credential_migration = {}
+    cluster.save_credential_migration.side_effect = lambda migration: setattr(
+        cluster, "credential_migration", migration
+    )
+    cluster.units_missing_credential_keys.return_value = ["osm-keystone/1"]
+    harness.charm.container.make_dir(CREDENTIAL_KEY_REPOSITORY, make_parents=True)
+    event_mock = mocker.Mock()
+    harness.charm._on_rotate_credential_keys_action(event_mock)
+    event_mock.fail.assert_called_once_with(
+        "The rotate-credential-keys action must run on the leader unit."
+    )
+
+    harness.set_leader(True)
+    harness.charm.container.exec.reset_mock()
+    event_mock = mocker.Mock()
+    harness.charm._on_rotate_credential_keys_action(event_mock)
+    event_mock.fail.assert_not_called()
+    commands = [call.args[0] for call in harness.charm.container.exec.call_args_list]
+    assert commands[0][:2] == ["keystone-manage", "credential_rotate"]
+    assert cluster.credential_migration["state"] == "distributing"
+    results = event_mock.set_results.call_args.args[0]
+    assert results["state"] == "distributing"
+    assert results["pending-units"] == "osm-keystone/1"
+    # The credentials are migrated once every unit has the new key
+    start_background.assert_not_called()
+    cluster.units_missing_credential_keys.return_value = []
+    harness.charm.on.update_status.emit()
+    assert start_background.call_args.args[0] == "credential-migrate"
+    assert cluster.credential_migration["state"] == "migrating"
+
+    # The keys are not rotated again until the migration finishes
+    event_mock = mocker.Mock()
+    harness.charm._on_rotate_credential_keys_action(event_mock)
+    assert event_mock.fail.call_count == 1
+
+
+def test_credential_migration_progress(mocker: MockerFixture, harness_no_relations: Harness):
+    harness = harness_no_relations
+    exit_code = mocker.patch.object(CommandRunner, "background_exit_code", return_value=None)
+    start_background = mocker.patch.object(CommandRunner, "start_background")
+    maintenance = mocker.patch.object(harness.charm, "_maintenance").return_value
+    maintenance.credential_migration_progress.return_value = {"migrated": 2, "total": 5}
+    cluster = harness.charm.cluster
+    cluster.credential_migration = {"state": "migrating", "started": time.time()}
+    harness.charm.container.make_dir(CREDENTIAL_KEY_REPOSITORY, make_parents=True)
+    harness.set_leader(True)
+    harness.charm.on.update_status.emit()
+    # Started by the previous leader: the migration is restarted in the new one
+    assert start_background.call_count == 1
+    harness.charm.container.add_layer(
+        "credential-migrate", {"services": {"credential-migrate": {"override": "replace"}}}
+    )
+    harness.charm.on.update_status.emit()
+    migration = cluster.save_credential_migration.call_args.args[0]
+    assert migration["state"] == "migrating"
+    assert migration["migrated"] == 2 and migration["total"] == 5
+
+    exit_code.return_value = 0
+    maintenance.credential_migration_progress.return_value = {"migrated": 5, "total": 5}
+    harness.charm.on.update_status.emit()
+    migration = cluster.save_credential_migration.call_args.args[0]
+    assert migration["state"] == "migrated"
+    assert migration["migrated"] == 5
+
+
+def test_configure_logging(mocker: MockerFixture, harness_no_relations: Harness):
+    harness = harness_no_relations
+    container = harness.charm.container
+    container.push(
+        "/etc/apache2/sites-enabled/keystone.conf",
+        "<VirtualHost *:5000>\n    CustomLog /var/log/apache2/access.log combined\n"
+        "</VirtualHost>\n",
+        make_dirs=True,
+    )
+    assert harness.charm._configure_logging()
+    assert not harness.charm._configure_logging()
+    keystone_config = container.pull("/etc/keystone/keystone.conf.d/charm-logging.conf").read()
+    assert "debug = False" in keystone_config
+
+    harness.update_config({"log-level": "debug", "access-log": False})
+    assert harness.charm._configure_logging()
+    keystone_config = container.pull("/etc/keystone/keystone.conf.d/charm-logging.conf").read()
+    assert "debug = True" in keystone_config
+    apache_config = container.pull("/etc/apache2/conf-enabled/charm-logging.conf").read()
+    assert apache_config.startswith("LogLevel debug\n")
+    site_config = container.pull("/etc/apache2/sites-enabled/keystone.conf").read()
+    assert "# Disabled by the charm: CustomLog" in site_config
+
+    # Applied with a graceful reload of apache, keystone is not restarted
+    mocker.patch.object(harness.charm, "_configure_logging", return_value=True)
+    mocker.patch.object(harness.charm, "_replan", return_value=False)
+    mocker.patch("config.validate_config")
+    mocker.patch.object(harness.charm, "_check_mysql_data")
+    run = mocker.patch.object(CommandRunner, "run")
+    assert not harness.charm._safe_restart()
+    run.assert_called_once_with(["apache2ctl", "graceful"])
+
+
+def test_reload_lock(mocker: MockerFixture, harness: Harness):
+    mocker.patch("charm.KeystoneCharm._drain", return_value=False)
+    mocker.patch("config.validate_config")
+    mocker.patch.object(harness.charm, "_patch_entrypoint")
+    configure_logging = mocker.patch.object(harness.charm, "_configure_logging")
+    run = mocker.patch.object(CommandRunner, "run")
+    cluster = harness.charm.cluster
+    configure_logging.return_value = False
+    harness.charm._safe_restart()
+
+    # The reload waits for the restart lock, like a restart
+    cluster.has_peers = True
+    cluster.restart_granted = False
+    configure_logging.return_value = True
+    assert not harness.charm._safe_restart()
+    run.assert_not_called()
+    cluster.request_restart.assert_called_once()
+    assert harness.charm._stored.reload_pending
+
+    # The configuration has already been written when the lock is granted
+    cluster.restart_granted = True
+    configure_logging.return_value = False
+    assert not harness.charm._safe_restart()
+    run.assert_called_once_with(["apache2ctl", "graceful"])
+    assert not harness.charm._stored.reload_pending
+    cluster.release_restart.assert_not_called()
+
+
+def test_configure_backpressure(harness_no_relations: Harness):
+    harness = harness_no_relations
+    container = harness.charm.container
+    site = "<VirtualHost *:5000>\n    WSGIDaemonProcess keystone processes=4\n</VirtualHost>\n"
+    container.push("/etc/apache2/sites-enabled/keystone.conf", site, make_dirs=True)
+    assert harness.charm._configure_backpressure()
+    assert not harness.charm._configure_backpressure()
+    assert container.pull("/etc/apache2/sites-enabled/keystone.conf").read() == site
+
+    with harness.hooks_disabled():
+        harness.update_config(
+            {"max-concurrent-requests": 8, "queue-timeout": 5, "source-rate-limit": 10}
+        )
+    assert harness.charm._configure_backpressure()
+    site_config = container.pull("/etc/apache2/sites-enabled/keystone.conf").read()
+    assert "WSGIDaemonProcess keystone processes=4 threads=2 queue-timeout=5" in site_config
+    # mod_qos is not installed: the source rate limit is disabled
+    assert container.pull("/etc/apache2/conf-enabled/charm-backpressure.conf").read() == ""
+
+
+def test_log_forwarding(mocker: MockerFixture, harness: Harness):
+    container = harness.charm.container
+    add_layer = mocker.spy(container, "add_layer")
+
+    def logging_layers():
+        return [call.args[1] for call in add_layer.call_args_list if call.args[0] == "logging"]
+
+    logging_rel_id = harness.add_relation("logging", "loki")
+    harness.add_relation_unit(logging_rel_id, "loki/0")
+    assert logging_layers() == []
+    harness.update_relation_data(
+        logging_rel_id,
+        "loki/0",
+        {"endpoint": json.dumps({"url": "http://loki-0:3100/loki/api/v1/push"})},
+    )
+    assert "location: http://loki-0:3100/loki/api/v1/push" in logging_layers()[-1]
+    # Started by the replan of keystone
+    assert container.get_service("log-forwarder").is_running()
+
+    harness.remove_relation_unit(logging_rel_id, "loki/0")
+    assert "- -all" in logging_layers()[-1]
+    assert not container.get_service("log-forwarder").is_running()
+    # Without Loki units, the logging layer is left alone
+    harness.remove_relation(logging_rel_id)
+    assert len(logging_layers()) == 2
+
+
+def test_patch_entrypoint(harness_no_relations: Harness):
+    harness = harness_no_relations
+    container = harness.charm.container
+    container.push("/app/start.sh", "#!/bin/bash\nservice apache2 restart\nsource setup_env\n")
+    harness.charm._patch_entrypoint()
+    lines = container.pull("/app/start-patched.sh").read().splitlines()
+    assert lines[0] == "#!/bin/bash"
+    assert "entrypoint $(date +%s.%N)" in lines[1]
+    assert "apache-start $(date +%s.%N)" in lines[2]
+    # The startup ends when the keystone API answers
+    assert lines[4].startswith("source setup_env && {")
+    assert lines[4].index("api-wait") < lines[4].index("until") < lines[4].index("serving")
+
+
+def test_mysql_endpoints(harness: Harness):
+    mysql_rel_id = harness.model.get_relation("db").id
+    harness.add_relation_unit(mysql_rel_id, "mysql/1")
+    harness.update_relation_data(
+        mysql_rel_id, "mysql/1", {"host": "host-1", "port": "3306", "root_password": "root_pass"}
+    )
+    assert harness.charm._mysql_data().endpoints == [("host", 3306), ("host-1", 3306)]
+    harness.charm._replan()
+    plan = harness.get_container_pebble_plan("keystone")
+    # Keystone connects through the db router, which fails over between the endpoints
+    environment = plan.services["keystone"].environment
+    assert (environment["DB_HOST"], environment["DB_PORT"]) == ("127.0.0.1", 3307)
+    assert "--endpoint host:3306 --endpoint host-1:3306" in plan.services["db-router"].command
+    assert "--connect-timeout 5 " in plan.services["db-router"].command
+    assert harness.charm.container.get_service("db-router").is_running()
+    # Without timeouts, the driver defaults apply, to the database migrations as well
+    database_config_file = "/etc/keystone/keystone.conf.d/charm-database.conf"
+    assert not harness.charm.container.exists(database_config_file)
+    harness.update_config({"mysql-connect-timeout": 10, "mysql-read-timeout": 60})
+    database_config = harness.charm.container.pull(database_config_file).read()
+    assert "connection_parameters = connect_timeout=10&read_timeout=60&write_timeout=60" in (
+        database_config
+    )
+    plan = harness.get_container_pebble_plan("keystone")
+    assert "--connect-timeout 10 " in plan.services["db-router"].command
+    harness.update_config({"mysql-connect-timeout": 0, "mysql-read-timeout": 0})
+    assert not harness.charm.container.exists(database_config_file)
+
+    harness.remove_relation_unit(mysql_rel_id, "mysql/1")
+    harness.charm._replan()
+    environment = harness.get_container_pebble_plan("keystone").services["keystone"].environment
+    assert (environment["DB_HOST"], environment["DB_PORT"]) == ("host", 3306)
+    assert not harness.charm.container.get_service("db-router").is_running()
+
+
+def test_service_patched_with_valid_config(mocker: MockerFixture, harness: Harness):
+    service_patch = harness.charm.service_patch
+    validate_config = mocker.patch(
+        "config.validate_config", side_effect=ValidationError("invalid")
+    )
+    harness.update_config({"service-session-affinity": "ClientIP"})
+    service_patch.patch.assert_not_called()
+    validate_config.side_effect = None
+    harness.update_config({"service-session-affinity-timeout": 600})
+    service_patch.patch.assert_called_once()
+
+
+def test_drain(mocker: MockerFixture, harness_no_relations: Harness):
+    harness = harness_no_relations
+    container = harness.charm.container
+    run = mocker.patch.object(CommandRunner, "run")
+    with harness.hooks_disabled():
+        harness.update_config({"drain-grace-period": 30})
+    # Keystone is not running: there is nothing to drain
+    assert not harness.charm._drain()
+    run.assert_not_called()
+
+    container.add_layer(
+        "keystone", {"services": {"keystone": {"override": "replace", "command": "start"}}}
+    )
+    container.start("keystone")
+    run.return_value = json.dumps({"drained": True, "seconds": 10.5, "connections": 0})
+    assert harness.charm._drain()
+    command = run.call_args.args[0]
+    assert command[:2] == ["python3", "/tmp/keystone-drain/drain.py"]
+    assert command[-2:] == ["--grace-period", "30"]
+
+    with harness.hooks_disabled():
+        harness.update_config({"drain-grace-period": 0})
+    assert not harness.charm._drain()
+    assert run.call_count == 1
+
+
+def test_drain_file_removed_on_replan_error(mocker: MockerFixture, harness: Harness):
+    container = harness.charm.container
+    harness.charm._replan()
+    mocker.patch("charm.KeystoneCharm._drain", return_value=True)
+    container.push("/tmp/keystone-drain/draining", "", make_dirs=True)
+    mocker.patch.object(container, "replan", side_effect=pebble.ChangeError("error", None))
+    with harness.hooks_disabled():
+        harness.update_config({"region-id": "other"})
+    with pytest.raises(pebble.ChangeError):
+        harness.charm._replan()
+    # The ready check of keystone does not fail forever
+    assert not container.exists("/tmp/keystone-drain/draining")
+
+
+def test_restart_lock(mocker: MockerFixture, harness: Harness):
+    mocker.patch("charm.KeystoneCharm._drain", return_value=False)
+    cluster = harness.charm.cluster
+    container = harness.charm.container
+    # First start: keystone is not serving requests, no lock needed
+    harness.charm._replan()
+    assert container.get_service("keystone").is_running()
+    cluster.request_restart.assert_not_called()
+
+    cluster.has_peers = True
+    cluster.restart_granted = False
+    with harness.hooks_disabled():
+        harness.update_config({"region-id": "other"})
+    # Keystone keeps serving requests with the previous configuration until the lock is granted
+    assert not harness.charm._replan()
+    cluster.request_restart.assert_called_once()
+    environment = harness.get_container_pebble_plan("keystone").services["keystone"].environment
+    assert environment["REGION_ID"] == "RegionOne"
+    assert harness.charm._stored.restart_waiting
+    harness.charm._complete_warm_up()
+    assert harness.charm.unit.status == ActiveStatus("waiting for the restart lock")
+
+    cluster.restart_granted = True
+    assert harness.charm._replan()
+    environment = harness.get_container_pebble_plan("keystone").services["keystone"].environment
+    assert environment["REGION_ID"] == "other"
+    assert not harness.charm._stored.restart_waiting
+
+    # The lock is released once keystone passes its ready check
+    cluster.restart_requested = True
+    ready_check = mocker.Mock(status=pebble.CheckStatus.DOWN)
+    container.get_checks = mocker.MagicMock(return_value={"keystone-ready": ready_check})
+    # The health check is not waited for: the event is deferred to check it again
+    event = mocker.Mock()
+    harness.charm._complete_warm_up(event)
+    assert harness.charm.unit.status == MaintenanceStatus(
+        "waiting for keystone to pass its health check"
+    )
+    event.defer.assert_called_once()
+    cluster.release_restart.assert_not_called()
+    ready_check.status = pebble.CheckStatus.UP
+    harness.charm._complete_warm_up()
+    assert harness.charm.unit.status == ActiveStatus()
+    cluster.release_restart.assert_called_once()
@@ -0,0 +1,225 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import hashlib
+
+import pytest
+from ops.charm import CharmBase
+from ops.testing import Harness
+from pytest_mock import MockerFixture
+
+import cluster
+
+METADATA = """
+name: test-charm
+peers:
+  cluster:
+    interface: cluster
+"""
+
+
+class ClusterCharm(CharmBase):
+    on = cluster.ClusterEvents()
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.cluster = cluster.Cluster(self)
+        self.keys_changed = 0
+        self.keys_changed_last_rotation = None
+        self.framework.observe(self.on.cluster_keys_changed, self._on_cluster_keys_changed)
+
+    def _on_cluster_keys_changed(self, _):
+        self.keys_changed += 1
+        self.keys_changed_last_rotation = self.cluster.last_rotation
+
+
+@pytest.fixture
+def harness():
+    cluster_harness = Harness(ClusterCharm, meta=METADATA)
+    cluster_harness.set_leader(True)
+    cluster_harness.add_relation("cluster", "test-charm")
+    cluster_harness.begin()
+    yield cluster_harness
+    cluster_harness.cleanup()
+
+
+def test_save_keys_bumps_generation(harness: Harness):
+    harness.charm.cluster.save_keys({"fernet": {"0": "a"}})
+    assert harness.charm.cluster.key_generation == 1
+    assert harness.charm.cluster.invalidation_counter == 1
+    # Same keys: nothing changes
+    harness.charm.cluster.save_keys({"fernet": {"0": "a"}})
+    assert harness.charm.cluster.key_generation == 1
+    assert harness.charm.cluster.invalidation_counter == 1
+
+
+def test_track_config(harness: Harness):
+    harness.charm.cluster.track_config("first")
+    assert harness.charm.cluster.invalidation_counter == 0
+    harness.charm.cluster.track_config("first")
+    assert harness.charm.cluster.invalidation_counter == 0
+    harness.charm.cluster.track_config("second")
+    assert harness.charm.cluster.invalidation_counter == 1
+
+
+def test_save_maintenance_results(harness: Harness):
+    assert harness.charm.cluster.last_maintenance == 0
+    harness.charm.cluster.save_maintenance_results({"trusts": 1, "complete": 0})
+    assert harness.charm.cluster.last_maintenance == 0
+    harness.charm.cluster.save_maintenance_results({"trusts": 1})
+    assert harness.charm.cluster.last_maintenance > 0
+
+
+def test_save_keys_trace_context(harness: Harness):
+    harness.charm.cluster.save_keys({"fernet": {"0": "a"}}, trace_context={"traceparent": "00-a"})
+    assert harness.charm.cluster.trace_context == {"traceparent": "00-a"}
+    harness.charm.cluster.save_keys({"fernet": {"0": "b"}})
+    assert harness.charm.cluster.trace_context == {}
+
+
+def test_save_keys_last_rotation(harness: Harness):
+    assert harness.charm.cluster.last_rotation is None
+    harness.charm.cluster.save_keys({"fernet": {"0": "a"}}, last_rotation=1000.0)
+    assert harness.charm.cluster.last_rotation == 1000.0
+    # The observers of the event see the new rotation time
+    assert harness.charm.keys_changed_last_rotation == 1000.0
+    # Same keys, new rotation time
+    harness.charm.cluster.save_keys({"fernet": {"0": "a"}}, last_rotation=2000.0)
+    assert harness.charm.cluster.last_rotation == 2000.0
+    harness.charm.cluster.save_keys({"fernet": {"0": "a"}})
+    assert harness.charm.cluster.last_rotation == 2000.0
+
+
+def test_keys_changed_on_new_generation(harness: Harness):
+    harness.set_leader(False)
+    relation_id = harness.model.get_relation("cluster").id
+    harness.update_relation_data(relation_id, "test-charm", {"key_generation": "1"})
+    assert harness.charm.keys_changed == 1
+    # Other changes do not fire the event
+    harness.update_relation_data(relation_id, "test-charm", {"last_maintenance": "1"})
+    assert harness.charm.keys_changed == 1
+    harness.update_relation_data(relation_id, "test-charm", {"key_generation": "2"})
+    assert harness.charm.keys_changed == 2
+
+
+def test_primary_key_hash():
+    assert cluster.primary_key_hash({}) is None
+    # The primary key is the key with the highest index
+    key_hash = cluster.primary_key_hash({"0": "staged", "2": "primary", "10": "newest"})
+    assert key_hash == hashlib.sha1(b"newest").hexdigest()
+
+
+def test_credential_key_acknowledgements(harness: Harness):
+    relation_id = harness.model.get_relation("cluster").id
+    harness.add_relation_unit(relation_id, "test-charm/1")
+    harness.charm.cluster.save_credential_migration({"state": "distributing"})
+    assert harness.charm.cluster.credential_migration == {"state": "distributing"}
+    assert harness.charm.cluster.units_missing_credential_keys("new") == ["test-charm/1"]
+    harness.update_relation_data(relation_id, "test-charm/1", {"credential_key_hash": "new"})
+    assert harness.charm.cluster.units_missing_credential_keys("new") == []
+    harness.charm.cluster.ack_credential_keys("new")
+    assert harness.get_relation_data(relation_id, "test-charm/0") == {"credential_key_hash": "new"}
+
+
+def test_save_private_keys_in_secret(harness: Harness, monkeypatch):
+    relation_id = harness.model.get_relation("cluster").id
+    keys = {"fernet": {"0": "a"}, "jws-private": {"private.pem": "secret"}}
+    # Without secrets, the private keys are in the relation data
+    harness.charm.cluster.save_keys(keys, private_repositories=["jws-private"])
+    assert "secret" in harness.get_relation_data(relation_id, "test-charm")["key_repository"]
+
+    monkeypatch.setenv("JUJU_VERSION", "3.1.0")
+    keys["jws-private"] = {"private.pem": "rotated"}
+    harness.charm.cluster.save_keys(keys, private_repositories=["jws-private"])
+    data = harness.get_relation_data(relation_id, "test-charm")
+    assert "jws-private" not in data["key_repository"]
+    assert "private_keys_secret" in data
+    assert harness.charm.cluster.get_keys() == keys
+    assert harness.charm.cluster.key_generation == 2
+    # Without private keys, the secret is removed
+    harness.charm.cluster.save_keys({"fernet": {"0": "a"}}, private_repositories=["jws-private"])
+    assert "private_keys_secret" not in harness.get_relation_data(relation_id, "test-charm")
+    assert harness.charm.cluster.get_keys() == {"fernet": {"0": "a"}}
+
+
+def test_jws_key_acknowledgements(harness: Harness):
+    relation_id = harness.model.get_relation("cluster").id
+    harness.add_relation_unit(relation_id, "test-charm/1")
+    assert not harness.charm.cluster.jws_keys_acknowledged
+    assert harness.charm.cluster.units_missing_jws_keys("new") == ["test-charm/1"]
+    harness.update_relation_data(relation_id, "test-charm/1", {"jws_key_hash": "new"})
+    assert harness.charm.cluster.units_missing_jws_keys("new") == []
+    harness.charm.cluster.ack_jws_keys("new")
+    assert harness.charm.cluster.jws_keys_acknowledged
+    assert not harness.charm.cluster.jws_rolled_out
+    harness.charm.cluster.set_jws_rolled_out(True)
+    assert harness.charm.cluster.jws_rolled_out
+    harness.charm.cluster.set_jws_rolled_out(False)
+    assert not harness.charm.cluster.jws_rolled_out
+
+
+def test_restart_lock(harness: Harness):
+    relation_id = harness.model.get_relation("cluster").id
+    for unit in ("test-charm/1", "test-charm/2", "test-charm/3"):
+        harness.add_relation_unit(relation_id, unit)
+    assert not harness.charm.cluster.restart_requested
+    assert harness.charm.cluster.grant_restarts(1) == []
+    assert "restart_granted" not in harness.get_relation_data(relation_id, "test-charm")
+
+    harness.update_relation_data(relation_id, "test-charm/2", {"restart_requested": "1"})
+    harness.update_relation_data(relation_id, "test-charm/1", {"restart_requested": "2"})
+    harness.charm.cluster.request_restart()
+    assert harness.charm.cluster.restart_requested
+    # Granted in the order of the requests, to a batch at a time
+    assert harness.charm.cluster.grant_restarts(2) == ["test-charm/2", "test-charm/1"]
+    assert not harness.charm.cluster.restart_granted
+    # The next batch waits until the previous one releases the lock
+    harness.update_relation_data(relation_id, "test-charm/2", {"restart_requested": ""})
+    assert harness.charm.cluster.grant_restarts(2) == ["test-charm/1"]
+    harness.remove_relation_unit(relation_id, "test-charm/1")
+    assert harness.charm.cluster.grant_restarts(2) == ["test-charm/0"]
+    assert harness.charm.cluster.restart_granted
+    harness.charm.cluster.release_restart()
+    assert not harness.charm.cluster.restart_requested
+    assert harness.charm.cluster.grant_restarts(2) == []
+
+
+def test_restart_lock_keeps_a_unit_serving(harness: Harness):
+    relation_id = harness.model.get_relation("cluster").id
+    harness.add_relation_unit(relation_id, "test-charm/1")
+    harness.update_relation_data(relation_id, "test-charm/1", {"restart_requested": "1"})
+    harness.charm.cluster.request_restart()
+    assert harness.charm.cluster.has_peers
+    assert harness.charm.cluster.grant_restarts(5) == ["test-charm/1"]
+
+
+def test_restart_lock_expires(mocker: MockerFixture, harness: Harness):
+    relation_id = harness.model.get_relation("cluster").id
+    for unit in ("test-charm/1", "test-charm/2"):
+        harness.add_relation_unit(relation_id, unit)
+    harness.update_relation_data(relation_id, "test-charm/1", {"restart_requested": "1"})
+    harness.update_relation_data(relation_id, "test-charm/2", {"restart_requested": "2"})
+    time = mocker.patch("cluster.time.time", return_value=1000)
+    assert harness.charm.cluster.grant_restarts(1) == ["test-charm/1"]
+    time.return_value = 1000 + cluster.RESTART_LOCK_TIMEOUT
+    assert harness.charm.cluster.grant_restarts(1) == ["test-charm/1"]
+    # The unit that never released the lock goes behind the rest of the units
+    time.return_value = 1001 + cluster.RESTART_LOCK_TIMEOUT
+    assert harness.charm.cluster.grant_restarts(1) == ["test-charm/2"]
+    harness.update_relation_data(relation_id, "test-charm/2", {"restart_requested": ""})
+    assert harness.charm.cluster.grant_restarts(1) == ["test-charm/1"]
+
+
+def test_without_relation():
+    cluster_harness = Harness(ClusterCharm, meta=METADATA)
+    cluster_harness.begin()
+    peers = cluster_harness.charm.cluster
+    assert peers.fernet_keys == []
+    assert peers.key_generation == 0
+    assert peers.invalidation_counter == 0
+    assert peers.last_rotation is None
+    assert peers.last_maintenance == 0
+    assert peers.credential_migration == {}
+    assert peers.get_keys() == {}
+    assert peers.units_missing_credential_keys("hash") == []
+    cluster_harness.cleanup()
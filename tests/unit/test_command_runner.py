@@ -0,0 +1,98 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import io
+
+import pytest
+from ops import pebble
+from ops.charm import CharmBase
+from ops.testing import Harness
+from pytest_mock import MockerFixture
+
+from command_runner import BACKGROUND_STATUS_FOLDER, CommandRunner
+
+METADATA = """
+name: test-charm
+containers:
+  workload:
+    resource: workload-image
+resources:
+  workload-image:
+    type: oci-image
+"""
+
+
+@pytest.fixture
+def container(mocker: MockerFixture):
+    harness = Harness(CharmBase, meta=METADATA)
+    harness.begin()
+    workload = harness.charm.unit.get_container("workload")
+    harness.set_can_connect(workload, True)
+    workload.exec = mocker.Mock()
+    workload.exec.return_value.stdout = io.StringIO("line 1\nline 2\n")
+    workload.exec.return_value.stderr = io.StringIO("warning\n")
+    yield workload
+    harness.cleanup()
+
+
+def test_run(container, caplog):
+    runner = CommandRunner(container, default_timeout=10)
+    with caplog.at_level("INFO"):
+        assert runner.run(["keystone-manage", "db_sync"]) == "line 1\nline 2\n"
+    assert "[keystone-manage stderr] warning" in caplog.text
+    # The stdout is only logged at debug level
+    assert "line 1" not in caplog.text
+    assert container.exec.call_args.kwargs["timeout"] == 10
+
+
+def test_run_error(container):
+    container.exec.return_value.wait.side_effect = pebble.ExecError(["false"], 1, None, None)
+    with pytest.raises(pebble.ExecError) as e:
+        CommandRunner(container).run(["false"])
+    assert e.value.stderr == "warning\n"
+
+
+def test_run_batch(container):
+    CommandRunner(container).run_batch([["a", "1"], ["b", "some arg"]], timeout=5)
+    container.exec.assert_called_once_with(
+        ["sh", "-c", "a 1 && b 'some arg'"], timeout=5, environment=None, working_dir=None
+    )
+
+
+def test_background(container):
+    runner = CommandRunner(container)
+    runner.start_background("db-sync", ["keystone-manage", "db_sync"])
+    service = container.get_plan().services["db-sync"]
+    assert service.startup == "disabled"
+    assert container.get_service("db-sync").is_running()
+    assert runner.background_exit_code("db-sync") is None
+    container.push(f"{BACKGROUND_STATUS_FOLDER}db-sync", "0\n")
+    assert runner.background_exit_code("db-sync") == 0
+
+
+def test_background_status_file_not_written(container):
+    runner = CommandRunner(container)
+    runner.start_background("db-sync", ["keystone-manage", "db_sync"])
+    command = container.get_plan().services["db-sync"].command
+    assert f"mv {BACKGROUND_STATUS_FOLDER}db-sync.tmp {BACKGROUND_STATUS_FOLDER}db-sync" in command
+    container.push(f"{BACKGROUND_STATUS_FOLDER}db-sync", "")
+    assert runner.background_exit_code("db-sync") is None
+
+
+def test_background_exits_immediately(mocker: MockerFixture, container):
+    def exit_immediately(name):
+        container.push(f"{BACKGROUND_STATUS_FOLDER}{name}", "0\n")
+        raise pebble.ChangeError("cannot start service: exited quickly with code 0", None)
+
+    mocker.patch.object(container, "restart", side_effect=exit_immediately)
+    runner = CommandRunner(container)
+    runner.start_background("credential-migrate", ["keystone-manage", "credential_migrate"])
+    assert runner.background_exit_code("credential-migrate") == 0
+
+
+def test_background_start_error(mocker: MockerFixture, container):
+    mocker.patch.object(
+        container, "restart", side_effect=pebble.ChangeError("cannot start service", None)
+    )
+    with pytest.raises(pebble.ChangeError):
+        CommandRunner(container).start_background("db-sync", ["keystone-manage", "db_sync"])
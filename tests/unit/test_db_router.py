@@ -0,0 +1,99 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import socket
+import socketserver
+import threading
+
+import pytest
+
+import db_router
+
+
+class StandIn(socketserver.ThreadingTCPServer):
+    """Local MySQL stand-in: it greets with its name, then echoes the data."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, name: str):
+        self.name = name
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def endpoint(self):
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.sendall(self.server.name.encode())
+        while True:
+            data = self.request.recv(1024)
+            if not data:
+                break
+            self.request.sendall(data)
+
+
+def _closed_endpoint():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()
+
+
+@pytest.fixture
+def stand_ins():
+    servers = [StandIn("mysql-0"), StandIn("mysql-1")]
+    yield servers
+    for server in servers:
+        if server.socket.fileno() != -1:
+            server.stop()
+
+
+def _router(endpoints):
+    router = db_router.Router(endpoints, connect_timeout=1)
+    server = db_router.RouterServer(("127.0.0.1", 0), router)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return router, server
+
+
+def _greeting(server) -> bytes:
+    with socket.create_connection(server.server_address, timeout=5) as client:
+        greeting = client.recv(1024)
+        if greeting:
+            client.sendall(b"ping")
+            assert client.recv(1024) == b"ping"
+        return greeting
+
+
+def test_parse_endpoint():
+    assert db_router.parse_endpoint("mysql-0.mysql:3306") == ("mysql-0.mysql", 3306)
+    with pytest.raises(ValueError):
+        db_router.parse_endpoint("mysql-0")
+
+
+def test_failover(stand_ins):
+    router, server = _router([stand_ins[0].endpoint, stand_ins[1].endpoint])
+    assert _greeting(server) == b"mysql-0"
+    stand_ins[0].stop()
+    assert _greeting(server) == b"mysql-1"
+    assert router.current == 1
+    # The router keeps using the new endpoint
+    stand_ins[0] = StandIn("mysql-0")
+    router.endpoints[0] = stand_ins[0].endpoint
+    assert _greeting(server) == b"mysql-1"
+    server.shutdown()
+    server.server_close()
+
+
+def test_no_endpoint():
+    router, server = _router([_closed_endpoint(), _closed_endpoint()])
+    # The connection is closed without data
+    assert _greeting(server) == b""
+    server.shutdown()
+    server.server_close()
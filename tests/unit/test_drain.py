@@ -0,0 +1,50 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+from pytest_mock import MockerFixture
+
+import drain
+
+TCP = """\
+  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid
+   0: 00000000:1388 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0
+   1: 0A01010A:1388 0B01010A:D431 01 00000000:00000000 00:00000000 00000000     0
+   2: 0100007F:1388 0100007F:D432 01 00000000:00000000 00:00000000 00000000     0
+   3: 0A01010A:1388 0C01010A:D433 06 00000000:00000000 00:00000000 00000000     0
+   4: 0A01010A:23C4 0B01010A:D434 01 00000000:00000000 00:00000000 00000000     0
+"""
+TCP6 = """\
+  sl  local_address                         remote_address                        st
+   0: 0000000000000000FFFF00000A01010A:1388 0000000000000000FFFF00000D01010A:D435 01
+   1: 00000000000000000000000001000000:1388 00000000000000000000000001000000:D436 01
+   2: 0000000000000000FFFF00000100007F:1388 0000000000000000FFFF00000100007F:D437 01
+"""
+
+
+def test_active_connections():
+    # Established connections to port 5000 from other hosts: not listening, loopback,
+    # time-wait or other ports
+    assert drain.active_connections([TCP, TCP6], 5000) == 2
+    assert drain.active_connections([TCP], 9156) == 1
+    assert drain.active_connections([], 5000) == 0
+
+
+def test_drain(mocker: MockerFixture):
+    mocker.patch("drain.time.sleep")
+    read_tables = mocker.patch("drain._read_tables", side_effect=[[TCP], [TCP], [""]])
+    result = drain.drain(5000, grace_period=30, min_wait=10, interval=0.5)
+    assert result["drained"] and result["connections"] == 0
+    assert read_tables.call_count == 3
+
+    read_tables = mocker.patch("drain._read_tables", return_value=[TCP])
+    result = drain.drain(5000, grace_period=0, min_wait=10, interval=0.5)
+    assert not result["drained"] and result["connections"] == 1
+
+
+def test_drain_without_connections(mocker: MockerFixture):
+    sleep = mocker.patch("drain.time.sleep")
+    mocker.patch("drain._read_tables", return_value=[""])
+    result = drain.drain(5000, grace_period=30, min_wait=10, interval=0.5)
+    assert result["drained"] and result["connections"] == 0
+    # The minimum wait is skipped
+    sleep.assert_not_called()
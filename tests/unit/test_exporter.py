@@ -0,0 +1,120 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import os
+from pathlib import Path
+
+import exporter
+
+REQUEST_LOG = """\
+201 30000
+200 4000
+404 2000000
+not a request
+"""
+
+
+def test_parse_request():
+    assert exporter.parse_request(REQUEST_LOG.splitlines()[0]) == ("201", 0.03)
+    assert exporter.parse_request("not a request") is None
+
+
+def test_render():
+    metric = exporter.MetricFamily("some_metric", "gauge", "Some metric.")
+    metric.add(1, repository="fernet").add(2, "_sum")
+    assert metric.render() == (
+        "# HELP some_metric Some metric.\n"
+        "# TYPE some_metric gauge\n"
+        'some_metric{repository="fernet"} 1\n'
+        "some_metric_sum 2\n"
+    )
+
+
+def test_key_repository_metrics(tmp_path: Path):
+    fernet = tmp_path / "fernet-keys"
+    fernet.mkdir()
+    for key, mtime in [("0", 900), ("1", 500), ("2", 800)]:
+        (fernet / key).write_text("key")
+        os.utime(fernet / key, (mtime, mtime))
+    metrics = exporter.key_repository_metrics(
+        {"fernet": str(fernet), "credential": str(tmp_path / "missing")},
+        {"fernet": 300},
+        now=1000,
+    )
+    rendered = "".join(metric.render() for metric in metrics)
+    assert 'keystone_keys{repository="fernet"} 3' in rendered
+    assert 'keystone_primary_key_age_seconds{repository="fernet"} 200' in rendered
+    assert 'keystone_key_rotation_due_seconds{repository="fernet"} 200' in rendered
+    assert 'repository="credential"' not in rendered
+    # The last rotation known by the leader prevails over the staged key
+    metrics = exporter.key_repository_metrics(
+        {"fernet": str(fernet)}, {"fernet": 300}, now=1000, last_rotations={"fernet": 800}
+    )
+    rendered = "".join(metric.render() for metric in metrics)
+    assert 'keystone_key_rotation_due_seconds{repository="fernet"} 100' in rendered
+
+
+def test_charm_metrics():
+    state = {
+        "last_key_sync": 990,
+        "hooks": {"update-status": {"duration": 1.5, "timestamp": 995}},
+        "pebble_calls": {"exec": 3},
+    }
+    rendered = "".join(metric.render() for metric in exporter.charm_metrics(state, now=1000))
+    assert "keystone_key_sync_age_seconds 10" in rendered
+    assert 'keystone_charm_hook_duration_seconds{hook="update-status"} 1.5' in rendered
+    assert 'keystone_charm_pebble_calls_total{method="exec"} 3' in rendered
+
+
+def test_startup_metrics():
+    assert exporter.startup_metrics(None) == []
+    startup = {
+        "started": 1000,
+        "duration": 62.5,
+        "phases": {"db-wait": 40.5, "api-wait": 22},
+        "regressions": ["db-wait"],
+    }
+    rendered = "".join(metric.render() for metric in exporter.startup_metrics(startup))
+    assert "keystone_startup_duration_seconds 62.5" in rendered
+    assert 'keystone_startup_phase_duration_seconds{phase="db-wait"} 40.5' in rendered
+    assert 'keystone_startup_phase_regressed{phase="db-wait"} 1' in rendered
+    assert 'keystone_startup_phase_regressed{phase="api-wait"} 0' in rendered
+
+
+def test_request_log(tmp_path: Path):
+    path = tmp_path / "keystone-requests.metrics"
+    path.write_text(REQUEST_LOG)
+    request_log = exporter.RequestLog(str(path), max_size=100)
+    requests, duration = request_log.collect()
+    assert requests.samples == [
+        ("", {"code": "200"}, 1),
+        ("", {"code": "201"}, 1),
+        ("", {"code": "404"}, 1),
+    ]
+    assert ("_bucket", {"le": "0.005"}, 1) in duration.samples
+    assert ("_bucket", {"le": "0.05"}, 2) in duration.samples
+    assert ("_count", {}, 3) in duration.samples
+    # Only the new lines are counted
+    with path.open("a") as f:
+        f.write(REQUEST_LOG.splitlines()[1] + "\n")
+    assert ("", {"code": "200"}, 2) in request_log.collect()[0].samples
+    # Truncated log
+    path.write_text(REQUEST_LOG.splitlines()[1] + "\n")
+    assert ("", {"code": "200"}, 3) in request_log.collect()[0].samples
+
+
+def test_request_log_truncated_once_read(tmp_path: Path):
+    path = tmp_path / "keystone-requests.metrics"
+    path.write_text(REQUEST_LOG)
+    request_log = exporter.RequestLog(str(path), max_size=10)
+    request_log.collect()
+    assert path.stat().st_size == 0
+    path.write_text(REQUEST_LOG.splitlines()[0] + "\n")
+    assert ("", {"code": "201"}, 2) in request_log.collect()[0].samples
+
+
+def test_probe_down():
+    probe = exporter.Probe("http://127.0.0.1:1/v3", timeout=1)
+    up, histogram = probe.collect()
+    assert up.samples == [("", {}, 0)]
+    assert ("_count", {}, 1) in histogram.samples
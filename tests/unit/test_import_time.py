@@ -0,0 +1,93 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, Tuple
+
+# Budget for the cumulative import time of the charm module, in microseconds
+IMPORT_TIME_BUDGET_US = 500_000
+# Budget for the dispatch of a no-op update-status, once the charm is imported, in seconds
+DISPATCH_TIME_BUDGET_S = 1
+# Modules that must only be loaded in the code paths that need them. Note that yaml, which
+# workload_logging uses, is always loaded by ops.
+LAZY_MODULES = [
+    "lightkube",
+    "config_validator",
+    "pydantic",
+    "opentelemetry",
+    "backpressure",
+    "command_runner",
+    "maintenance",
+    "profiler",
+    "statistics",
+    "workload_logging",
+]
+
+ROOT = Path(__file__).parents[2]
+
+# A follower with nothing to do: Pebble is ready, and there are no keys to sync, maintenance or
+# warm-up pending
+UPDATE_STATUS_SCRIPT = """
+import json
+import os
+import sys
+import time
+import charm
+from ops.testing import Harness
+os.environ["JUJU_DISPATCH_PATH"] = "hooks/update-status"
+harness = Harness(charm.KeystoneCharm)
+harness.add_relation("cluster", "keystone")
+harness.begin()
+harness.set_can_connect("keystone", True)
+start = time.perf_counter()
+harness.charm.on.update_status.emit()
+harness.framework.commit()
+print(json.dumps({
+    "dispatch_time": time.perf_counter() - start,
+    "status": harness.charm.unit.status.message,
+    "modules": sorted(sys.modules),
+}))
+"""
+
+
+def _run_with_importtime(script: str) -> Tuple[Dict[str, int], str]:
+    """Run a script with `python -X importtime`.
+
+    Returns:
+        Tuple[Dict[str, int], str]: cumulative import time of each module (in microseconds),
+            and the stdout of the script.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [str(ROOT), str(ROOT / "lib"), str(ROOT / "src"), env.get("PYTHONPATH", "")]
+    )
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script],
+        capture_output=True,
+        text=True,
+        env=env,
+        cwd=ROOT,
+        check=True,
+    )
+    import_times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line.split(":", 1)[1].split("|")
+        import_times[module.strip()] = int(cumulative)
+    return import_times, process.stdout
+
+
+def test_update_status_cold_start():
+    import_times, stdout = _run_with_importtime(UPDATE_STATUS_SCRIPT)
+    assert import_times["charm"] < IMPORT_TIME_BUDGET_US
+    update_status = json.loads(stdout)
+    # The hook was not deferred waiting for Pebble
+    assert update_status["status"] != "waiting for pebble to start"
+    assert update_status["dispatch_time"] < DISPATCH_TIME_BUDGET_S
+    for module in LAZY_MODULES:
+        assert module not in update_status["modules"], f"{module} loaded in update-status"
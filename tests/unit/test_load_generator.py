@@ -0,0 +1,117 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import load_generator
+
+
+class FakeKeystoneHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        password = body["auth"]["identity"]["password"]["user"]["password"]
+        self._respond(201 if password == "secret" else 401, {"X-Subject-Token": "token"})
+
+    def do_GET(self):
+        self._respond(200 if self.headers.get("X-Auth-Token") == "token" else 401)
+
+    def _respond(self, status, headers=None):
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def keystone_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeKeystoneHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/v3"
+    server.shutdown()
+    server.server_close()
+
+
+def test_percentile():
+    values = [float(v) for v in range(1, 101)]
+    assert load_generator.percentile(values, 50) == 50
+    assert load_generator.percentile(values, 95) == 95
+    assert load_generator.percentile(values, 99) == 99
+    assert load_generator.percentile([3.0], 99) == 3
+    assert load_generator.percentile([], 50) == 0
+
+
+def test_summarize():
+    summary = load_generator.summarize([0.01, 0.02, 0.03, 0.04], {"200": 3, "503": 1}, 2)
+    assert summary["requests"] == 4
+    assert summary["errors"] == 1
+    assert summary["requests-per-second"] == 2
+    assert summary["p50-ms"] == 20
+    assert summary["p99-ms"] == 40
+
+
+def run_benchmark(keystone_url, capsys):
+    load_generator.main(
+        [
+            "--url",
+            keystone_url,
+            "--username",
+            "service",
+            "--project",
+            "service",
+            "--concurrency",
+            "2",
+            "--duration",
+            "0.2",
+        ]
+    )
+    return json.loads(capsys.readouterr().out)
+
+
+def test_benchmark(keystone_url, capsys, monkeypatch):
+    monkeypatch.setenv("KEYSTONE_PASSWORD", "secret")
+    results = run_benchmark(keystone_url, capsys)
+    assert set(results) == {"issue", "validate", "catalog", "total"}
+    assert results["issue"]["requests"] > 0
+    assert results["issue"]["status-codes"] == {"201": results["issue"]["requests"]}
+    assert results["validate"]["errors"] == 0
+    assert results["total"]["errors"] == 0
+
+
+def test_benchmark_wrong_password(keystone_url, capsys, monkeypatch):
+    monkeypatch.setenv("KEYSTONE_PASSWORD", "wrong")
+    results = run_benchmark(keystone_url, capsys)
+    assert results["issue"]["errors"] == results["issue"]["requests"] > 0
+    assert results["catalog"]["requests"] == 0
+
+
+def test_warm_up_loops(keystone_url, capsys, monkeypatch):
+    monkeypatch.setenv("KEYSTONE_PASSWORD", "secret")
+    exit_code = load_generator.main(
+        ["--url", keystone_url, "--username", "service", "--project", "service"]
+        + ["--concurrency", "2", "--loops", "5", "--wait-ready", "5"]
+    )
+    assert exit_code == 0
+    results = json.loads(capsys.readouterr().out)
+    assert results["issue"]["requests"] == 5
+    assert results["total"]["requests"] == 15
+
+
+def test_wait_ready_timeout(capsys):
+    exit_code = load_generator.main(
+        ["--url", "http://127.0.0.1:1/v3", "--username", "service", "--project", "service"]
+        + ["--wait-ready", "0"]
+    )
+    assert exit_code == load_generator.NOT_READY_EXIT_CODE
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,168 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import io
+from unittest.mock import MagicMock
+
+import pytest
+from ops import pebble
+
+from command_runner import CommandRunner
+from maintenance import (
+    MYSQL_OPTION_FILE,
+    PRUNE_BATCH_SIZE,
+    PRUNE_BATCHES_PER_QUERY,
+    KeystoneMaintenance,
+)
+
+
+class FakeKeystoneExec:
+    """Fake exec backend emulating keystone-manage and the mysql client."""
+
+    def __init__(self):
+        self.flushable_trusts = 4
+        self.revocation_events = 7
+        self.application_credentials = 2
+        self.credentials = {"old": 3, "new": 2}
+        self.trust_flush_timeout = False
+        self.commands = []
+
+    def __call__(self, command, **kwargs):
+        self.commands.append((command, kwargs))
+        output = ""
+        if command[:2] == ["keystone-manage", "trust_flush"]:
+            if self.trust_flush_timeout:
+                raise pebble.ChangeError("timed out", MagicMock())
+            self.flushable_trusts = 0
+        elif command[0] == "mysql":
+            sql = command[command.index("-e") + 1]
+            if "FROM trust" in sql:
+                output = f"{self.flushable_trusts}\n"
+            elif "revocation_event" in sql:
+                output = self._delete_in_batches(sql, "revocation_events")
+            elif "application_credential" in sql:
+                output = self._delete_in_batches(sql, "application_credentials")
+            elif "FROM credential" in sql:
+                migrated = sum(n for key_hash, n in self.credentials.items() if key_hash in sql)
+                output = f"{sum(self.credentials.values())}\t{migrated}\n"
+        process = MagicMock()
+        process.stdout = io.StringIO(output)
+        process.stderr = io.StringIO("")
+        return process
+
+    def _delete_in_batches(self, sql, table):
+        output = ""
+        for _ in range(sql.count(f"LIMIT {PRUNE_BATCH_SIZE};")):
+            deleted = min(getattr(self, table), PRUNE_BATCH_SIZE)
+            setattr(self, table, getattr(self, table) - deleted)
+            output += f"{deleted}\n"
+        return output
+
+
+@pytest.fixture
+def fake_exec():
+    return FakeKeystoneExec()
+
+
+@pytest.fixture
+def container(fake_exec: FakeKeystoneExec):
+    container = MagicMock()
+    container.exec.side_effect = fake_exec
+    return container
+
+
+@pytest.fixture
+def maintenance(container: MagicMock):
+    return KeystoneMaintenance(
+        CommandRunner(container),
+        db_host="mysql",
+        db_port=3306,
+        db_password="secret",
+        token_expiration=3600,
+    )
+
+
+def test_prune(
+    maintenance: KeystoneMaintenance, fake_exec: FakeKeystoneExec, container: MagicMock
+):
+    results = maintenance.prune()
+    assert results["trusts"] == 4
+    assert results["revocation-events"] == 7
+    assert "application-credentials" not in results
+    assert results["complete"] == 1
+    assert "seconds" in results
+    assert fake_exec.application_credentials == 2
+    revocation_command, kwargs = fake_exec.commands[-1]
+    assert "INTERVAL 5400 SECOND" in revocation_command[revocation_command.index("-e") + 1]
+    assert revocation_command[1] == f"--defaults-extra-file={MYSQL_OPTION_FILE}"
+    assert "secret" not in revocation_command
+    assert kwargs["environment"] is None
+    # The option file is written once
+    container.push.assert_called_once_with(
+        MYSQL_OPTION_FILE,
+        '[client]\nuser = keystone\npassword = "secret"\n',
+        permissions=0o600,
+        make_dirs=True,
+    )
+
+
+def test_prune_application_credentials(
+    maintenance: KeystoneMaintenance, fake_exec: FakeKeystoneExec
+):
+    results = maintenance.prune(application_credentials=True)
+    assert results["application-credentials"] == 2
+    # Nothing left to prune
+    results = maintenance.prune(application_credentials=True)
+    assert results["trusts"] == 0
+    assert results["revocation-events"] == 0
+    assert results["application-credentials"] == 0
+
+
+def test_prune_in_batches(maintenance: KeystoneMaintenance, fake_exec: FakeKeystoneExec):
+    rows_per_query = PRUNE_BATCH_SIZE * PRUNE_BATCHES_PER_QUERY
+    fake_exec.revocation_events = 2 * rows_per_query + 5
+    results = maintenance.prune()
+    assert results["revocation-events"] == 2 * rows_per_query + 5
+    revocation_commands = [
+        command for command, _ in fake_exec.commands if "revocation_event" in " ".join(command)
+    ]
+    assert len(revocation_commands) == 3
+    # Out of time: the rows left are deleted in the next pruning
+    fake_exec.revocation_events = 2 * rows_per_query
+    results = maintenance.prune(application_credentials=True, time_budget=0)
+    assert results["revocation-events"] == rows_per_query
+    assert results["complete"] == 0
+    assert "application-credentials" not in results
+    assert fake_exec.revocation_events == rows_per_query
+
+
+def test_prune_trust_flush_time_budget(
+    maintenance: KeystoneMaintenance, fake_exec: FakeKeystoneExec, mocker
+):
+    maintenance.prune(time_budget=30)
+    trust_flush, kwargs = next(
+        (command, kwargs) for command, kwargs in fake_exec.commands if command[0] != "mysql"
+    )
+    assert trust_flush == ["keystone-manage", "trust_flush"]
+    assert 0 < kwargs["timeout"] <= 30
+
+    # Killed at the deadline: the trusts are flushed in the next pruning
+    fake_exec.trust_flush_timeout = True
+    fake_exec.flushable_trusts = 3
+    fake_exec.revocation_events = 2
+    times = iter([0, 1, 31, 32])
+    mocker.patch("maintenance.time.monotonic", side_effect=lambda: next(times))
+    results = maintenance.prune(time_budget=30)
+    assert results["trusts"] == 0
+    assert results["revocation-events"] == 2
+    assert results["complete"] == 0
+
+    # Other failures are raised
+    times = iter([0, 1, 2])
+    with pytest.raises(pebble.ChangeError):
+        maintenance.prune(time_budget=30)
+
+
+def test_credential_migration_progress(maintenance: KeystoneMaintenance):
+    assert maintenance.credential_migration_progress("new") == {"migrated": 2, "total": 5}
+    assert maintenance.credential_migration_progress("other") == {"migrated": 0, "total": 5}
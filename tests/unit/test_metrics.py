@@ -0,0 +1,103 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+
+import pytest
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+from interfaces import PrometheusScrapeProvider
+from metrics import EXPORTER_STATE_FILE, CharmMetrics, InstrumentedContainer
+
+METADATA = """
+name: test-charm
+containers:
+  workload:
+    resource: workload-image
+provides:
+  metrics-endpoint:
+    interface: prometheus_scrape
+"""
+
+
+class MetricsCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.container = InstrumentedContainer(self.unit.get_container("workload"))
+        self.metrics = CharmMetrics(self, self.container)
+        self.metrics.workload_state = {"rotation_times": {"fernet": 1200}}
+        self.metrics_endpoint = PrometheusScrapeProvider(self, "metrics-endpoint", port=9180)
+
+
+@pytest.fixture
+def harness(monkeypatch):
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/update-status")
+    metrics_harness = Harness(MetricsCharm, meta=METADATA)
+    metrics_harness.begin()
+    metrics_harness.set_can_connect("workload", True)
+    yield metrics_harness
+    metrics_harness.cleanup()
+
+
+def test_state_file(harness: Harness):
+    container = harness.charm.container
+    container.exists("/etc")
+    container.exists("/etc")
+    # The calls made without the wrapper are not counted, and the container is not patched
+    unwrapped_container = harness.charm.unit.get_container("workload")
+    unwrapped_container.exists("/etc")
+    assert "exists" not in vars(unwrapped_container)
+    harness.charm.metrics.key_synced()
+    harness.framework.on.pre_commit.emit()
+
+    state = json.loads(container.pull(EXPORTER_STATE_FILE).read())
+    assert state["hooks"]["update-status"]["duration"] >= 0
+    assert state["pebble_calls"]["exists"] == 2
+    assert state["last_key_sync"] > 0
+    assert state["rotation_times"] == {"fernet": 1200}
+
+    # The calls are accumulated across hooks
+    container.exists("/etc")
+    harness.framework.on.pre_commit.emit()
+    state = json.loads(container.pull(EXPORTER_STATE_FILE).read())
+    assert state["pebble_calls"]["exists"] == 3
+
+
+def test_state_file_written_on_change(harness: Harness, monkeypatch):
+    harness.framework.on.pre_commit.emit()
+    unwrapped_container = harness.charm.unit.get_container("workload")
+    state = unwrapped_container.pull(EXPORTER_STATE_FILE).read()
+    assert "pebble_calls" in state
+
+    # A hook without Pebble calls nor new values does not write the state file
+    unwrapped_container.push(EXPORTER_STATE_FILE, "unchanged")
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/config-changed")
+    harness.framework.on.pre_commit.emit()
+    assert unwrapped_container.pull(EXPORTER_STATE_FILE).read() == "unchanged"
+
+    # Its duration is written along with the next change
+    harness.charm.metrics.workload_state["rotation_times"] = {"fernet": 600}
+    harness.framework.on.pre_commit.emit()
+    state = json.loads(unwrapped_container.pull(EXPORTER_STATE_FILE).read())
+    assert state["rotation_times"] == {"fernet": 600}
+    assert "config-changed" in state["hooks"]
+
+
+def test_scrape_jobs(harness: Harness, monkeypatch):
+    network = {
+        "bind-addresses": [{"addresses": [{"value": "10.1.2.3"}]}],
+        "ingress-addresses": ["10.1.2.3"],
+        "egress-subnets": ["10.1.2.3/32"],
+    }
+    monkeypatch.setattr(harness._backend, "network_get", lambda *args: network, raising=False)
+    harness.set_leader(True)
+    relation_id = harness.add_relation("metrics-endpoint", "prometheus")
+    harness.add_relation_unit(relation_id, "prometheus/0")
+    app_data = harness.get_relation_data(relation_id, "test-charm")
+    scrape_jobs = json.loads(app_data["scrape_jobs"])
+    assert scrape_jobs[0]["static_configs"] == [{"targets": ["*:9180"]}]
+    assert json.loads(app_data["scrape_metadata"])["application"] == "test-charm"
+    unit_data = harness.get_relation_data(relation_id, "test-charm/0")
+    assert unit_data["prometheus_scrape_unit_name"] == "test-charm/0"
+    assert unit_data["prometheus_scrape_unit_address"] == "10.1.2.3"
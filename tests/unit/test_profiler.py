@@ -0,0 +1,108 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import io
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+from ops import pebble
+
+import profiler
+from command_runner import CommandRunner
+
+COLLAPSED = """\
+<module> (keystone/server.py:1);authenticate (keystone/auth.py:10);execute (sqlalchemy/engine.py:5) 6
+<module> (keystone/server.py:1);authenticate (keystone/auth.py:10);simple_bind_s (ldap/ldapobject.py:3) 3
+<module> (keystone/server.py:1);validate (keystone/token.py:7);decrypt (cryptography/fernet.py:9) 1
+"""
+
+PROCESSES = """\
+1 /usr/sbin/apache2 -DFOREGROUND
+12 (wsgi:keystone-pu -DFOREGROUND
+13 (wsgi:keystone-pu -DFOREGROUND
+20 sh -c
+"""
+
+
+def test_parse_collapsed():
+    stacks = profiler.parse_collapsed(COLLAPSED + "garbage\n")
+    assert sum(stacks.values()) == 10
+    assert len(stacks) == 3
+
+
+def test_top_functions():
+    stacks = profiler.parse_collapsed(COLLAPSED)
+    assert profiler.top_functions(stacks, limit=2) == [
+        "60.0% execute (sqlalchemy/engine.py:5)",
+        "30.0% simple_bind_s (ldap/ldapobject.py:3)",
+    ]
+
+
+def test_categorize():
+    stacks = profiler.parse_collapsed(COLLAPSED)
+    assert profiler.categorize(stacks) == {"database": 60.0, "ldap": 30.0, "crypto": 10.0}
+    assert profiler.categorize(profiler.parse_collapsed("")) == {
+        "database": 0.0,
+        "ldap": 0.0,
+        "crypto": 0.0,
+    }
+
+
+def test_find_worker_pids():
+    assert profiler.find_worker_pids(PROCESSES) == [12, 13]
+    # Embedded mode: the apache processes run keystone
+    assert profiler.find_worker_pids("1 /usr/sbin/apache2 -DFOREGROUND\n2 sh\n") == [1]
+
+
+def fake_process(output: str = "", exit_code: int = 0):
+    process = MagicMock()
+    process.stdout = io.StringIO(output)
+    process.stderr = io.StringIO("")
+    if exit_code:
+        process.wait.side_effect = pebble.ExecError([], exit_code, None, None)
+    return process
+
+
+@pytest.fixture
+def container():
+    container = MagicMock()
+    container.exists.return_value = False
+    container.pull.return_value = io.StringIO(COLLAPSED)
+    return container
+
+
+def test_profile(container, tmp_path: Path):
+    commands = []
+
+    def exec_side_effect(command, **kwargs):
+        commands.append(command)
+        if command[-1] == "command -v py-spy":
+            return fake_process(exit_code=1)
+        if command[-1] == profiler.LIST_PROCESSES:
+            return fake_process(PROCESSES)
+        return fake_process()
+
+    container.exec.side_effect = exec_side_effect
+    (tmp_path / "venv" / "bin").mkdir(parents=True)
+    (tmp_path / "venv" / "bin" / "py-spy").write_bytes(b"binary")
+    workload_profiler = profiler.WorkloadProfiler(container, CommandRunner(container), tmp_path)
+
+    profile = workload_profiler.profile(duration=5)
+
+    container.push.assert_called_once()
+    assert container.push.call_args.args[0] == profiler.PY_SPY_PATH
+    record_script = commands[-1][-1]
+    assert "--pid 12" in record_script and "--pid 13" in record_script
+    assert profile["pids"] == "12 13"
+    assert profile["samples"] == 10
+    assert profile["categories"]["database"] == 60.0
+    assert profile["file"].startswith(profiler.PROFILES_FOLDER)
+
+
+def test_profile_without_py_spy(container, tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(profiler.shutil, "which", lambda _: None)
+    container.exec.side_effect = lambda command, **kwargs: fake_process(exit_code=1)
+    workload_profiler = profiler.WorkloadProfiler(container, CommandRunner(container), tmp_path)
+    with pytest.raises(profiler.ProfilerError):
+        workload_profiler.profile(duration=5)
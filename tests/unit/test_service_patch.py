@@ -0,0 +1,96 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import copy
+
+import pytest
+from ops.charm import CharmBase
+from ops.testing import Harness
+from pytest_mock import MockerFixture
+
+from service_patch import ServicePatch
+
+METADATA = """
+name: test-charm
+"""
+
+
+class ServicePatchCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.service_patch = ServicePatch(
+            self,
+            [("test-charm", 5000)],
+            internal_traffic_policy="Local",
+            topology_aware_hints=True,
+            session_affinity="ClientIP",
+            session_affinity_timeout=600,
+        )
+
+
+@pytest.fixture
+def harness(mocker: MockerFixture):
+    mocker.patch(
+        "service_patch.ServicePatch._namespace",
+        new_callable=mocker.PropertyMock,
+        return_value="test",
+    )
+    mocker.patch("service_patch._client", None)
+    service_patch_harness = Harness(ServicePatchCharm, meta=METADATA)
+    service_patch_harness.begin()
+    yield service_patch_harness
+    service_patch_harness.cleanup()
+
+
+def test_service_object(harness: Harness):
+    service = harness.charm.service_patch.service
+    assert service.metadata.name == "test-charm"
+    assert service.spec.ports[0].port == service.spec.ports[0].targetPort == 5000
+    assert service.spec.internalTrafficPolicy == "Local"
+    assert service.spec.sessionAffinity == "ClientIP"
+    assert service.spec.sessionAffinityConfig.clientIP.timeoutSeconds == 600
+    assert service.metadata.annotations == {
+        "service.kubernetes.io/topology-aware-hints": "auto",
+        "service.kubernetes.io/topology-mode": "Auto",
+    }
+
+
+def test_patch(mocker: MockerFixture, harness: Harness):
+    client = mocker.patch("lightkube.Client")
+    live_service = copy.deepcopy(harness.charm.service_patch.service)
+    live_service.spec.sessionAffinity = "None"
+    client.return_value.get.return_value = live_service
+    # Only the leader patches the service
+    harness.charm.service_patch.patch()
+    client.return_value.patch.assert_not_called()
+    harness.set_leader(True)
+    harness.charm.on.upgrade_charm.emit()
+    client.return_value.patch.assert_called_once()
+
+
+def test_patch_skipped_when_service_matches(mocker: MockerFixture, harness: Harness):
+    client = mocker.patch("lightkube.Client")
+    live_service = copy.deepcopy(harness.charm.service_patch.service)
+    live_service.spec.ports[0].nodePort = 30000
+    live_service.spec.selector["controller-uid"] = "1234"
+    client.return_value.get.return_value = live_service
+    harness.set_leader(True)
+    harness.charm.on.install.emit()
+    harness.charm.on.upgrade_charm.emit()
+    client.return_value.patch.assert_not_called()
+    # The client is created once per process
+    assert client.call_count == 1
+
+
+def test_patch_removes_session_affinity_config(mocker: MockerFixture, harness: Harness):
+    client = mocker.patch("lightkube.Client")
+    # The live service still has the config of the "ClientIP" session affinity
+    client.return_value.get.return_value = copy.deepcopy(harness.charm.service_patch.service)
+    service_patch = harness.charm.service_patch
+    service_patch.session_affinity = "None"
+    service_patch._service = None
+    harness.set_leader(True)
+    service_patch.patch()
+    patch = client.return_value.patch.call_args.args[2]
+    assert patch["spec"]["sessionAffinity"] == "None"
+    assert patch["spec"]["sessionAffinityConfig"] is None
@@ -0,0 +1,106 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+import startup
+
+ENTRYPOINT = """\
+#!/bin/bash
+function wait_db(){
+    mysqladmin ping -h"$1" -P"$2" --silent
+}
+wait_db "$DB_HOST" "$DB_PORT" || exit 1
+if [ -z $DB_EXISTS ]; then
+    su -s /bin/sh -c "keystone-manage db_sync" keystone
+fi
+keystone-manage fernet_setup --keystone-user keystone --keystone-group keystone
+keystone-manage credential_setup --keystone-user keystone --keystone-group keystone
+OS_BOOTSTRAP_REGION_ID=$REGION_ID \\
+    keystone-manage bootstrap --bootstrap-password $ADMIN_PASSWORD
+service apache2 restart
+"""
+
+TIMELINE = """\
+charm 100.0
+replan 101.5
+entrypoint 102.0
+db-wait 102.5
+garbage
+db-sync 130.0
+serving 140.0
+"""
+
+
+class StartupCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.startup = startup.StartupTimeline(self, self.unit.get_container("keystone"))
+
+
+def test_instrument_entrypoint():
+    lines = startup.instrument_entrypoint(ENTRYPOINT).splitlines()
+    assert lines[0] == "#!/bin/bash"
+    assert lines[1] == startup.marker_command("entrypoint")
+    assert lines[lines.index('wait_db "$DB_HOST" "$DB_PORT" || exit 1') - 1] == (
+        startup.marker_command("db-wait")
+    )
+    # The markers keep the indentation of the step
+    db_sync = lines.index('    su -s /bin/sh -c "keystone-manage db_sync" keystone')
+    assert lines[db_sync - 1] == "    " + startup.marker_command("db-sync")
+    # A marker is never inserted in a continued line
+    assert startup.marker_command("bootstrap") not in lines
+    assert lines[-2] == startup.marker_command("apache-start")
+    assert lines[-1] == "service apache2 restart"
+
+
+def test_last_startup():
+    markers = startup.parse_timeline(TIMELINE)
+    assert len(markers) == 6
+    assert startup.last_startup(markers) == markers
+    # Pebble restarted the entrypoint: the markers of the charm are not part of the startup
+    restarted = markers + [("entrypoint", 150.0), ("serving", 160.0)]
+    assert startup.last_startup(restarted) == [("entrypoint", 150.0), ("serving", 160.0)]
+    assert startup.last_startup(markers[:2]) == []
+
+
+def test_phase_durations_and_regressions():
+    phases = startup.phase_durations(startup.parse_timeline(TIMELINE))
+    assert phases == {
+        "charm": 1.5,
+        "replan": 0.5,
+        "entrypoint": 0.5,
+        "db-wait": 27.5,
+        "db-sync": 10.0,
+    }
+    history = [{"phases": {"db-wait": 2.0, "db-sync": 8.0}}, {"phases": {"db-wait": 3.0}}]
+    assert startup.find_regressions(phases, history) == ["db-wait"]
+    assert startup.find_regressions(phases, []) == []
+
+
+def test_startup_timeline():
+    harness = Harness(StartupCharm, meta="name: test\ncontainers:\n  keystone: {}\n")
+    harness.begin()
+    harness.set_can_connect("keystone", True)
+    timeline = harness.charm.startup
+    assert timeline.collect() is None
+    timeline.restarting()
+    assert timeline.collect() is None
+    assert timeline.pending
+    container = harness.charm.unit.get_container("keystone")
+    for number in range(startup.HISTORY_LENGTH + 1):
+        timeline.restarting()
+        content = container.pull(startup.TIMELINE_FILE).read()
+        container.push(
+            startup.TIMELINE_FILE,
+            content + f"entrypoint {2e9 + number}\nserving {2e9 + number + 10}\n",
+        )
+        recorded = timeline.collect()
+        assert recorded["phases"]["entrypoint"] == 10
+        assert not timeline.pending
+        assert timeline.last == recorded
+        # The startup is only recorded once
+        assert timeline.collect() is None
+    assert len(timeline._stored.history) == startup.HISTORY_LENGTH
+    harness.cleanup()
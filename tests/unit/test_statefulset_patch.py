@@ -0,0 +1,151 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import pytest
+from lightkube.models.apps_v1 import StatefulSetSpec
+from lightkube.models.core_v1 import (
+    Container,
+    Lifecycle,
+    PodSpec,
+    PodTemplateSpec,
+    ResourceRequirements,
+    TopologySpreadConstraint,
+)
+from lightkube.models.meta_v1 import LabelSelector
+from lightkube.resources.apps_v1 import StatefulSet
+from ops.charm import CharmBase
+from ops.testing import Harness
+from pytest_mock import MockerFixture
+
+from statefulset_patch import KubernetesStatefulSetPatch
+
+METADATA = """
+name: test-charm
+"""
+
+
+class FakeClient:
+    """Fake lightkube client that applies strategic merge patches to a StatefulSet."""
+
+    def __init__(self):
+        self.patches = []
+        self.statefulset = StatefulSet(
+            spec=StatefulSetSpec(
+                selector=LabelSelector(matchLabels={"app.kubernetes.io/name": "test-charm"}),
+                serviceName="test-charm",
+                template=PodTemplateSpec(
+                    spec=PodSpec(
+                        containers=[Container(name="charm"), Container(name="app")],
+                        terminationGracePeriodSeconds=30,
+                    )
+                ),
+            )
+        )
+
+    def get(self, res, name, namespace=None):
+        return self.statefulset
+
+    def patch(self, res, name, obj, namespace=None, patch_type=None):
+        self.patches.append(obj)
+        pod_spec = obj["spec"]["template"]["spec"]
+        template_spec = self.statefulset.spec.template.spec
+        template_spec.topologySpreadConstraints = [
+            TopologySpreadConstraint.from_dict(c)
+            for c in pod_spec["topologySpreadConstraints"] or []
+        ]
+        template_spec.terminationGracePeriodSeconds = pod_spec.get(
+            "terminationGracePeriodSeconds", template_spec.terminationGracePeriodSeconds
+        )
+        for container in template_spec.containers:
+            for container_patch in pod_spec["containers"]:
+                if container.name == container_patch["name"]:
+                    resources = container_patch["resources"]
+                    container.resources = ResourceRequirements.from_dict(
+                        {k: v for k, v in resources.items() if v is not None}
+                    )
+                    lifecycle = container_patch["lifecycle"]
+                    container.lifecycle = Lifecycle.from_dict(lifecycle) if lifecycle else None
+
+
+class StatefulSetPatchCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.statefulset_patch = KubernetesStatefulSetPatch(
+            self,
+            "app",
+            requests={"cpu": "500m", "memory": ""},
+            limits={"memory": "1Gi"},
+            spread="soft",
+            pre_stop=["python3", "/drain.py"],
+            termination_grace_period=60,
+            refresh_event=self.on.config_changed,
+            client=FakeClient(),
+        )
+
+
+@pytest.fixture
+def harness(mocker: MockerFixture):
+    mocker.patch(
+        "statefulset_patch.KubernetesStatefulSetPatch._namespace",
+        new_callable=mocker.PropertyMock,
+        return_value="test",
+    )
+    statefulset_patch_harness = Harness(StatefulSetPatchCharm, meta=METADATA)
+    statefulset_patch_harness.set_leader(True)
+    statefulset_patch_harness.begin()
+    yield statefulset_patch_harness
+    statefulset_patch_harness.cleanup()
+
+
+def test_patch(harness: Harness):
+    client = harness.charm.statefulset_patch.client
+    harness.charm.on.install.emit()
+    assert len(client.patches) == 1
+    pod_spec = client.statefulset.spec.template.spec
+    assert pod_spec.containers[1].resources.requests == {"cpu": "500m"}
+    assert pod_spec.containers[1].resources.limits == {"memory": "1Gi"}
+    assert pod_spec.containers[0].resources is None
+    assert pod_spec.topologySpreadConstraints[0].whenUnsatisfiable == "ScheduleAnyway"
+    assert pod_spec.topologySpreadConstraints[0].topologyKey == "kubernetes.io/hostname"
+    assert pod_spec.containers[1].lifecycle.preStop.exec.command == ["python3", "/drain.py"]
+    assert pod_spec.terminationGracePeriodSeconds == 60
+    # Nothing changed: the patch is not applied again
+    harness.charm.on.config_changed.emit()
+    assert len(client.patches) == 1
+
+
+def test_patch_non_leader(harness: Harness):
+    harness.set_leader(False)
+    harness.charm.on.install.emit()
+    assert harness.charm.statefulset_patch.client.patches == []
+
+
+def test_patch_without_drain(harness: Harness):
+    statefulset_patch = harness.charm.statefulset_patch
+    statefulset_patch.pre_stop = None
+    statefulset_patch.termination_grace_period = None
+    harness.charm.on.install.emit()
+    pod_spec = statefulset_patch.client.statefulset.spec.template.spec
+    assert pod_spec.containers[1].lifecycle is None
+    # The termination grace period is left alone
+    assert pod_spec.terminationGracePeriodSeconds == 30
+    assert (
+        "terminationGracePeriodSeconds"
+        not in statefulset_patch.client.patches[0]["spec"]["template"]["spec"]
+    )
+    harness.charm.on.config_changed.emit()
+    assert len(statefulset_patch.client.patches) == 1
+
+
+def test_patch_normalized_quantities(harness: Harness):
+    statefulset_patch = harness.charm.statefulset_patch
+    harness.charm.on.install.emit()
+    # Kubernetes stores the quantities normalized
+    resources = statefulset_patch.client.statefulset.spec.template.spec.containers[1].resources
+    resources.requests = {"cpu": "0.5"}
+    resources.limits = {"memory": "1024Mi"}
+    harness.charm.on.config_changed.emit()
+    assert len(statefulset_patch.client.patches) == 1
+    statefulset_patch.limits = {"memory": "2Gi"}
+    harness.charm.on.config_changed.emit()
+    assert len(statefulset_patch.client.patches) == 2
@@ -0,0 +1,77 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+from metrics import InstrumentedContainer
+from tracing import Tracing, traced
+
+METADATA = """
+name: test-charm
+containers:
+  workload:
+    resource: workload-image
+"""
+
+
+class TracedCharm(CharmBase):
+    endpoint = None
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.container = InstrumentedContainer(self.unit.get_container("workload"))
+        self.tracing = Tracing(self, self.endpoint, self.container)
+
+    @traced
+    def _some_method(self, value):
+        self.container.exists("/etc")
+        return value
+
+
+@pytest.fixture
+def harness(monkeypatch):
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/update-status")
+    tracing_harness = Harness(TracedCharm, meta=METADATA)
+    yield tracing_harness
+    tracing_harness.cleanup()
+
+
+def test_tracing_disabled(harness: Harness):
+    harness.begin()
+    harness.set_can_connect("workload", True)
+    assert not harness.charm.tracing.enabled
+    assert harness.charm._some_method("value") == "value"
+    assert harness.charm.tracing.inject() == {}
+    with harness.charm.tracing.span("span") as span:
+        assert span is None
+
+
+def test_tracing_without_opentelemetry(harness: Harness, monkeypatch):
+    monkeypatch.setitem(sys.modules, "opentelemetry", None)
+    monkeypatch.setattr(TracedCharm, "endpoint", "http://tempo:4318/v1/traces")
+    harness.begin()
+    harness.set_can_connect("workload", True)
+    assert not harness.charm.tracing.enabled
+    assert harness.charm._some_method("value") == "value"
+
+
+def test_tracing_to_file(harness: Harness, tmp_path: Path, monkeypatch):
+    traces_file = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(TracedCharm, "endpoint", f"file://{traces_file}")
+    harness.begin()
+    harness.set_can_connect("workload", True)
+    assert harness.charm._some_method("value") == "value"
+    assert "traceparent" in harness.charm.tracing.inject()
+    harness.framework.commit()
+    assert harness.charm.tracing._traces_file.closed
+
+    spans = {span["name"]: span for span in map(json.loads, traces_file.read_text().splitlines())}
+    assert set(spans) == {"update-status", "_some_method", "pebble.exists"}
+    assert spans["pebble.exists"]["parent_id"] == spans["_some_method"]["context"]["span_id"]
+    assert spans["_some_method"]["parent_id"] == spans["update-status"]["context"]["span_id"]
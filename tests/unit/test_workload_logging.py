@@ -0,0 +1,66 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import yaml
+
+import workload_logging
+
+SITE_CONFIG = """\
+<VirtualHost *:5000>
+    WSGIScriptAlias / /usr/bin/keystone-wsgi-public
+    ErrorLog /var/log/apache2/keystone.log
+    CustomLog /var/log/apache2/keystone_access.log combined
+</VirtualHost>
+"""
+
+
+def test_keystone_logging_config():
+    assert workload_logging.keystone_logging_config("debug") == "[DEFAULT]\ndebug = True\n"
+    assert workload_logging.keystone_logging_config("info") == "[DEFAULT]\ndebug = False\n"
+    config = workload_logging.keystone_logging_config("warning")
+    assert "debug = False" in config
+    # The levels of the noisy libraries are kept
+    assert "default_log_levels = amqp=WARN," in config
+    assert config.endswith(",keystone=WARNING\n")
+
+
+def test_apache_logging_config():
+    assert workload_logging.apache_logging_config("warning") == (
+        "LogLevel warn\n"
+        "BufferedLogs On\n"
+        'LogFormat "%>s %D" keystone-requests\n'
+        "GlobalLog /var/log/apache2/keystone-requests.metrics keystone-requests\n"
+    )
+
+
+def test_toggle_access_log():
+    disabled = workload_logging.toggle_access_log(SITE_CONFIG, False)
+    assert "    # Disabled by the charm: CustomLog /var/log/apache2/" in disabled
+    assert "ErrorLog /var/log/apache2/keystone.log" in disabled
+    assert workload_logging.toggle_access_log(disabled, False) == disabled
+    assert workload_logging.toggle_access_log(disabled, True) == SITE_CONFIG
+    assert workload_logging.toggle_access_log(SITE_CONFIG, True) == SITE_CONFIG
+
+
+def test_log_forwarding_layer():
+    layer = yaml.safe_load(
+        workload_logging.log_forwarding_layer(
+            {"loki/1": "http://loki-1:3100/loki/api/v1/push"},
+            ["loki-loki-0", "loki-loki-1"],
+            {"juju_unit": "osm-keystone/0"},
+        )
+    )
+    assert layer["services"]["log-forwarder"]["startup"] == "enabled"
+    assert layer["log-targets"]["loki-loki-1"] == {
+        "override": "replace",
+        "type": "loki",
+        "location": "http://loki-1:3100/loki/api/v1/push",
+        "services": ["all"],
+        "labels": {"juju_unit": "osm-keystone/0"},
+    }
+    # The logs are not forwarded to the units that are gone
+    assert layer["log-targets"]["loki-loki-0"] == {"override": "merge", "services": ["-all"]}
+
+    layer = yaml.safe_load(workload_logging.log_forwarding_layer({}, ["loki-loki-1"], {}))
+    assert layer["services"]["log-forwarder"]["startup"] == "disabled"
+    assert layer["log-targets"]["loki-loki-1"]["services"] == ["-all"]